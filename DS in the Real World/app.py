@@ -1,54 +1,953 @@
 import os
+import gc
+import io
+import ast
+import math
+import bisect
+import cProfile
+import pstats
 import json
+import time
+import random
+import hashlib
+import queue
 import pickle
+import atexit
+import threading
+import collections
+from collections import OrderedDict
+from concurrent.futures import Future
 import joblib
+import numpy as np
 import pandas as pd
-from flask import Flask, jsonify, request
+from scipy import sparse
+from flask import Flask, Response, g, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from peewee import (
     SqliteDatabase, PostgresqlDatabase, Model, IntegerField,
-    FloatField, TextField, IntegrityError
+    FloatField, TextField, IntegrityError, DatabaseError, chunked, fn
 )
 from playhouse.shortcuts import model_to_dict
 from playhouse.db_url import connect
+from playhouse.migrate import SchemaMigrator, migrate
+
+########################################
+# Begin background thread stuff
+
+
+class BackgroundThread:
+    """
+        A daemon thread running target, started at most once per process.
+        Threads do not survive a fork, so every worker process of a
+        preloading server starts its own on first use.
+    """
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self.lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self.target, name=self.name, daemon=True).start()
+                self._pid = os.getpid()
+
+
+class DroppingQueue(queue.Queue):
+    """
+        Bounded queue from the request path to a background thread: offer
+        never blocks, the work that does not fit is dropped and counted
+        rather than slowing requests down when the thread lags
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.dropped_lock = threading.Lock()
+        self.dropped = 0
+
+    def offer(self, item, size=1):
+        """
+            Queues item, or counts size dropped items if the queue is full
+
+            Returns:
+            - True if item was queued
+        """
+        try:
+            self.put_nowait(item)
+            return True
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += size
+            return False
+
+# End background thread stuff
+########################################
+
+########################################
+# Begin metrics stuff
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """
+        Prometheus style histogram: cumulative counts are only computed when
+        the metrics are rendered, an observation is a bisect and three
+        increments
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+class Metrics:
+    """
+        In-process counters and latency histograms, rendered in the
+        Prometheus text format by GET /metrics. Metrics are identified by a
+        name and a tuple of (label, value) pairs.
+
+        They are per process: behind several gunicorn workers each scrape
+        sees the worker that answered it, aggregate them by instance.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        # Callables returning extra (name, type, labels, value) samples,
+        # e.g. the statistics of the cache, evaluated at render time
+        self.collectors = []
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def stage(self, name):
+        """
+            Context manager timing a stage of the request handling into the
+            stage_seconds histogram
+        """
+        return _StageTimer(self.histogram('stage_seconds', (('stage', name),)))
+
+    def render(self):
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append('# HELP {} {}'.format(name, self.help[name]))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            header(name, 'histogram')
+            counts, total = histogram.snapshot()
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', le),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative))
+        for collector in self.collectors:
+            for name, kind, labels, value in collector():
+                header(name, kind)
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+class _StageTimer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+class RequestProfiler:
+    """
+        Profiles sampled requests with cProfile and dumps the stats to
+        directory, to read with pstats, snakeviz or GET /profile?name=...
+
+        A request is profiled when it is drawn with probability sample_rate,
+        when arm(n) asked for the next n requests, or when forced (an admin
+        sent an X-Profile header). cProfile only sees the thread it runs in,
+        and only one profiler can be active at a time, so one request is
+        profiled at a time and the others are skipped meanwhile.
+    """
+
+    def __init__(self, directory, sample_rate=0.0, keep=50):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.armed = 0
+        self.profiled = 0
+        self.dumps = []
+        self.lock = threading.Lock()
+        self.busy = threading.Lock()
+
+    def arm(self, n):
+        with self.lock:
+            self.armed = n
+
+    def start(self, forced=False):
+        """
+            Returns a running profiler if this request is to be profiled,
+            None otherwise
+        """
+        sampled = self.sample_rate and random.random() < self.sample_rate
+        if not (forced or sampled or self.armed):
+            return None
+        if not self.busy.acquire(blocking=False):
+            return None
+        with self.lock:
+            if not (forced or sampled) and self.armed:
+                self.armed -= 1
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def finish(self, profiler, label):
+        """
+            Stops the profiler and dumps its stats, returns the dump name
+        """
+        profiler.disable()
+        self.busy.release()
+        with self.lock:
+            self.profiled += 1
+            name = '{}-{}-{}-{}.prof'.format(time.strftime('%Y%m%d-%H%M%S'), label, os.getpid(), self.profiled)
+        os.makedirs(self.directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(self.directory, name))
+        with self.lock:
+            self.dumps.append(name)
+            expired, self.dumps = self.dumps[:-self.keep], self.dumps[-self.keep:]
+        for old in expired:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+        return name
+
+    def report(self, name, limit=40):
+        """
+            Returns the stats of a dump of this process sorted by cumulative
+            time, or None if there is no such dump
+        """
+        if name not in self.dumps:
+            return None
+        out = io.StringIO()
+        stats = pstats.Stats(os.path.join(self.directory, name), stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def status(self):
+        return {'sample_rate': self.sample_rate, 'armed': self.armed, 'profiles': list(self.dumps)}
+
+
+metrics = Metrics()
+metrics.describe('request_seconds', "Latency of the requests by endpoint")
+metrics.describe('requests_total', "Requests by endpoint and status code")
+metrics.describe('stage_seconds', "Latency of the stages of the request handling")
+metrics.describe('validation_failures_total', "Observations rejected, by offending field")
+metrics.describe('duplicate_ids_total', "Predictions not stored because their admission_id exists")
+metrics.describe('model_errors_total', "Exceptions raised while scoring")
+metrics.describe('db_errors_total', "Database errors (other than duplicate ids)")
+
+profiler = RequestProfiler(
+    os.environ.get('PROFILE_DIR', 'profiles'),
+    sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+
+# End metrics stuff
+########################################
 
 ########################################
 # Begin database stuff
 
-DB = connect(os.environ.get('DATABASE_URL') or 'sqlite:///predictions.db')
+def connect_from_env():
+    """
+        Opens the database from DATABASE_URL (defaults to a local SQLite file).
+
+        Unless DB_POOLING=0, the pooled playhouse backends are used, so each
+        request that queries the database takes a connection from the pool
+        and returns it at the end:
+        - DB_MAX_CONNECTIONS: pool size per process (default 20)
+        - DB_STALE_TIMEOUT: seconds after which an idle connection is recycled (default 300)
+        - DB_POOL_TIMEOUT: seconds to wait for a free connection (default 10)
+
+        SQLite is opened in WAL mode so readers do not block the writer:
+        - SQLITE_SYNCHRONOUS: synchronous pragma (default normal, safe with WAL)
+        - SQLITE_CACHE_SIZE_KB: page cache per connection (default 64000)
+    """
+    url = os.environ.get('DATABASE_URL') or 'sqlite:///predictions.db'
+    scheme, rest = url.split('://', 1)
+    options = {}
+
+    if scheme.startswith('sqlite'):
+        options['pragmas'] = {
+            'journal_mode': 'wal',
+            'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'normal'),
+            'cache_size': -int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64000)),
+        }
+
+    # An in-memory SQLite database only exists for its own connection
+    pooling = os.environ.get('DB_POOLING', '1').lower() not in ('0', 'false', 'no')
+    if pooling and ':memory:' not in rest and '+pool' not in scheme:
+        scheme += '+pool'
+        options.update(
+            max_connections=int(os.environ.get('DB_MAX_CONNECTIONS', 20)),
+            stale_timeout=float(os.environ.get('DB_STALE_TIMEOUT', 300)),
+            timeout=float(os.environ.get('DB_POOL_TIMEOUT', 10)))
+        if scheme.startswith('sqlite'):
+            # Pooled connections are handed to whichever thread asks next
+            options['check_same_thread'] = False
+
+    return connect('{}://{}'.format(scheme, rest), **options)
+
+
+DB = connect_from_env()
 
 
 class Prediction(Model):
     admission_id = IntegerField(unique=True)
+    # Compact JSON array of the feature values in the order of the
+    # ObservationLayout named by layout. Rows stored before layouts existed
+    # have no layout and hold the repr of the observation dict
     observation = TextField()
     predicted_readmitted = TextField()
     actual_readmitted = TextField(null=True)
+    model_version = TextField(null=True)
+    layout = TextField(null=True)
+    # Unix time of the prediction
+    created_at = FloatField(null=True)
+    # Prediction of the shadow model, if one scored this observation
+    shadow_predicted_readmitted = TextField(null=True)
+    shadow_model_version = TextField(null=True)
+
+    class Meta:
+        database = DB
+
+
+class ObservationLayout(Model):
+    """
+        The feature columns of stored observations, one row per distinct
+        columns list of the model bundles
+    """
+    key = TextField(unique=True)
+    columns = TextField()
 
     class Meta:
         database = DB
 
 
-DB.create_tables([Prediction], safe=True)
+def migrate_prediction_table():
+    """
+        Adds the (nullable) columns introduced after the table was created
+    """
+    existing = set(column.name for column in DB.get_columns(Prediction._meta.table_name))
+    missing = [field for field in Prediction._meta.sorted_fields if field.column_name not in existing]
+    if missing:
+        migrator = SchemaMigrator.from_database(DB)
+        migrate(*[migrator.add_column(Prediction._meta.table_name, field.column_name, field)
+                  for field in missing])
+
+
+def create_tables():
+    with DB.connection_context():
+        DB.create_tables([Prediction, ObservationLayout], safe=True)
+        migrate_prediction_table()
+
+
+def layout_key(columns):
+    return hashlib.blake2b(json.dumps(list(columns)).encode(), digest_size=8).hexdigest()
+
+
+def register_layout(columns):
+    """
+        Makes sure the layout of columns is stored, returns its key
+    """
+    key = layout_key(columns)
+    if key not in layouts:
+        with DB.connection_context():
+            (ObservationLayout
+             .insert(key=key, columns=json.dumps(list(columns)))
+             .on_conflict_ignore()
+             .execute())
+        layouts[key] = list(columns)
+    return key
+
+
+def get_layout(key):
+    """
+        Returns the columns of the layout key, or None if it is unknown
+    """
+    if key not in layouts:
+        row = ObservationLayout.get_or_none(ObservationLayout.key == key)
+        if row is None:
+            return None
+        layouts[key] = json.loads(row.columns)
+    return layouts[key]
+
+
+layouts = {}
+
+
+def pack_observation(observation, columns):
+    """
+        Returns the values of observation in the order of columns, as a
+        compact JSON array (NaN is stored as null)
+    """
+    values = [observation.get(key) for key in columns]
+    values = [None if value != value else value for value in values]
+    return json.dumps(values, separators=(',', ':'))
+
+
+class _NaNConstants(ast.NodeTransformer):
+    # repr() writes float NaN and infinity as bare names, which
+    # ast.literal_eval rejects
+    def visit_Name(self, node):
+        if node.id in ('nan', 'inf'):
+            return ast.copy_location(ast.Constant(float(node.id)), node)
+        return node
+
+
+def unpack_legacy_observation(text):
+    """
+        Parses the observation of a row stored before layouts existed: the
+        repr of the observation dict (or JSON)
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        tree = _NaNConstants().visit(ast.parse(text, mode='eval'))
+        return ast.literal_eval(tree.body)
+
+
+def existing_admission_ids(admission_ids):
+    """
+        Returns the subset of admission_ids that already have a prediction,
+        querying the table in chunks to stay under the bound parameter limit
+    """
+    existing = set()
+    for ids in chunked(admission_ids, 500):
+        query = (Prediction
+                 .select(Prediction.admission_id)
+                 .where(Prediction.admission_id.in_(ids)))
+        existing.update(row.admission_id for row in query)
+    return existing
+
+
+def save_predictions(rows):
+    """
+        Inserts the prediction rows in a single transaction
+
+        Returns:
+        - set of admission ids that could not be saved because they already
+          exist (only possible if another request inserted them concurrently)
+    """
+    try:
+        with DB.atomic():
+            for batch in chunked(rows, 100):
+                Prediction.insert_many(batch).execute()
+        return set()
+    except IntegrityError:
+        pass
+
+    # Someone else saved some of these ids in the meantime: fall back to
+    # one savepoint per row so that the rest of the batch is still stored
+    duplicates = set()
+    with DB.atomic():
+        for row in rows:
+            try:
+                with DB.atomic():
+                    Prediction.insert(row).execute()
+            except IntegrityError:
+                duplicates.add(row['admission_id'])
+    return duplicates
+
+
+def update_outcomes(outcomes):
+    """
+        Sets the actual_readmitted of many predictions in one transaction.
+        The stored values are read in chunks, then only the rows whose
+        outcome changes are written, with one set-based statement: a join
+        against a temporary table on Postgres, a single executemany of the
+        prepared UPDATE elsewhere (SQLite)
+
+        Returns:
+        - dict {admission_id: (status, predicted_readmitted)} where status is
+          'updated', 'unchanged' or 'unknown' (no prediction with that id)
+        - list of (model_version, created_at, predicted_readmitted, previous
+          actual_readmitted, new actual_readmitted, shadow_model_version,
+          shadow_predicted_readmitted) of the updated rows
+    """
+    table = Prediction._meta.table_name
+    param = DB.param
+    results = {}
+    updated = []
+    with DB.atomic():
+        stored = {}
+        for ids in chunked(list(outcomes), 500):
+            query = (Prediction
+                     .select(Prediction.admission_id, Prediction.predicted_readmitted,
+                             Prediction.actual_readmitted, Prediction.model_version, Prediction.created_at,
+                             Prediction.shadow_model_version, Prediction.shadow_predicted_readmitted)
+                     .where(Prediction.admission_id.in_(ids))
+                     .tuples())
+            stored.update((row[0], row[1:]) for row in query)
+
+        changes = []
+        for _id, actual in outcomes.items():
+            if _id not in stored:
+                results[_id] = ('unknown', None)
+                continue
+            predicted, previous, version, created_at, shadow_version, shadow_predicted = stored[_id]
+            results[_id] = ('unchanged' if previous == actual else 'updated', predicted)
+            if previous != actual:
+                changes.append((actual, _id))
+                updated.append((version, created_at, predicted, previous, actual, shadow_version, shadow_predicted))
+
+        if changes and isinstance(DB, PostgresqlDatabase):
+            DB.execute_sql('CREATE TEMPORARY TABLE outcome_update '
+                           '(admission_id INTEGER PRIMARY KEY, actual_readmitted TEXT) ON COMMIT DROP')
+            for batch in chunked(changes, 1000):
+                values = ', '.join(['({0}, {0})'.format(param)] * len(batch))
+                DB.execute_sql('INSERT INTO outcome_update (actual_readmitted, admission_id) VALUES ' + values,
+                               [value for change in batch for value in change])
+            DB.execute_sql('UPDATE "{0}" SET actual_readmitted = u.actual_readmitted '
+                           'FROM outcome_update u WHERE "{0}".admission_id = u.admission_id'.format(table))
+        elif changes:
+            DB.cursor().executemany(
+                'UPDATE "{0}" SET actual_readmitted = {1} WHERE admission_id = {1}'.format(table, param),
+                changes)
+    return results, updated
+
+
+def save_shadow_predictions(rows):
+    """
+        Stores the predictions of the shadow model, rows of
+        (shadow_predicted_readmitted, shadow_model_version, admission_id),
+        with one executemany of the prepared UPDATE in a single transaction
+    """
+    table = Prediction._meta.table_name
+    param = DB.param
+    with DB.atomic():
+        DB.cursor().executemany(
+            'UPDATE "{0}" SET shadow_predicted_readmitted = {1}, shadow_model_version = {1} '
+            'WHERE admission_id = {1}'.format(table, param),
+            rows)
+
+
+class PredictionWriter:
+    """
+        Write-behind persistence of Prediction rows.
+
+        Requests reserve their admission_id in an in-memory index (seeded from
+        the table) so duplicates are still reported synchronously, then append
+        the row to a buffer. A background thread inserts the buffer with
+        insert_many in one transaction every interval_ms or as soon as
+        max_rows rows are waiting. close() drains the buffer on shutdown.
+
+        A flush that fails (e.g. database is locked or unreachable) puts its
+        rows back in front of the buffer, their ids stay reserved, and the
+        thread retries with an exponential backoff up to max_retry_seconds:
+        an acknowledged prediction is never dropped. close() retries the same
+        way for up to close_timeout_seconds, then logs the admission_ids it
+        could not write.
+
+        The index is per process: with several worker processes a duplicate
+        sent to two different workers is only caught when the row is flushed.
+    """
+
+    def __init__(self, max_rows=500, interval_ms=50.0, max_retry_seconds=5.0, close_timeout_seconds=10.0):
+        self.max_rows = max_rows
+        self.interval = interval_ms / 1000.0
+        self.max_retry = max_retry_seconds
+        self.close_timeout = close_timeout_seconds
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.buffer = []
+        self.pending = set()
+        self.known_ids = set()
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.late_duplicates = 0
+        self.failed_flushes = 0
+        self.closed = False
+        self.thread = BackgroundThread(self._run, 'prediction-writer')
+
+    def seed(self):
+        """
+            Loads the admission ids already in the table into the index
+        """
+        with DB.connection_context():
+            known_ids = set(row.admission_id for row in Prediction.select(Prediction.admission_id))
+        with self.lock:
+            self.known_ids.update(known_ids)
+
+    def reserve(self, admission_id):
+        """
+            Returns True if admission_id is new, False if it already has a prediction
+        """
+        with self.lock:
+            if admission_id in self.known_ids:
+                return False
+            self.known_ids.add(admission_id)
+            return True
+
+    def put(self, row):
+        self.put_many([row])
+
+    def put_many(self, rows):
+        self.thread.ensure_started()
+        with self.lock:
+            self.buffer.extend(rows)
+            self.pending.update(row['admission_id'] for row in rows)
+            if len(self.buffer) >= self.max_rows:
+                self.wakeup.notify()
+
+    def is_pending(self, admission_id):
+        with self.lock:
+            return admission_id in self.pending
+
+    def flush(self):
+        """
+            Writes the buffered rows now, returns the number of rows written
+        """
+        with self.flush_lock:
+            with self.lock:
+                rows, self.buffer = self.buffer, []
+            if not rows:
+                return 0
+            try:
+                duplicates = save_predictions(rows)
+            except Exception:
+                # Keep the rows (still pending, ids still reserved) for the
+                # next flush
+                with self.lock:
+                    self.buffer[:0] = rows
+                    self.failed_flushes += 1
+                raise
+            with self.lock:
+                self.pending.difference_update(row['admission_id'] for row in rows)
+            for _id in duplicates:
+                print("ERROR: Observation Id: '{}' already exists".format(_id))
+            with self.lock:
+                self.flushes += 1
+                self.flushed_rows += len(rows) - len(duplicates)
+                self.late_duplicates += len(duplicates)
+            if duplicates:
+                metrics.inc('duplicate_ids_total', value=len(duplicates))
+            return len(rows)
+
+    def _run(self):
+        retry = 0.0
+        while True:
+            with self.lock:
+                if not self.closed and len(self.buffer) < self.max_rows:
+                    self.wakeup.wait(self.interval)
+                closed = self.closed
+            try:
+                self.flush()
+                retry = 0.0
+            except Exception as e:
+                metrics.inc('db_errors_total', (('source', 'writer'),))
+                retry = self._backoff(retry)
+                print("ERROR: could not write predictions, retrying in {:.2f}s: {}".format(retry, e))
+            finally:
+                if not DB.in_transaction():
+                    DB.close()
+            if closed:
+                return
+            if retry:
+                time.sleep(retry)
+
+    def _backoff(self, retry):
+        return min(max(2 * retry, self.interval), self.max_retry)
+
+    def close(self):
+        """
+            Drains the buffer on shutdown, retrying a failed flush until
+            close_timeout_seconds have passed
+
+            Returns:
+            - True if every buffered row was written
+        """
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        deadline = time.time() + self.close_timeout
+        retry = 0.0
+        while True:
+            try:
+                self.flush()
+                return True
+            except Exception as e:
+                metrics.inc('db_errors_total', (('source', 'writer'),))
+                error = e
+            finally:
+                if not DB.in_transaction():
+                    DB.close()
+            retry = self._backoff(retry)
+            if time.time() + retry > deadline:
+                break
+            print("ERROR: could not write predictions, retrying in {:.2f}s: {}".format(retry, error))
+            time.sleep(retry)
+        with self.lock:
+            lost = [row['admission_id'] for row in self.buffer]
+        print("ERROR: could not write {} predictions before exiting ({}), admission_ids: {}".format(
+            len(lost), error, ', '.join(str(_id) for _id in lost)))
+        return False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'buffered_rows': len(self.buffer),
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows,
+                'late_duplicates': self.late_duplicates,
+                'failed_flushes': self.failed_flushes,
+                'known_ids': len(self.known_ids),
+            }
+
+
+if os.environ.get('WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'):
+    writer = PredictionWriter(
+        max_rows=int(os.environ.get('WRITE_BEHIND_MAX_ROWS', 500)),
+        interval_ms=float(os.environ.get('WRITE_BEHIND_INTERVAL_MS', 50)),
+        max_retry_seconds=float(os.environ.get('WRITE_BEHIND_MAX_RETRY_SECONDS', 5)),
+        close_timeout_seconds=float(os.environ.get('WRITE_BEHIND_CLOSE_TIMEOUT_SECONDS', 10)))
+    atexit.register(writer.close)
+else:
+    writer = None
 
 # End database stuff
 ########################################
 
 ########################################
-# Unpickle the previously-trained model
+# Begin model quality stuff
+
+
+POSITIVE_LABEL = 'Yes'
+NEGATIVE_LABEL = 'No'
+
+# Positions in a counts list
+PREDICTIONS, PREDICTED_POSITIVE, TP, FP, FN, TN = range(6)
+
 
+def _confusion_cell(predicted, actual):
+    if actual == POSITIVE_LABEL:
+        return TP if predicted == POSITIVE_LABEL else FN
+    return FP if predicted == POSITIVE_LABEL else TN
 
-with open(os.path.join('data', 'columns.json')) as fh:
-    columns = json.load(fh)
 
+def quality_summary(counts):
+    """
+        Returns the counts list as a dict, with the metrics derived from
+        the confusion matrix (None while undefined)
+    """
+    predictions, predicted_positive, tp, fp, fn, tn = counts
+    labeled = tp + fp + fn + tn
+
+    def ratio(a, b):
+        return a / b if b else None
+
+    precision, recall = ratio(tp, tp + fp), ratio(tp, tp + fn)
+    return {
+        'predictions': predictions,
+        'predicted_positive': predicted_positive,
+        'labeled': labeled,
+        'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+        'accuracy': ratio(tp + tn, labeled),
+        'precision': precision,
+        'recall': recall,
+        'f1': ratio(2 * precision * recall, precision + recall) if precision and recall else None,
+    }
+
+
+class QualityStats:
+    """
+        Running confusion matrix of the stored predictions, overall, per
+        model version and per time window of the prediction (window_seconds,
+        the last max_windows are kept), updated as predictions are stored
+        and outcomes arrive so that /stats never touches the database.
+
+        rebuild() recomputes everything from the table with one GROUP BY. It
+        runs at startup and, every refresh_seconds, in a background thread:
+        the counters are per process, so behind several workers each one
+        only sees its own traffic between two refreshes.
+    """
+
+    def __init__(self, window_seconds=3600.0, max_windows=48, refresh_seconds=0.0,
+                 version_field='model_version', predicted_field='predicted_readmitted'):
+        self.window = window_seconds
+        self.max_windows = max_windows
+        self.refresh_seconds = refresh_seconds
+        # The Prediction columns counted: rows are grouped by version_field
+        # and the rows without a predicted_field are skipped, e.g. to count
+        # the shadow predictions by shadow model version
+        self.version_field = version_field
+        self.predicted_field = predicted_field
+        self.lock = threading.Lock()
+        self.refreshed_at = None
+        self.thread = BackgroundThread(self._run, 'quality-refresh')
+        self._reset()
+
+    def _reset(self):
+        self.overall = [0] * 6
+        self.versions = {}
+        self.windows = {}
+
+    def _cells(self, version, created_at):
+        version = version if version is not None else 'unversioned'
+        cells = [self.overall, self.versions.setdefault(version, [0] * 6)]
+        if created_at is not None:
+            window = int(created_at // self.window)
+            if window not in self.windows:
+                if len(self.windows) >= self.max_windows and window < min(self.windows):
+                    return cells
+                self.windows[window] = [0] * 6
+                while len(self.windows) > self.max_windows:
+                    del self.windows[min(self.windows)]
+            cells.append(self.windows[window])
+        return cells
+
+    def record_prediction(self, version, created_at, predicted):
+        with self.lock:
+            for cell in self._cells(version, created_at):
+                cell[PREDICTIONS] += 1
+                cell[PREDICTED_POSITIVE] += predicted == POSITIVE_LABEL
+
+    def record_outcome(self, version, created_at, predicted, previous, actual):
+        """
+            Counts the outcome of a prediction, replacing its previous outcome
+            if it had one
+        """
+        labels = (POSITIVE_LABEL, NEGATIVE_LABEL)
+        with self.lock:
+            for cell in self._cells(version, created_at):
+                if previous in labels:
+                    cell[_confusion_cell(predicted, previous)] -= 1
+                if actual in labels:
+                    cell[_confusion_cell(predicted, actual)] += 1
+
+    def rebuild(self):
+        if isinstance(DB, PostgresqlDatabase):
+            window = fn.FLOOR(Prediction.created_at / self.window)
+        else:
+            # created_at is positive, truncation is the floor
+            window = (Prediction.created_at / self.window).cast('INTEGER')
+        version = getattr(Prediction, self.version_field)
+        predicted = getattr(Prediction, self.predicted_field)
+        query = (Prediction
+                 .select(version, window, predicted, Prediction.actual_readmitted, fn.COUNT(Prediction.id))
+                 .where(predicted.is_null(False))
+                 .group_by(version, window, predicted, Prediction.actual_readmitted)
+                 .tuples())
+        with DB.connection_context():
+            groups = list(query)
+
+        rebuilt = QualityStats(self.window, self.max_windows)
+        labels = (POSITIVE_LABEL, NEGATIVE_LABEL)
+        for version, window_index, predicted, actual, count in groups:
+            created_at = None if window_index is None else int(window_index) * self.window
+            for cell in rebuilt._cells(version, created_at):
+                cell[PREDICTIONS] += count
+                cell[PREDICTED_POSITIVE] += count if predicted == POSITIVE_LABEL else 0
+                if actual in labels:
+                    cell[_confusion_cell(predicted, actual)] += count
+        with self.lock:
+            self.overall, self.versions, self.windows = rebuilt.overall, rebuilt.versions, rebuilt.windows
+            self.refreshed_at = time.time()
 
-with open(os.path.join('data', 'pipeline.pickle'), 'rb') as fh:
-    pipeline = joblib.load(fh)
+    def ensure_started(self):
+        if self.refresh_seconds:
+            self.thread.ensure_started()
 
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.rebuild()
+            except Exception as e:
+                metrics.inc('db_errors_total', (('source', 'quality'),))
+                print("ERROR: could not refresh the quality stats: {}".format(e))
+
+    def stats(self):
+        with self.lock:
+            overall = list(self.overall)
+            versions = {version: list(counts) for version, counts in self.versions.items()}
+            windows = sorted((window, list(counts)) for window, counts in self.windows.items())
+            refreshed_at = self.refreshed_at
+        return {
+            'overall': quality_summary(overall),
+            'versions': {version: quality_summary(counts) for version, counts in versions.items()},
+            'window_seconds': self.window,
+            'windows': [dict(quality_summary(counts), start=window * self.window, end=(window + 1) * self.window)
+                        for window, counts in windows],
+            'refreshed_at': refreshed_at,
+        }
 
-with open(os.path.join('data', 'dtypes.pickle'), 'rb') as fh:
-    dtypes = pickle.load(fh)
 
+quality = QualityStats(
+    window_seconds=float(os.environ.get('QUALITY_WINDOW_SECONDS', 3600)),
+    max_windows=int(os.environ.get('QUALITY_WINDOWS', 48)),
+    refresh_seconds=float(os.environ.get('QUALITY_REFRESH_SECONDS', 300)))
 
-# End model un-pickling
+# End model quality stuff
 ########################################
 
 ########################################
@@ -97,6 +996,224 @@ categorical_features = [
 
 
 
+valid_category_map = {
+   'race': ['White', 'Caucasian', 'European', 'AfricanAmerican', 'EURO',
+   'Afro American', '?', 'African American', 'WHITE', 'Asian',
+   'Black', 'Hispanic', 'Other', 'Latino', 'AFRICANAMERICAN'],
+   'gender': ['Male', 'Female', 'Unknown/Invalid'], 
+   'age': ['[80-90)', '[40-50)', '[30-40)', '[70-80)', '[90-100)', '[50-60)','[60-70)', '[20-30)', "NaN", '[10-20)', '[0-10)'], 
+   'weight': ['?', "NaN", '[50-75)', '[25-50)', '[75-100)', '[125-150)','[100-125)', '[0-25)', '[150-175)', '[175-200)'], 
+   'payer_code': ['?', 'UN', 'MC', 'SP', 'DM', 'HM', 'MD', 'BC', 'CM', 'CP', 'WC','OG', 'PO', 'MP', 'OT', 'CH', 'SI'], 
+   'medical_specialty': ['?', 'Family/GeneralPractice', 'InternalMedicine', 'Surgery-Neuro',
+                        'Orthopedics-Reconstructive', 'Pulmonology', 'Surgery-General',
+                        'Hematology/Oncology', 'Gastroenterology', 'Oncology',
+                        'Emergency/Trauma', 'Cardiology', 'Neurology', 'Orthopedics',
+                        'Nephrology', 'Surgery-Cardiovascular/Thoracic', 'Urology',
+                        'Surgery-Vascular', 'ObstetricsandGynecology', 'Radiologist',
+                        'Pediatrics', 'Surgery-Cardiovascular', 'DCPTEAM', 'Podiatry',
+                        'Psychiatry', 'Endocrinology', 'Psychology',
+                        'PhysicalMedicineandRehabilitation', 'Surgery-Thoracic',
+                        'Endocrinology-Metabolism', 'Pediatrics-Endocrinology',
+                        'Hematology', 'Osteopath', 'Pediatrics-Pulmonology',
+                        'Otolaryngology', 'Obstetrics', 'Resident',
+                        'Pediatrics-CriticalCare', 'Gynecology', 'SurgicalSpecialty',
+                        'Radiology', 'Surgery-Plastic', 'Hospitalist', 'Pathology',
+                        'Surgery-Colon&Rectal', 'InfectiousDiseases',
+                        'Pediatrics-Hematology-Oncology', 'Surgery-Maxillofacial',
+                        'Psychiatry-Child/Adolescent', 'Anesthesiology-Pediatric',
+                        'Anesthesiology', 'PhysicianNotFound', 'Cardiology-Pediatric',
+                        'Ophthalmology', 'Surgeon', 'Psychiatry-Addictive',
+                        'Pediatrics-Neurology', 'Obsterics&Gynecology-GynecologicOnco',
+                        'Rheumatology', 'AllergyandImmunology'], 
+   'has_prosthesis': [False,  True],
+   'complete_vaccination_status': ['Complete', 'Incomplete', 'None'], 
+   'diag_1': ['185', '786', '590', '250.82', '486', '724', '411', '571', '715',
+          '398', '733', '721', '410', '569', '996', '560', '518', '250.6',
+          '414', '250.11', '599', '789', '274', '491', '564', '?', '156',
+          '584', '38', '427', '574', '558', '575', '719', '162', '431',
+          '434', '553', '428', '812', '493', '250.02', '722', '413', '780',
+          '153', '997', '415', '435', '458', '295', '350', '530', '995',
+          '424', '824', '200', '250.8', '707', '437', '576', 'V58', '552',
+          '496', '562', '331', '188', '807', '820', '482', '404', '432',
+          '401', '577', '250.42', '403', '515', '433', '250.7', '276',
+          '250.1', '440', '642', '682', '611', 'V57', '250.03', '453', '296',
+          '578', '202', '323', '511', '532', '238', '850', '600', '157',
+          '136', '278', '805', '998', '659', '288', '555', '344', '716',
+          '311', '535', '198', '285', '714', '218', '250.13', 'V55', '507',
+          '250.81', '607', '211', '614', '54', '220', '280', '625', '244',
+          '348', '648', '447', '309', '438', '727', '395', '250', '11',
+          '846', '436', '728', '423', '483', '586', '487', '464', '250.2',
+          '618', '481', '182', '250.22', '189', '572', '945', '920', 'V54',
+          '802', '429', '681', '346', '250.83', '444', '813', '304', '522',
+          '983', '250.32', '866', '416', '291', '581', '303', '787', '402',
+          '808', '729', '261', '531', '823', '386', '656', '250.4', '860',
+          '174', '250.12', '980', '42', '250.41', '8', '626', '294', '592',
+          '933', '204', '536', '290', '420', '782', '466', '836', '596',
+          '88', '790', '388', '718', '191', '751', '305', '452', '250.93',
+          '490', '528', '426', '284', '79', '717', '534', '785', '332',
+          '822', '307', '557', '730', '963', '540', '286', '568', '723',
+          '131', '383', '227', '604', '277', '835', '825', '654', '470',
+          '512', '380', '801', '924', '573', '338', '197', '455', '283',
+          '255', '349', '969', '852', '794', '443', '293', '172', '608',
+          '617', '792', '851', '591', '977', '451', '327', '193', 'V66',
+          '815', '441', '239', 'V56', '292', '844', '173', '658', '781',
+          '196', '345', '298', '233', '494', '459', '492', '865', '333',
+          '322', '161', '225', '726', '519', '853', '710', '660', '179',
+          '78', '967', '340', '864', '962', '663', '585', '446', '873',
+          '550', '154', '300', '845', '593', '972', 'V63', '646', '965',
+          '275', '620', '151', '282', '644', '164', '442', '287', '241',
+          '514', '336', '816', '355', '566', '175', '537', '621', '709',
+          '784', '793', '230', '250.23', '158', '112', '465', '235', '357',
+          '516', '236', '425', 'V45', '250.33', '454', '783', '215', '203',
+          '958', '297', '312', '595', '999', '737', '421', '922', '485',
+          '556', '745', '799', '959', '351', '250.01', '892', '669', '567',
+          '821', '916', '250.92', '150', '711', '973', '250.31', '9', '475',
+          '480', '921', '840', '473', '694', '362', '661', '266', '541',
+          '97', '306', '53', '588', '521', '989', '252', '250.43', '966',
+          '250.52', '456', '66', '942', '183', '527', '184', '579', '495',
+          '616', '359', '171', '524', '500', '245', '210', 'V71', '70',
+          '725', '738', '430', '756', '991', '510', '320', '632', '253',
+          '583', '337', '363', '810', '935', '970', '226', '601', '237',
+          '347', 'V53', '377', '664', '513', '142', '533', '622', '217',
+          '878', '35', '690', '695', '952', '250.21', '281', '843', '800',
+          '693', '110', '652', '205', '368', '462', '448', '155', '250.5',
+          '788', '680', '508', '627', '647', '705', '735', '955', '223',
+          '353', '341', '375', '570', '826', '308', '208', '753', '396',
+          '759', '7'], 
+
+   'diag_2': ['788', '425', '250', 'V85', '276', '250.8', '998', '250.02', '584',
+          '496', '250.01', '716', '250.1', '493', '280', '112', '197', '707',
+          '401', '403', '428', '715', '?', '571', '995', '780', '414', '359',
+          '486', '599', '287', '447', '434', '345', '919', '424', '781',
+          '214', '305', '518', '300', '511', '585', '427', '295', '553',
+          '285', 'E849', '705', '429', '70', '728', '201', '568', "NaN", '600',
+          '733', '512', '411', '153', '530', '250.11', '41', 'E885', '242',
+          '244', '997', '574', '250.51', '342', '785', '682', '786', '648',
+          'V10', '799', '250.03', '337', '250.43', '413', '303', '250.82',
+          '710', '533', '250.6', '578', '727', '492', '807', '410', '560',
+          '284', '278', '198', '412', '564', 'V43', '294', '577', '293',
+          'E932', '340', '296', 'V45', '595', '491', '996', '162', '402',
+          '535', '151', '331', '179', '626', 'V42', '250.4', '218', '784',
+          '731', '572', '618', '920', '438', '466', '693', '573', '567',
+          '722', 'V58', 'E888', '250.41', '847', '614', '730', '437', '453',
+          '250.92', '591', '291', '250.12', '261', 'E917', '435', '416',
+          '802', '189', '253', '703', '255', '787', 'V72', 'E878', '738',
+          '536', '396', '836', '531', '892', '38', '202', '211', '357',
+          '864', 'V62', '292', '348', '575', '664', '174', '706', '440',
+          '610', '482', '540', '557', '250.81', '723', '616', '312', '782',
+          '368', '789', '304', '283', '507', '751', '465', '719', '590',
+          '157', '135', 'V63', '426', '263', '250.5', '281', '681', '42',
+          '805', '458', '433', '277', '333', '378', '250.42', '808', '386',
+          'E934', 'V64', '272', '332', '8', '344', '196', '111', '356',
+          '199', '250.7', '203', '873', '724', '53', '279', '569', '154',
+          '663', '420', '204', '34', '473', '415', '452', '820', '592',
+          '456', 'V46', '625', '262', '443', '729', '441', '783', '959',
+          '297', '816', '481', '556', '250.93', '714', '790', '290', '910',
+          '436', '282', '394', 'E942', '506', '562', '837', '759', 'E884',
+          '301', 'E947', '813', '404', 'E880', '232', 'E939', '796', '515',
+          '351', '349', '250.52', '576', '868', 'E930', '558', 'V12', '654',
+          'V15', '185', '311', '593', '869', '642', 'V49', '617', '288',
+          '250.31', '200', '721', '444', '252', '581', '451', 'V54', '223',
+          '704', '684', 'V17', '208', 'E928', '607', '432', '883', '94',
+          '172', '183', '822', '550', '711', '620', '397', '380', '842',
+          '117', '156', '824', 'V14', '421', '250.83', '494', '490', '611',
+          '350', 'E935', '644', '358', 'E919', '40', 'V23', '924', '286',
+          '336', '933', '346', '275', '314', '455', '150', '758', '319',
+          '794', '583', '9', '250.22', '365', '552', '487', '422', '274',
+          '994', '289', '860', '999', '923', '238', '298', '753', '27',
+          '537', '821', '659', '861', '852', '459', '726', '527', '152',
+          '205', '260', '79', '377', '322', '826', '362', 'E819', '155',
+          '922', '327', '268', '850', '661', '250.53', '309', '519', '480',
+          '812', '250.13', '696', '446', '594', '320', '532', '11', '872',
+          '521', '516', '462', 'V57', '138', '867', '680', '934', '258',
+          '233', '191', '596', '746', 'V66', '324', '369', '31', '621',
+          '647', '398', '701', '423', '565', '916', '310', '114', 'E870',
+          '431', '524', 'E931', 'E968', '500', '463', 'E933', '685', 'V11',
+          '460', '273', '485', '352', '307', '619', '909', '335', '717',
+          '355', '478', '522', '250.91', '376', '958', '905', 'V65', '823',
+          '141'], 
+   'diag_3': ['601', '250.01', '401', '784', '276', '427', '250.02', '491',
+          '599', '428', '585', '737', '244', '403', '496', '682', '272',
+          '584', '70', '786', '493', '305', '?', '574', '482', '780', '414',
+          '250', '433', 'E885', '425', '402', '424', '531', '716', '787',
+          'V15', '410', '280', '38', '443', '571', '794', '285', '997',
+          '693', '600', '596', '861', '41', '197', '250.6', 'E849', '518',
+          '411', '593', '588', '278', '511', '707', '577', '722', '446',
+          '438', '730', '250.53', '458', '250.4', '440', '250.8', '263',
+          '277', '729', '466', '535', '203', '473', '805', 'V85', 'V45',
+          '620', 'V14', 'E942', '294', '459', '413', '112', '789', 'V17',
+          '225', 'V42', '416', '530', '250.82', '560', '296', '486', '301',
+          '552', '956', '617', '54', 'V58', '357', '441', '910', '202',
+          'E930', '310', '537', '536', '726', '562', '426', '799', '515',
+          '710', '790', '924', 'E878', '578', '731', 'V12', 'V10', '996',
+          '255', '533', '616', '781', '792', '303', '311', '465', '174',
+          '198', '250.42', '800', '583', '995', '591', '611', '253', '300',
+          '658', '356', '462', '397', 'V46', '453', '250.5', '342', '274',
+          '204', '733', '250.52', '522', 'E933', '250.81', 'V03', '284',
+          '304', '719', '295', 'E884', '998', 'E947', '568', '785', '287',
+          '358', '922', '260', 'V16', '250.1', '293', '396', '492', '592',
+          '153', '309', '742', 'V64', '348', '686', 'E935', '681', '404',
+          '721', '437', '788', '412', '715', '250.92', '199', '728', '836',
+          '155', '312', '291', '724', 'V65', '331', '572', '338', '523',
+          '78', '808', 'V43', '337', '580', '5', '581', '378', 'V54', 'E888',
+          '796', '558', '250.7', '8', 'E950', 'E934', '384', '661', '435',
+          'E880', '494', '200', '196', '647', 'V72', '783', '162', '648',
+          '218', 'V27', '782', '217', '368', '569', '680', '307', '516',
+          'V49', '327', '250.03', '211', '451', '573', '7', 'E938', '447',
+          '157', '834', 'V62', '290', '34', '275', '389', 'V09', '318',
+          '429', '812', '250.93', '336', '696', '590', 'V06', '507', '281',
+          '517', '420', '349', '250.83', '553', '373', '692', '299', '351',
+          '610', '288', '555', '625', '286', '958', '741', '564', '346',
+          '317', '484', '999', '532', '332', '745', 'E892', '738', '664',
+          '820', '621', '250.41', '131', '595', 'E941', '423', '512', '170',
+          '626', '250.51', '434', '380', '135', '915', '646', '607', '519',
+          '235', '907', '712', '455', '824', '442', '334', '883', '273',
+          '282', '807', 'E932', '652', '362', '344', '604', '79', '189',
+          '575', '454', '659', '185', '279', '576', '456', '333', '521',
+          '655', '850', '180', '354', '340', '714', '208', '923', '709',
+          '150', '151', '663', '665', '242', '146', '478', '543', 'E858',
+          '851', '727', 'E879', 'E812', 'E819', '802', '405', '845', '618',
+          '913', '579', '17', '250.12', '11', '814', '840', 'E939', '138',
+          '94', '598', '42', '415', '948', 'V70', '457', '382', '245', '656',
+          '920', 'E905', 'V08', '685', '369', '916', '514', '252', 'V44',
+          'E929', 'V55', '823', '642', '53', '214', '746', 'V02', '171',
+          '490', 'V13', '461', '388', '718', '586', '567', '528', '161',
+          '250.13', '306', '713', '649', '747', '928', '250.43', '379',
+          '183', '386', '398', '711', '201', '251', '908', '394', '860',
+          '614', 'V66', '238', '319', '205', '487', '376', '444', 'E920',
+          '695', 'V63', '383', '825', '298', 'E931', '723', '361', '704',
+          '753', '935', '292', '355', '261', '694', '873', '945', '154',
+          '250.23', '841', '343', '345', 'E936', '793', '654', '867', '365',
+          '627', '736', '35', '801', '110', '717', '605', '959', '250.11',
+          '3', '534', '250.9', '445', '360', '250.2', '262', 'V23'],
+
+   'blood_type': ['A-', 'O+', 'A+', 'B+', 'O-', 'AB-', 'AB+', 'B-'], 
+   'blood_transfusion': [False,  True],
+   'max_glu_serum': ['NONE', '>200', 'None', '>300', 'NORM', 'Norm'], 
+   'A1Cresult': ['None', '>8', '>7', 'Norm'], 
+   'diuretics': ['No', 'Yes'], 
+   'insulin': ['No', 'Yes'], 
+   'change': ['No', 'Ch'], 
+   'diabetesMed': ['No', 'Yes']
+}
+
+
+valid_num_range = {
+    'admission_type_code': [1.0, 8.0],
+    'discharge_disposition_code': [1.0, 28.0],
+    'admission_source_code': [1, 22],
+    'time_in_hospital': [1, 14],
+    'num_lab_procedures': [1.0, 132.0],
+    'num_procedures': [0, 6],
+    'num_medications': [1.0, 70.0],
+    'number_outpatient': [0, 35],
+    'number_emergency': [0, 22],
+    'number_inpatient': [0, 18],
+    'number_diagnoses': [1, 16],
+    'hemoglobin_level': [10.9, 18.1]
+}
+
+
 def check_request(request):
     
     #check that no additional key is received
@@ -164,207 +1281,6 @@ def check_categorical_values(observation):
         - error message: empty if all provided columns are valid, False otherwise
     """
     
-    valid_category_map = {
-       'race': ['White', 'Caucasian', 'European', 'AfricanAmerican', 'EURO',
-       'Afro American', '?', 'African American', 'WHITE', 'Asian',
-       'Black', 'Hispanic', 'Other', 'Latino', 'AFRICANAMERICAN'],
-       'gender': ['Male', 'Female', 'Unknown/Invalid'], 
-       'age': ['[80-90)', '[40-50)', '[30-40)', '[70-80)', '[90-100)', '[50-60)','[60-70)', '[20-30)', "NaN", '[10-20)', '[0-10)'], 
-       'weight': ['?', "NaN", '[50-75)', '[25-50)', '[75-100)', '[125-150)','[100-125)', '[0-25)', '[150-175)', '[175-200)'], 
-       'payer_code': ['?', 'UN', 'MC', 'SP', 'DM', 'HM', 'MD', 'BC', 'CM', 'CP', 'WC','OG', 'PO', 'MP', 'OT', 'CH', 'SI'], 
-       'medical_specialty': ['?', 'Family/GeneralPractice', 'InternalMedicine', 'Surgery-Neuro',
-                            'Orthopedics-Reconstructive', 'Pulmonology', 'Surgery-General',
-                            'Hematology/Oncology', 'Gastroenterology', 'Oncology',
-                            'Emergency/Trauma', 'Cardiology', 'Neurology', 'Orthopedics',
-                            'Nephrology', 'Surgery-Cardiovascular/Thoracic', 'Urology',
-                            'Surgery-Vascular', 'ObstetricsandGynecology', 'Radiologist',
-                            'Pediatrics', 'Surgery-Cardiovascular', 'DCPTEAM', 'Podiatry',
-                            'Psychiatry', 'Endocrinology', 'Psychology',
-                            'PhysicalMedicineandRehabilitation', 'Surgery-Thoracic',
-                            'Endocrinology-Metabolism', 'Pediatrics-Endocrinology',
-                            'Hematology', 'Osteopath', 'Pediatrics-Pulmonology',
-                            'Otolaryngology', 'Obstetrics', 'Resident',
-                            'Pediatrics-CriticalCare', 'Gynecology', 'SurgicalSpecialty',
-                            'Radiology', 'Surgery-Plastic', 'Hospitalist', 'Pathology',
-                            'Surgery-Colon&Rectal', 'InfectiousDiseases',
-                            'Pediatrics-Hematology-Oncology', 'Surgery-Maxillofacial',
-                            'Psychiatry-Child/Adolescent', 'Anesthesiology-Pediatric',
-                            'Anesthesiology', 'PhysicianNotFound', 'Cardiology-Pediatric',
-                            'Ophthalmology', 'Surgeon', 'Psychiatry-Addictive',
-                            'Pediatrics-Neurology', 'Obsterics&Gynecology-GynecologicOnco',
-                            'Rheumatology', 'AllergyandImmunology'], 
-       'has_prosthesis': [False,  True],
-       'complete_vaccination_status': ['Complete', 'Incomplete', 'None'], 
-       'diag_1': ['185', '786', '590', '250.82', '486', '724', '411', '571', '715',
-              '398', '733', '721', '410', '569', '996', '560', '518', '250.6',
-              '414', '250.11', '599', '789', '274', '491', '564', '?', '156',
-              '584', '38', '427', '574', '558', '575', '719', '162', '431',
-              '434', '553', '428', '812', '493', '250.02', '722', '413', '780',
-              '153', '997', '415', '435', '458', '295', '350', '530', '995',
-              '424', '824', '200', '250.8', '707', '437', '576', 'V58', '552',
-              '496', '562', '331', '188', '807', '820', '482', '404', '432',
-              '401', '577', '250.42', '403', '515', '433', '250.7', '276',
-              '250.1', '440', '642', '682', '611', 'V57', '250.03', '453', '296',
-              '578', '202', '323', '511', '532', '238', '850', '600', '157',
-              '136', '278', '805', '998', '659', '288', '555', '344', '716',
-              '311', '535', '198', '285', '714', '218', '250.13', 'V55', '507',
-              '250.81', '607', '211', '614', '54', '220', '280', '625', '244',
-              '348', '648', '447', '309', '438', '727', '395', '250', '11',
-              '846', '436', '728', '423', '483', '586', '487', '464', '250.2',
-              '618', '481', '182', '250.22', '189', '572', '945', '920', 'V54',
-              '802', '429', '681', '346', '250.83', '444', '813', '304', '522',
-              '983', '250.32', '866', '416', '291', '581', '303', '787', '402',
-              '808', '729', '261', '531', '823', '386', '656', '250.4', '860',
-              '174', '250.12', '980', '42', '250.41', '8', '626', '294', '592',
-              '933', '204', '536', '290', '420', '782', '466', '836', '596',
-              '88', '790', '388', '718', '191', '751', '305', '452', '250.93',
-              '490', '528', '426', '284', '79', '717', '534', '785', '332',
-              '822', '307', '557', '730', '963', '540', '286', '568', '723',
-              '131', '383', '227', '604', '277', '835', '825', '654', '470',
-              '512', '380', '801', '924', '573', '338', '197', '455', '283',
-              '255', '349', '969', '852', '794', '443', '293', '172', '608',
-              '617', '792', '851', '591', '977', '451', '327', '193', 'V66',
-              '815', '441', '239', 'V56', '292', '844', '173', '658', '781',
-              '196', '345', '298', '233', '494', '459', '492', '865', '333',
-              '322', '161', '225', '726', '519', '853', '710', '660', '179',
-              '78', '967', '340', '864', '962', '663', '585', '446', '873',
-              '550', '154', '300', '845', '593', '972', 'V63', '646', '965',
-              '275', '620', '151', '282', '644', '164', '442', '287', '241',
-              '514', '336', '816', '355', '566', '175', '537', '621', '709',
-              '784', '793', '230', '250.23', '158', '112', '465', '235', '357',
-              '516', '236', '425', 'V45', '250.33', '454', '783', '215', '203',
-              '958', '297', '312', '595', '999', '737', '421', '922', '485',
-              '556', '745', '799', '959', '351', '250.01', '892', '669', '567',
-              '821', '916', '250.92', '150', '711', '973', '250.31', '9', '475',
-              '480', '921', '840', '473', '694', '362', '661', '266', '541',
-              '97', '306', '53', '588', '521', '989', '252', '250.43', '966',
-              '250.52', '456', '66', '942', '183', '527', '184', '579', '495',
-              '616', '359', '171', '524', '500', '245', '210', 'V71', '70',
-              '725', '738', '430', '756', '991', '510', '320', '632', '253',
-              '583', '337', '363', '810', '935', '970', '226', '601', '237',
-              '347', 'V53', '377', '664', '513', '142', '533', '622', '217',
-              '878', '35', '690', '695', '952', '250.21', '281', '843', '800',
-              '693', '110', '652', '205', '368', '462', '448', '155', '250.5',
-              '788', '680', '508', '627', '647', '705', '735', '955', '223',
-              '353', '341', '375', '570', '826', '308', '208', '753', '396',
-              '759', '7'], 
-
-       'diag_2': ['788', '425', '250', 'V85', '276', '250.8', '998', '250.02', '584',
-              '496', '250.01', '716', '250.1', '493', '280', '112', '197', '707',
-              '401', '403', '428', '715', '?', '571', '995', '780', '414', '359',
-              '486', '599', '287', '447', '434', '345', '919', '424', '781',
-              '214', '305', '518', '300', '511', '585', '427', '295', '553',
-              '285', 'E849', '705', '429', '70', '728', '201', '568', "NaN", '600',
-              '733', '512', '411', '153', '530', '250.11', '41', 'E885', '242',
-              '244', '997', '574', '250.51', '342', '785', '682', '786', '648',
-              'V10', '799', '250.03', '337', '250.43', '413', '303', '250.82',
-              '710', '533', '250.6', '578', '727', '492', '807', '410', '560',
-              '284', '278', '198', '412', '564', 'V43', '294', '577', '293',
-              'E932', '340', '296', 'V45', '595', '491', '996', '162', '402',
-              '535', '151', '331', '179', '626', 'V42', '250.4', '218', '784',
-              '731', '572', '618', '920', '438', '466', '693', '573', '567',
-              '722', 'V58', 'E888', '250.41', '847', '614', '730', '437', '453',
-              '250.92', '591', '291', '250.12', '261', 'E917', '435', '416',
-              '802', '189', '253', '703', '255', '787', 'V72', 'E878', '738',
-              '536', '396', '836', '531', '892', '38', '202', '211', '357',
-              '864', 'V62', '292', '348', '575', '664', '174', '706', '440',
-              '610', '482', '540', '557', '250.81', '723', '616', '312', '782',
-              '368', '789', '304', '283', '507', '751', '465', '719', '590',
-              '157', '135', 'V63', '426', '263', '250.5', '281', '681', '42',
-              '805', '458', '433', '277', '333', '378', '250.42', '808', '386',
-              'E934', 'V64', '272', '332', '8', '344', '196', '111', '356',
-              '199', '250.7', '203', '873', '724', '53', '279', '569', '154',
-              '663', '420', '204', '34', '473', '415', '452', '820', '592',
-              '456', 'V46', '625', '262', '443', '729', '441', '783', '959',
-              '297', '816', '481', '556', '250.93', '714', '790', '290', '910',
-              '436', '282', '394', 'E942', '506', '562', '837', '759', 'E884',
-              '301', 'E947', '813', '404', 'E880', '232', 'E939', '796', '515',
-              '351', '349', '250.52', '576', '868', 'E930', '558', 'V12', '654',
-              'V15', '185', '311', '593', '869', '642', 'V49', '617', '288',
-              '250.31', '200', '721', '444', '252', '581', '451', 'V54', '223',
-              '704', '684', 'V17', '208', 'E928', '607', '432', '883', '94',
-              '172', '183', '822', '550', '711', '620', '397', '380', '842',
-              '117', '156', '824', 'V14', '421', '250.83', '494', '490', '611',
-              '350', 'E935', '644', '358', 'E919', '40', 'V23', '924', '286',
-              '336', '933', '346', '275', '314', '455', '150', '758', '319',
-              '794', '583', '9', '250.22', '365', '552', '487', '422', '274',
-              '994', '289', '860', '999', '923', '238', '298', '753', '27',
-              '537', '821', '659', '861', '852', '459', '726', '527', '152',
-              '205', '260', '79', '377', '322', '826', '362', 'E819', '155',
-              '922', '327', '268', '850', '661', '250.53', '309', '519', '480',
-              '812', '250.13', '696', '446', '594', '320', '532', '11', '872',
-              '521', '516', '462', 'V57', '138', '867', '680', '934', '258',
-              '233', '191', '596', '746', 'V66', '324', '369', '31', '621',
-              '647', '398', '701', '423', '565', '916', '310', '114', 'E870',
-              '431', '524', 'E931', 'E968', '500', '463', 'E933', '685', 'V11',
-              '460', '273', '485', '352', '307', '619', '909', '335', '717',
-              '355', '478', '522', '250.91', '376', '958', '905', 'V65', '823',
-              '141'], 
-       'diag_3': ['601', '250.01', '401', '784', '276', '427', '250.02', '491',
-              '599', '428', '585', '737', '244', '403', '496', '682', '272',
-              '584', '70', '786', '493', '305', '?', '574', '482', '780', '414',
-              '250', '433', 'E885', '425', '402', '424', '531', '716', '787',
-              'V15', '410', '280', '38', '443', '571', '794', '285', '997',
-              '693', '600', '596', '861', '41', '197', '250.6', 'E849', '518',
-              '411', '593', '588', '278', '511', '707', '577', '722', '446',
-              '438', '730', '250.53', '458', '250.4', '440', '250.8', '263',
-              '277', '729', '466', '535', '203', '473', '805', 'V85', 'V45',
-              '620', 'V14', 'E942', '294', '459', '413', '112', '789', 'V17',
-              '225', 'V42', '416', '530', '250.82', '560', '296', '486', '301',
-              '552', '956', '617', '54', 'V58', '357', '441', '910', '202',
-              'E930', '310', '537', '536', '726', '562', '426', '799', '515',
-              '710', '790', '924', 'E878', '578', '731', 'V12', 'V10', '996',
-              '255', '533', '616', '781', '792', '303', '311', '465', '174',
-              '198', '250.42', '800', '583', '995', '591', '611', '253', '300',
-              '658', '356', '462', '397', 'V46', '453', '250.5', '342', '274',
-              '204', '733', '250.52', '522', 'E933', '250.81', 'V03', '284',
-              '304', '719', '295', 'E884', '998', 'E947', '568', '785', '287',
-              '358', '922', '260', 'V16', '250.1', '293', '396', '492', '592',
-              '153', '309', '742', 'V64', '348', '686', 'E935', '681', '404',
-              '721', '437', '788', '412', '715', '250.92', '199', '728', '836',
-              '155', '312', '291', '724', 'V65', '331', '572', '338', '523',
-              '78', '808', 'V43', '337', '580', '5', '581', '378', 'V54', 'E888',
-              '796', '558', '250.7', '8', 'E950', 'E934', '384', '661', '435',
-              'E880', '494', '200', '196', '647', 'V72', '783', '162', '648',
-              '218', 'V27', '782', '217', '368', '569', '680', '307', '516',
-              'V49', '327', '250.03', '211', '451', '573', '7', 'E938', '447',
-              '157', '834', 'V62', '290', '34', '275', '389', 'V09', '318',
-              '429', '812', '250.93', '336', '696', '590', 'V06', '507', '281',
-              '517', '420', '349', '250.83', '553', '373', '692', '299', '351',
-              '610', '288', '555', '625', '286', '958', '741', '564', '346',
-              '317', '484', '999', '532', '332', '745', 'E892', '738', '664',
-              '820', '621', '250.41', '131', '595', 'E941', '423', '512', '170',
-              '626', '250.51', '434', '380', '135', '915', '646', '607', '519',
-              '235', '907', '712', '455', '824', '442', '334', '883', '273',
-              '282', '807', 'E932', '652', '362', '344', '604', '79', '189',
-              '575', '454', '659', '185', '279', '576', '456', '333', '521',
-              '655', '850', '180', '354', '340', '714', '208', '923', '709',
-              '150', '151', '663', '665', '242', '146', '478', '543', 'E858',
-              '851', '727', 'E879', 'E812', 'E819', '802', '405', '845', '618',
-              '913', '579', '17', '250.12', '11', '814', '840', 'E939', '138',
-              '94', '598', '42', '415', '948', 'V70', '457', '382', '245', '656',
-              '920', 'E905', 'V08', '685', '369', '916', '514', '252', 'V44',
-              'E929', 'V55', '823', '642', '53', '214', '746', 'V02', '171',
-              '490', 'V13', '461', '388', '718', '586', '567', '528', '161',
-              '250.13', '306', '713', '649', '747', '928', '250.43', '379',
-              '183', '386', '398', '711', '201', '251', '908', '394', '860',
-              '614', 'V66', '238', '319', '205', '487', '376', '444', 'E920',
-              '695', 'V63', '383', '825', '298', 'E931', '723', '361', '704',
-              '753', '935', '292', '355', '261', '694', '873', '945', '154',
-              '250.23', '841', '343', '345', 'E936', '793', '654', '867', '365',
-              '627', '736', '35', '801', '110', '717', '605', '959', '250.11',
-              '3', '534', '250.9', '445', '360', '250.2', '262', 'V23'],
-              
-       'blood_type': ['A-', 'O+', 'A+', 'B+', 'O-', 'AB-', 'AB+', 'B-'], 
-       'blood_transfusion': [False,  True],
-       'max_glu_serum': ['NONE', '>200', 'None', '>300', 'NORM', 'Norm'], 
-       'A1Cresult': ['None', '>8', '>7', 'Norm'], 
-       'diuretics': ['No', 'Yes'], 
-       'insulin': ['No', 'Yes'], 
-       'change': ['No', 'Ch'], 
-       'diabetesMed': ['No', 'Yes']
-    }
-    
     for key, valid_categories in valid_category_map.items():
         if key in observation:
             value = observation[key]
@@ -381,21 +1297,6 @@ def check_categorical_values(observation):
 
 def check_numerical_values(observation):
 
-    valid_num_range = {
-        'admission_type_code': [1.0, 8.0],
-        'discharge_disposition_code': [1.0, 28.0],
-        'admission_source_code': [1, 22],
-        'time_in_hospital': [1, 14],
-        'num_lab_procedures': [1.0, 132.0],
-        'num_procedures': [0, 6],
-        'num_medications': [1.0, 70.0],
-        'number_outpatient': [0, 35],
-        'number_emergency': [0, 22],
-        'number_inpatient': [0, 18],
-        'number_diagnoses': [1, 16],
-        'hemoglobin_level': [10.9, 18.1]
-        }
-
     for key, valid_range in valid_num_range.items():
 
         if key not in observation: 
@@ -416,81 +1317,2345 @@ def check_numerical_values(observation):
 
     return True, ""
 
-# End input validation functions
-########################################
 
-########################################
-# Begin webserver stuff
+class ObservationSchema:
+    """
+        Validation rules of a /predict payload, compiled once at startup from
+        the model columns and dtypes plus the category and range tables above.
 
-app = Flask(__name__)
+        The checks are the same as check_request, check_categorical_values and
+        check_numerical_values, but the allowed categories are frozensets, the
+        ranges are precomputed and a single pass over the columns reports every
+        error of the observation instead of stopping at the first one.
+    """
 
+    def __init__(self, columns, dtypes, category_map, num_range):
+        self.columns = tuple(columns)
+        self.column_set = frozenset(columns)
 
-@app.route('/predict', methods=['POST'])
-def predict():
-    obs_dict = request.get_json()
-  
-    request_ok, error = check_request(obs_dict)
-    
-    if not request_ok:
-        response = {'error': error}
-        return jsonify(response)
+        self.categories = {}
+        self.allowed_values = {}
+        # The invalid value messages list every allowed value (hundreds of
+        # codes for diag_*): only the offending value is formatted per error
+        self.invalid_value_messages = {}
+        for key, valid_categories in category_map.items():
+            self.categories[key] = frozenset(valid_categories)
+            self.allowed_values[key] = ",".join(["'{}'".format(v) for v in valid_categories])
+            self.invalid_value_messages[key] = (
+                "Invalid value provided for {}: ".format(key),
+                ". Allowed values are: {}".format(self.allowed_values[key]))
 
-    _id = obs_dict['admission_id']
+        # Numerical columns without a range (e.g. admission_id) still need to
+        # be numbers, otherwise they break the dtypes cast of the model input
+        self.ranges = {}
+        for key in self.columns:
+            if key in num_range:
+                self.ranges[key] = tuple(num_range[key])
+            elif key not in self.categories and dtypes[key].kind in 'iuf':
+                self.ranges[key] = (float('-inf'), float('inf'))
 
-    
-    categories_ok, error = check_categorical_values(obs_dict)
-    if not categories_ok:
-        response = {'error': error}
-        return jsonify(response)
+    def validate(self, observation):
+        """
+            Validates one observation
 
-    numerics_ok, error = check_numerical_values(obs_dict)
-    if not numerics_ok:
-        response = {'error': error}
-        return jsonify(response)
+            Returns:
+            - list of (field, error message), empty if the observation is valid
+        """
+        if not isinstance(observation, dict):
+            return [(None, "Observation must be a JSON object")]
 
+        errors = []
+        present = 0
+        for key in self.columns:
+            if key not in observation:
+                errors.append((key, f"Field {key} missing"))
+                continue
+            present += 1
+            value = observation[key]
 
-    obs = pd.DataFrame([obs_dict], columns=columns).astype(dtypes)
-    
-    prediction = pipeline.predict(obs)[0]
-    
-    response = {'readmitted': prediction}
-    
-    p = Prediction(
-        admission_id=_id,
-        observation=obs_dict,
-        predicted_readmitted = prediction
-    )
+            allowed = self.categories.get(key)
+            if allowed is not None:
+                try:
+                    valid = value in allowed
+                except TypeError:
+                    valid = False
+                if not valid:
+                    prefix, suffix = self.invalid_value_messages[key]
+                    errors.append((key, prefix + str(value) + suffix))
+                continue
 
-    try:
-        p.save()
-    except IntegrityError:
-        error_msg = "ERROR: Observation Id: '{}' already exists".format(_id)
-        response["error"] = error_msg
-        print(error_msg)
-        DB.rollback()
-    return jsonify(response)
+            valid_range = self.ranges.get(key)
+            if valid_range is not None:
+                if not isinstance(value, (int, float)):
+                    errors.append((key, f"Field {key} is not an integer or float"))
+                elif value < valid_range[0] or value > valid_range[1]:
+                    errors.append((key, f"Field {key} is not within defined range"))
 
-    
-@app.route('/update', methods=['POST'])
-def update():
-    obs = request.get_json()
-    try:
-        p = Prediction.get(Prediction.admission_id == obs['admission_id'])
-        p.actual_readmitted = obs['readmitted']
-        p.save()
-        
-        response = {
-                    "admission_id": obs['admission_id'],
-                    "actual_readmitted": obs['readmitted'],
-                    "predicted_readmitted": p.predicted_readmitted
-                    }
+        if present != len(observation):
+            for key in observation:
+                if key not in self.column_set:
+                    errors.append((key, f"Unrecognized field {key}"))
 
-        return jsonify(response)
-    except Prediction.DoesNotExist:
-        error_msg = 'Admission Id: "{}" does not exist'.format(obs['admission_id'])
-        return jsonify({'error': error_msg})
+        return errors
+
+    def validate_batch(self, observations):
+        """
+            Validates a batch of observations
+
+            Returns:
+            - list with the errors of each observation (see validate)
+        """
+        validate = self.validate
+        return [validate(observation) for observation in observations]
+
+
+def format_errors(errors):
+    return "; ".join(message for _, message in errors)
+
+
+def count_validation_failures(errors, schema):
+    # Field names that are not model columns come from the clients, they
+    # are counted together to keep the number of label values bounded
+    for field, _ in errors:
+        metrics.inc('validation_failures_total', (('field', field if field in schema.column_set else '_other'),))
+
+
+def check_observation(observation, bundle=None):
+    """
+        Runs all the validations of a /predict payload against the schema of
+        the given model bundle (the default model if None)
+
+        Returns:
+        - assertion value: True if the observation is valid, False otherwise
+        - error message: empty if the observation is valid, every error otherwise
+    """
+    schema = (bundle or registry.default).schema
+    errors = schema.validate(observation)
+    if errors:
+        count_validation_failures(errors, schema)
+        return False, format_errors(errors)
+
+    return True, ""
+
+def synthetic_observations(n, seed=0, feature_columns=None):
+    """
+        Builds n valid observations from the category and range tables,
+        used to check and warm up a freshly loaded model
+    """
+    rng = random.Random(seed)
+    observations = []
+    for i in range(n):
+        observation = {}
+        for key in feature_columns or columns:
+            if key in valid_category_map:
+                observation[key] = rng.choice(valid_category_map[key])
+            elif key in valid_num_range:
+                low, high = valid_num_range[key]
+                if isinstance(low, float):
+                    observation[key] = round(rng.uniform(low, high), 1)
+                else:
+                    observation[key] = rng.randint(low, high)
+            else:
+                observation[key] = i
+        observations.append(observation)
+    return observations
+
+# End input validation functions
+########################################
+
+########################################
+# Begin micro-batching stuff
+
+
+def predict_observations(observations, bundle=None):
+    """
+        Scores a list of validated observations with a single model call
+        of the given bundle (the default model if None)
+
+        Returns:
+        - array with the prediction of each observation
+    """
+    return (bundle or registry.default).predict(observations)
+
+
+class PredictionBatcher:
+    """
+        Coalesces concurrent /predict calls into one model call.
+
+        Request threads put their observation on a queue and wait on a
+        Future. A worker thread takes up to max_size observations, waiting at
+        most max_wait_ms after the first one, scores them together (one call
+        per model version in the batch) and hands each caller its own
+        prediction.
+    """
+
+    def __init__(self, predict_fn, max_size=64, max_wait_ms=2.0):
+        self.predict_fn = predict_fn
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+        self.max_batch_size = 0
+        self.batch_sizes = {}
+        self.thread = BackgroundThread(self._run, 'prediction-batcher')
+
+    def submit(self, observation, bundle):
+        self.thread.ensure_started()
+        future = Future()
+        self.queue.put((observation, bundle, future))
+        return future
+
+    def predict(self, observation, bundle):
+        return self.submit(observation, bundle).result()
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            by_bundle = {}
+            for item in batch:
+                by_bundle.setdefault(item[1], []).append(item)
+
+            for bundle, items in by_bundle.items():
+                try:
+                    predictions = self.predict_fn([observation for observation, _, _ in items], bundle)
+                except Exception as e:
+                    for _, _, future in items:
+                        future.set_exception(e)
+                else:
+                    for (_, _, future), prediction in zip(items, predictions):
+                        future.set_result(prediction)
+
+            size = len(batch)
+            with self.lock:
+                self.batches += 1
+                self.rows += size
+                self.max_batch_size = max(self.max_batch_size, size)
+                bucket = 1 << (size - 1).bit_length()
+                self.batch_sizes[bucket] = self.batch_sizes.get(bucket, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'max_size': self.max_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'batches': self.batches,
+                'rows': self.rows,
+                'mean_batch_size': self.rows / self.batches if self.batches else 0.0,
+                'max_batch_size': self.max_batch_size,
+                # Number of batches by size, bucketed to the next power of two
+                'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            }
+
+
+if os.environ.get('PREDICT_BATCHING', '').lower() in ('1', 'true', 'yes'):
+    batcher = PredictionBatcher(
+        predict_observations,
+        max_size=int(os.environ.get('PREDICT_BATCH_MAX_SIZE', 64)),
+        max_wait_ms=float(os.environ.get('PREDICT_BATCH_MAX_WAIT_MS', 2)))
+else:
+    batcher = None
+
+# End micro-batching stuff
+########################################
+
+########################################
+# Begin prediction cache stuff
+
+
+def _canonical_caster(dtype):
+    # Mirrors the .astype(dtypes) of the model input so that e.g. 7 and 7.0
+    # sent for a float column give the same key
+    if dtype.kind == 'f':
+        return float
+    if dtype.kind in 'iu':
+        return int
+    if dtype.kind == 'b':
+        return bool
+    return None
+
+
+def observation_key(observation, bundle):
+    """
+        Stable hash of a validated observation for a model version, taken
+        over its values in columns order after casting them to the model dtypes
+    """
+    values = [bundle.version]
+    for key, cast in bundle.casters:
+        value = observation[key]
+        if cast is not None and value == value:
+            try:
+                value = cast(value)
+            except (TypeError, ValueError):
+                pass
+        values.append(value)
+    data = json.dumps(values, separators=(',', ':'), default=str)
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).digest()
+
+
+class PredictionCache:
+    """
+        Bounded LRU cache of predictions with an optional time to live,
+        keyed by observation_key. It is cleared whenever a model bundle is
+        (re)loaded.
+    """
+
+    def __init__(self, max_size=10000, ttl_seconds=3600.0):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if self.ttl and expires < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+def cached_predict(observations, bundle):
+    """
+        Scores validated observations with the bundle, only running the
+        model on the ones that are not in the prediction cache
+
+        Returns:
+        - list with the prediction of each observation
+    """
+    if prediction_cache is None:
+        if batcher is not None and len(observations) == 1:
+            return [batcher.predict(observations[0], bundle)]
+        return list(predict_observations(observations, bundle))
+
+    keys = [observation_key(observation, bundle) for observation in observations]
+    predictions = [prediction_cache.get(key) for key in keys]
+    missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+
+    if missing:
+        if batcher is not None and len(missing) == 1:
+            scored = [batcher.predict(observations[missing[0]], bundle)]
+        else:
+            scored = predict_observations([observations[i] for i in missing], bundle)
+        for i, prediction in zip(missing, scored):
+            predictions[i] = prediction
+            prediction_cache.put(keys[i], prediction)
+
+    return predictions
+
+
+cache_size = int(os.environ.get('PREDICTION_CACHE_SIZE', 10000))
+if cache_size > 0:
+    prediction_cache = PredictionCache(
+        max_size=cache_size,
+        ttl_seconds=float(os.environ.get('PREDICTION_CACHE_TTL', 3600)))
+else:
+    prediction_cache = None
+
+# End prediction cache stuff
+########################################
+
+########################################
+# Begin compiled inference stuff
+
+
+class UnsupportedPipeline(ValueError):
+    """
+        The pipeline has a step or an option that CompiledPipeline does not
+        compile, its bundle uses the pandas path
+    """
+
+
+class _NaN:
+    def __repr__(self):
+        return 'nan'
+
+
+# Key of the NaN category, since nan != nan cannot be used as a dict key
+_NAN = _NaN()
+
+
+class CompiledPipeline:
+    """
+        Inference path that skips pandas and the sklearn transformers.
+
+        At load time the fitted ColumnTransformer of the pipeline is turned
+        into per-column encoders (imputation, scaling, one-hot positions) that
+        write a validated observation directly into a preallocated NumPy row,
+        or a batch straight into a (sparse, like the ColumnTransformer output)
+        matrix, which is then passed to the final estimator. The arithmetic is the
+        same as the sklearn transformers, so predictions are identical to
+        pipeline.predict on the .astype(dtypes) DataFrame.
+
+        Only SimpleImputer, StandardScaler, OneHotEncoder and passthrough/drop
+        are supported; anything else raises UnsupportedPipeline.
+    """
+
+    def __init__(self, pipeline, columns, dtypes):
+        steps = [step for _, step in pipeline.steps if step not in (None, 'passthrough')]
+        if len(steps) != 2 or type(steps[0]).__name__ != 'ColumnTransformer':
+            raise UnsupportedPipeline("expected a ColumnTransformer followed by an estimator")
+        preprocessor, self.estimator = steps
+
+        self.encoders = []
+        self.width = 0
+        for name, transformer, selection in preprocessor.transformers_:
+            if transformer == 'drop':
+                continue
+            keys = self._select(selection, columns)
+            if transformer == 'passthrough':
+                transformer_steps = []
+            elif type(transformer).__name__ == 'Pipeline':
+                transformer_steps = [step for _, step in transformer.steps if step not in (None, 'passthrough')]
+            else:
+                transformer_steps = [transformer]
+            self._compile_block(name, keys, transformer_steps, dtypes)
+
+        # Like the ColumnTransformer, hand wide one-hot batches to the
+        # estimator as a sparse matrix
+        self.sparse = bool(getattr(preprocessor, 'sparse_output_', False))
+        self.local = threading.local()
+
+    @staticmethod
+    def _select(selection, columns):
+        if isinstance(selection, str):
+            return [selection]
+        selection = list(selection)
+        if selection and isinstance(selection[0], (bool, np.bool_)):
+            return [key for key, keep in zip(columns, selection) if keep]
+        return [columns[c] if isinstance(c, (int, np.integer)) else c for c in selection]
+
+    def _compile_block(self, name, keys, steps, dtypes):
+        # Numerical steps are compiled to (fill value, mean, scale) per column,
+        # an optional one-hot encoder must be the last step of the block
+        fills = [None] * len(keys)
+        means = [None] * len(keys)
+        scales = [None] * len(keys)
+        onehot = None
+
+        for position, step in enumerate(steps):
+            kind = type(step).__name__
+            if kind == 'SimpleImputer':
+                if step.add_indicator or not (step.missing_values != step.missing_values):
+                    raise UnsupportedPipeline("unsupported SimpleImputer in {}".format(name))
+                statistics = list(step.statistics_)
+                if any(isinstance(v, float) and v != v for v in statistics):
+                    raise UnsupportedPipeline("SimpleImputer drops empty columns in {}".format(name))
+                if any(m is not None for m in means):
+                    raise UnsupportedPipeline("imputation after scaling in {}".format(name))
+                fills = [v.item() if isinstance(v, np.generic) else v for v in statistics]
+            elif kind == 'StandardScaler':
+                means = list(step.mean_) if step.with_mean else [None] * len(keys)
+                scales = list(step.scale_) if step.with_std else [None] * len(keys)
+            elif kind == 'OneHotEncoder' and position == len(steps) - 1:
+                if getattr(step, 'drop_idx_', None) is not None or getattr(step, '_infrequent_enabled', False):
+                    raise UnsupportedPipeline("unsupported OneHotEncoder options in {}".format(name))
+                onehot = step
+            else:
+                raise UnsupportedPipeline("unsupported step {} in {}".format(kind, name))
+
+        for i, key in enumerate(keys):
+            cast = _canonical_caster(dtypes[key])
+            if onehot is None:
+                self.encoders.append((key, cast, fills[i], means[i], scales[i], self.width, None))
+                self.width += 1
+            else:
+                categories = onehot.categories_[i]
+                positions = {}
+                for offset, category in enumerate(categories):
+                    category = category.item() if isinstance(category, np.generic) else category
+                    if isinstance(category, float) and category != category:
+                        category = _NAN
+                    positions[category] = self.width + offset
+                unknown_ok = onehot.handle_unknown != 'error'
+                self.encoders.append((key, cast, fills[i], None, None, None, (positions, unknown_ok)))
+                self.width += len(categories)
+
+    def _encode(self, observation, indices, data):
+        """
+            Appends the non-zero features of the observation, in increasing
+            position order, to indices and data
+        """
+        for key, cast, fill, mean, scale, position, onehot in self.encoders:
+            value = observation[key]
+            if value is None:
+                value = float('nan')
+            if cast is not None and value == value:
+                value = cast(value)
+            if value != value and fill is not None:
+                value = fill
+
+            if onehot is None:
+                value = float(value)
+                if mean is not None:
+                    value -= mean
+                if scale is not None:
+                    value /= scale
+                indices.append(position)
+                data.append(value)
+            else:
+                positions, unknown_ok = onehot
+                if value != value:
+                    value = _NAN
+                position = positions.get(value)
+                if position is not None:
+                    indices.append(position)
+                    data.append(1.0)
+                elif not unknown_ok:
+                    raise ValueError("Found unknown category {!r} in column {}".format(value, key))
+
+    def transform(self, observations):
+        if len(observations) == 1:
+            # Single rows reuse a per-thread preallocated buffer
+            row = getattr(self.local, 'row', None)
+            if row is None:
+                row = self.local.row = np.zeros((1, self.width))
+            else:
+                row.fill(0.0)
+            indices, data = [], []
+            self._encode(observations[0], indices, data)
+            row[0, indices] = data
+            return row
+
+        indptr = [0]
+        indices, data = [], []
+        for observation in observations:
+            self._encode(observation, indices, data)
+            indptr.append(len(indices))
+
+        if self.sparse:
+            return sparse.csr_matrix(
+                (np.array(data), np.array(indices), np.array(indptr)),
+                shape=(len(observations), self.width))
+        X = np.zeros((len(observations), self.width))
+        rows = np.repeat(np.arange(len(observations)), np.diff(indptr))
+        X[rows, indices] = data
+        return X
+
+    def predict(self, observations):
+        return self.estimator.predict(self.transform(observations))
+
+
+def compile_pipeline(bundle):
+    """
+        Compiles the pipeline of a model bundle
+
+        Returns:
+        - the CompiledPipeline, or None (pandas path) if compilation is
+          disabled, the pipeline is not supported or it does not give
+          identical predictions
+    """
+    if os.environ.get('COMPILED_INFERENCE', '1').lower() in ('0', 'false', 'no'):
+        return None
+    try:
+        compiled = CompiledPipeline(bundle.pipeline, bundle.columns, bundle.dtypes)
+    except UnsupportedPipeline as e:
+        print("Compiled inference disabled for {}: {}".format(bundle.path, e))
+        return None
+
+    # Any other error is a bug of CompiledPipeline, it is raised
+    observations = synthetic_observations(256, feature_columns=bundle.columns)
+    # Missing values in the float columns too, they go through the imputers
+    float_keys = [key for key in bundle.columns if key in valid_num_range and bundle.dtypes[key].kind == 'f']
+    for i, observation in enumerate(observations[::4] if float_keys else []):
+        observation[float_keys[i % len(float_keys)]] = float('nan')
+    expected = list(bundle.pipeline.predict(
+        pd.DataFrame(observations, columns=bundle.columns).astype(bundle.dtypes)))
+    if list(compiled.predict(observations)) != expected:
+        error = "predictions differ from the pandas path"
+    elif [compiled.predict([o])[0] for o in observations[:32]] != expected[:32]:
+        error = "single-row predictions differ from the pandas path"
+    else:
+        return compiled
+    print("Compiled inference disabled for {}: {}".format(bundle.path, error))
+    return None
+
+# End compiled inference stuff
+########################################
+
+########################################
+# Begin drift stuff
+
+
+REFERENCE_PROFILE = 'profile.json'
+OTHER_CATEGORY = '__other__'
+
+
+def profiled_features(columns, dtypes):
+    """
+        Returns the numerical and the categorical features worth profiling:
+        every model column but the identifiers
+    """
+    numeric, categorical = [], []
+    for key in columns:
+        if key.endswith('_id'):
+            continue
+        if dtypes[key].kind in 'iuf':
+            numeric.append(key)
+        else:
+            categorical.append(key)
+    return numeric, categorical
+
+
+class ReferenceProfileBuilder:
+    """
+        Profile of training data read chunk by chunk (see
+        build_reference_profile), without holding all of it in memory:
+        - numerical features: a sketch of each distribution, the distinct
+          values and their counts. Past max_points values it is compacted
+          into max_points weighted centroids of the neighbouring values, the
+          quantiles (and so the bin edges) then become approximate
+        - categorical features: the count of each value
+    """
+
+    def __init__(self, columns, dtypes, bins=10, min_share=0.005, max_points=4096):
+        self.numeric, self.categorical = profiled_features(columns, dtypes)
+        self.bins = bins
+        self.min_share = min_share
+        self.max_points = max_points
+        self.rows = 0
+        self.sketches = {key: (np.array([]), np.array([])) for key in self.numeric}
+        self.missing = {key: 0 for key in self.numeric}
+        self.counts = {key: collections.Counter() for key in self.categorical}
+
+    def update(self, frame):
+        """
+            Adds a chunk, a DataFrame with the model columns (a missing
+            column counts as missing values)
+        """
+        for key in self.numeric:
+            if key in frame.columns:
+                values = pd.to_numeric(frame[key], errors='coerce').to_numpy(dtype=float)
+            else:
+                values = np.full(len(frame), np.nan)
+            present = values[~np.isnan(values)]
+            self.missing[key] += len(values) - len(present)
+            points, weights = self.sketches[key]
+            points, inverse = np.unique(np.concatenate([points, present]), return_inverse=True)
+            weights = np.bincount(inverse, weights=np.concatenate([weights, np.ones(len(present))]),
+                                  minlength=len(points))
+            self.sketches[key] = self._compact(points, weights)
+        for key in self.categorical:
+            if key in frame.columns:
+                self.counts[key].update(frame[key].map(str).value_counts().to_dict())
+            else:
+                self.counts[key][str(np.nan)] += len(frame)
+        self.rows += len(frame)
+
+    def _compact(self, points, weights):
+        if len(points) <= self.max_points:
+            return points, weights
+        # Groups of about the same weight, a value heavier than a group
+        # stays on its own
+        starts = np.cumsum(weights) - weights
+        groups = np.minimum((starts / weights.sum() * self.max_points).astype(int), self.max_points - 1)
+        group_weights = np.bincount(groups, weights=weights, minlength=self.max_points)
+        sums = np.bincount(groups, weights=points * weights, minlength=self.max_points)
+        kept = group_weights > 0
+        return sums[kept] / group_weights[kept], group_weights[kept]
+
+    @staticmethod
+    def _quantiles(points, weights, q):
+        # np.quantile (linear interpolation) of the values the sketch holds
+        cumulative = np.cumsum(weights)
+        ranks = q * (cumulative[-1] - 1)
+        low = points[np.searchsorted(cumulative, np.floor(ranks), side='right')]
+        high = points[np.searchsorted(cumulative, np.ceil(ranks), side='right')]
+        return low + (high - low) * (ranks - np.floor(ranks))
+
+    def profile(self):
+        """
+            Returns the profile, in the format of build_reference_profile
+        """
+        profile = {'rows': self.rows, 'numeric': {}, 'categorical': {}}
+        for key in self.numeric:
+            points, weights = self.sketches[key]
+            edges = np.array([])
+            if len(points):
+                edges = np.unique(self._quantiles(points, weights, np.linspace(0, 1, self.bins + 1)[1:-1]))
+            counts = np.bincount(np.searchsorted(edges, points, side='left'), weights=weights,
+                                 minlength=len(edges) + 1)
+            counts = np.append(counts, self.missing[key])
+            profile['numeric'][key] = {
+                'edges': edges.tolist(),
+                'proportions': (counts / max(self.rows, 1)).tolist(),
+            }
+        for key in self.categorical:
+            total = max(self.rows, 1)
+            proportions = {k: count / total for k, count in self.counts[key].items() if count / total >= self.min_share}
+            proportions[OTHER_CATEGORY] = sum(count / total for k, count in self.counts[key].items()
+                                              if count / total < self.min_share)
+            profile['categorical'][key] = {'proportions': proportions}
+        return profile
+
+
+def build_reference_profile(frame, dtypes, bins=10, min_share=0.005):
+    """
+        Profiles the training data of a model, a DataFrame with its columns:
+        - numerical features: bin edges at the quantiles of the data, and the
+          share of rows in each bin (the last bin counts missing values)
+        - categorical features: share of rows of each value. Values rarer
+          than min_share are pooled under OTHER_CATEGORY, otherwise the
+          hundreds of rare diag_* codes make PSI pure sampling noise
+    """
+    builder = ReferenceProfileBuilder(list(frame.columns), dtypes, bins=bins, min_share=min_share,
+                                      max_points=max(len(frame), 1))
+    builder.update(frame)
+    return builder.profile()
+
+
+def load_reference_profile(path):
+    """
+        Returns the reference profile saved with the model bundle in path,
+        or None if there is none
+    """
+    profile_path = os.path.join(path, REFERENCE_PROFILE)
+    if not os.path.exists(profile_path):
+        return None
+    with open(profile_path) as fh:
+        return json.load(fh)
+
+
+def psi(expected, actual, epsilon=1e-4):
+    """
+        Population stability index between two lists of proportions
+    """
+    total = 0.0
+    for e, a in zip(expected, actual):
+        e, a = max(e, epsilon), max(a, epsilon)
+        total += (a - e) * math.log(a / e)
+    return total
+
+
+def binned_ks(expected, actual):
+    """
+        Kolmogorov-Smirnov statistic of two distributions over the same
+        ordered bins: the largest gap between their cumulative shares
+    """
+    gap, cumulative_e, cumulative_a = 0.0, 0.0, 0.0
+    for e, a in zip(expected, actual):
+        cumulative_e += e
+        cumulative_a += a
+        gap = max(gap, abs(cumulative_e - cumulative_a))
+    return gap
+
+
+class DriftMonitor:
+    """
+        Distribution of the scored observations of one model bundle against
+        the reference profile of its training data.
+
+        Numerical features are counted in the bins of the reference (its
+        quantiles), categorical ones in a table of the reference values
+        (anything else counts as OTHER_CATEGORY), so the memory used does not
+        grow with the traffic. Counts are kept for the current and the previous window of
+        window_seconds, and the scores are computed over both (the recent
+        traffic).
+    """
+
+    def __init__(self, reference, window_seconds=3600.0):
+        self.reference = reference
+        self.window = window_seconds
+        self.lock = threading.Lock()
+        self.numeric = [(key, spec['edges']) for key, spec in reference['numeric'].items()]
+        self.categorical = []
+        for key, spec in reference['categorical'].items():
+            categories = list(spec['proportions'])
+            if OTHER_CATEGORY not in categories:
+                categories.append(OTHER_CATEGORY)
+            self.categorical.append((key, {category: i for i, category in enumerate(categories)}))
+        self.total = 0
+        self.previous = None
+        self._new_window()
+
+    def _new_window(self):
+        self.started_at = time.time()
+        self.current = {
+            'observations': 0,
+            'numeric': [[0] * (len(edges) + 2) for _, edges in self.numeric],
+            'categorical': [[0] * len(index) for _, index in self.categorical],
+        }
+
+    def _rotate(self):
+        # A window older than two window_seconds is not recent traffic anymore
+        elapsed = time.time() - self.started_at
+        if elapsed >= self.window:
+            self.previous = self.current if elapsed < 2 * self.window else None
+            self._new_window()
+
+    def update(self, observations):
+        with self.lock:
+            self._rotate()
+            window = self.current
+            for observation in observations:
+                for (key, edges), counts in zip(self.numeric, window['numeric']):
+                    value = observation.get(key)
+                    if value is None or value != value:
+                        counts[-1] += 1
+                    else:
+                        counts[bisect.bisect_left(edges, value)] += 1
+                for (key, index), counts in zip(self.categorical, window['categorical']):
+                    counts[index.get(str(observation.get(key)), index[OTHER_CATEGORY])] += 1
+            window['observations'] += len(observations)
+            self.total += len(observations)
+
+    def scores(self):
+        """
+            Returns PSI (and KS for numerical features) of each feature over
+            the recent traffic
+        """
+        with self.lock:
+            self._rotate()
+            windows = [w for w in (self.previous, self.current) if w is not None]
+            n = sum(w['observations'] for w in windows)
+            numeric = [[sum(c) for c in zip(*(w['numeric'][i] for w in windows))] for i in range(len(self.numeric))]
+            categorical = [[sum(c) for c in zip(*(w['categorical'][i] for w in windows))]
+                           for i in range(len(self.categorical))]
+            total = self.total
+
+        features = {}
+        if n:
+            for (key, _), counts in zip(self.numeric, numeric):
+                expected = self.reference['numeric'][key]['proportions']
+                actual = [count / n for count in counts]
+                # The missing values bin is not part of the ordering
+                features[key] = {'type': 'numeric', 'psi': psi(expected, actual),
+                                 'ks': binned_ks(expected[:-1], actual[:-1])}
+            for (key, index), counts in zip(self.categorical, categorical):
+                proportions = self.reference['categorical'][key]['proportions']
+                expected = [proportions.get(category, 0.0) for category in index]
+                features[key] = {'type': 'categorical', 'psi': psi(expected, [count / n for count in counts]),
+                                 'other_share': counts[index[OTHER_CATEGORY]] / n}
+        return {
+            'observations': n,
+            'observations_since_start': total,
+            'window_seconds': self.window,
+            'max_psi': max((f['psi'] for f in features.values()), default=None),
+            'features': features,
+        }
+
+
+class DriftFeeder:
+    """
+        Hands the scored observations over to the drift monitors of their
+        bundle in a background thread, through a DroppingQueue
+    """
+
+    def __init__(self, max_queue=10000, sample_rate=1.0):
+        self.queue = DroppingQueue(max_queue)
+        self.sample_rate = sample_rate
+        self.thread = BackgroundThread(self._run, 'drift-feeder')
+
+    def offer(self, bundle, observations):
+        if bundle.drift is None:
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        self.thread.ensure_started()
+        self.queue.offer((bundle.drift, observations), len(observations))
+
+    def _run(self):
+        while True:
+            monitor, observations = self.queue.get()
+            try:
+                monitor.update(observations)
+            except Exception as e:
+                print("ERROR: could not update the drift monitor: {}".format(e))
+
+
+if os.environ.get('DRIFT_MONITOR', '1').lower() not in ('0', 'false', 'no'):
+    drift_feeder = DriftFeeder(
+        max_queue=int(os.environ.get('DRIFT_QUEUE_SIZE', 10000)),
+        sample_rate=float(os.environ.get('DRIFT_SAMPLE_RATE', 1.0)))
+else:
+    drift_feeder = None
+
+DRIFT_WINDOW_SECONDS = float(os.environ.get('DRIFT_WINDOW_SECONDS', 3600))
+
+# End drift stuff
+########################################
+
+########################################
+# Begin model bundle stuff
+
+
+def bundle_version(path):
+    """
+        Version of the model bundle in path: the content of its version.txt
+        if there is one, otherwise a hash of its pipeline.pickle
+    """
+    version_file = os.path.join(path, 'version.txt')
+    if os.path.exists(version_file):
+        with open(version_file) as fh:
+            return fh.read().strip()
+    digest = hashlib.sha1()
+    with open(os.path.join(path, 'pipeline.pickle'), 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+class ModelBundle:
+    """
+        A deployable model: the pipeline.pickle, columns.json and
+        dtypes.pickle of one folder, plus what is compiled from them (the
+        validation schema, the cache key casters and the compiled inference
+        path).
+    """
+
+    def __init__(self, path, version=None):
+        self.path = path
+        self.version = version or bundle_version(path)
+
+        with open(os.path.join(path, 'columns.json')) as fh:
+            self.columns = json.load(fh)
+
+        with open(os.path.join(path, 'dtypes.pickle'), 'rb') as fh:
+            self.dtypes = pickle.load(fh)
+
+        pipeline_path = os.path.join(path, 'pipeline.pickle')
+        self.mtime = os.path.getmtime(pipeline_path)
+        # Memory-mapping keeps the numpy arrays of the pipeline in the page
+        # cache, shared by all the processes that load the same file
+        mmap = os.environ.get('MODEL_MMAP', '1').lower() not in ('0', 'false', 'no')
+        self.pipeline = joblib.load(pipeline_path, mmap_mode='r' if mmap else None)
+
+        self.schema = ObservationSchema(self.columns, self.dtypes, valid_category_map, valid_num_range)
+        self.layout = layout_key(self.columns)
+        self.casters = [(key, _canonical_caster(self.dtypes[key])) for key in self.columns]
+        self.compiled = compile_pipeline(self)
+        self.reference = load_reference_profile(path)
+        if self.reference is not None and drift_feeder is not None:
+            self.drift = DriftMonitor(self.reference, DRIFT_WINDOW_SECONDS)
+        else:
+            self.drift = None
+        self.loaded_at = time.time()
+
+    def predict(self, observations, stage_prefix=''):
+        # encode: building the model input (compiled encoder, or DataFrame
+        # and astype); model: the estimator (the whole pipeline if not compiled)
+        try:
+            if self.compiled is not None:
+                with metrics.stage(stage_prefix + 'encode'):
+                    features = self.compiled.transform(observations)
+                with metrics.stage(stage_prefix + 'model'):
+                    return self.compiled.estimator.predict(features)
+            with metrics.stage(stage_prefix + 'encode'):
+                obs = pd.DataFrame(observations, columns=self.columns).astype(self.dtypes)
+            with metrics.stage(stage_prefix + 'model'):
+                return self.pipeline.predict(obs)
+        except Exception:
+            metrics.inc('model_errors_total', (('version', self.version),))
+            raise
+
+    def pack(self, observation):
+        return pack_observation(observation, self.columns)
+
+    def warm_up(self, n=8):
+        # The first calls of a model are slower (lazy imports, allocations),
+        # pay for them before the bundle gets traffic
+        observations = synthetic_observations(n, feature_columns=self.columns)
+        self.predict(observations[:1])
+        self.predict(observations)
+
+    def describe(self):
+        return {
+            'version': self.version,
+            'path': self.path,
+            'compiled': self.compiled is not None,
+            'drift_monitor': self.drift is not None,
+            'loaded_at': self.loaded_at,
+        }
+
+
+class ModelRegistry:
+    """
+        Model bundles held in memory, by version, and how /predict traffic
+        is routed between them: an X-Model-Version header picks a version,
+        otherwise the split (percentage of traffic per version) applies and
+        the rest goes to the default bundle. The shadow bundle, if any, also
+        scores the stored predictions in the background (see ShadowScorer).
+
+        Bundles are loaded and warmed up before being swapped in. The dicts
+        are replaced, never mutated, so request threads read them without
+        locking.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bundles = {}
+        self.default = None
+        self.split = {}
+        self.shadow = None
+        self.loading = {}
+        # Callbacks run after a bundle was added or the default changed
+        self.listeners = []
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener()
+
+    def add(self, bundle, activate=False):
+        with self.lock:
+            bundles = dict(self.bundles)
+            bundles[bundle.version] = bundle
+            self.bundles = bundles
+            if activate or self.default is None or self.default.version == bundle.version:
+                self.default = bundle
+        self._notify()
+
+    def load(self, path, version=None, activate=False):
+        bundle = ModelBundle(path, version)
+        bundle.warm_up()
+        register_layout(bundle.columns)
+        self.add(bundle, activate)
+        return bundle
+
+    def load_tracked(self, path, version=None, activate=False):
+        """
+            Loads a bundle like load, recording its progress in loading
+            (see status) instead of raising
+
+            Returns:
+            - the bundle, or None if it could not be loaded
+        """
+        key = version or path
+        with self.lock:
+            self.loading = dict(self.loading, **{key: {'status': 'loading'}})
+        try:
+            bundle = self.load(path, version, activate)
+            status = {'status': 'loaded', 'version': bundle.version}
+        except Exception as e:
+            bundle = None
+            status = {'status': 'failed', 'error': str(e)}
+        with self.lock:
+            self.loading = dict(self.loading, **{key: status})
+        return bundle
+
+    def load_in_background(self, path, version=None, activate=False):
+        key = version or path
+        with self.lock:
+            self.loading = dict(self.loading, **{key: {'status': 'loading'}})
+        thread = threading.Thread(target=self.load_tracked, args=(path, version, activate),
+                                  name='model-loader', daemon=True)
+        thread.start()
+        return thread
+
+    def set_routing(self, default=None, split=None, shadow=None):
+        """
+            Changes the default version, the split and the shadow version
+            ('' to stop shadow scoring), each one only if given
+        """
+        with self.lock:
+            versions = ([default] if default else []) + list(split or {}) + ([shadow] if shadow else [])
+            unknown = [version for version in versions if version not in self.bundles]
+            if unknown:
+                raise KeyError("Unknown model version(s): {}".format(", ".join(unknown)))
+            if split is not None:
+                if any(weight < 0 for weight in split.values()) or sum(split.values()) > 100:
+                    raise ValueError("Split percentages must be positive and add up to at most 100")
+                self.split = dict(split)
+            if default:
+                self.default = self.bundles[default]
+            if shadow is not None:
+                self.shadow = self.bundles[shadow] if shadow else None
+        self._notify()
+
+    def route(self, version=None):
+        """
+            Returns the bundle that should score a request, or None if the
+            requested version is not loaded
+        """
+        if version:
+            return self.bundles.get(version)
+        split = self.split
+        if split:
+            draw = random.random() * 100
+            for split_version, weight in split.items():
+                draw -= weight
+                if draw < 0:
+                    return self.bundles.get(split_version, self.default)
+        return self.default
+
+    def status(self):
+        return {
+            'default': self.default.version if self.default else None,
+            'split': self.split,
+            'shadow': self.shadow.version if self.shadow else None,
+            'versions': [bundle.describe() for bundle in self.bundles.values()],
+            'loading': self.loading,
+        }
+
+
+class ModelWatcher:
+    """
+        Polls the pipeline.pickle of a bundle folder and loads, warms up and
+        activates it in the background when it changes
+    """
+
+    def __init__(self, registry, path, interval):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.thread = BackgroundThread(self._run, 'model-watcher')
+
+    def ensure_started(self):
+        self.thread.ensure_started()
+
+    def _run(self):
+        pipeline_path = os.path.join(self.path, 'pipeline.pickle')
+        while True:
+            time.sleep(self.interval)
+            try:
+                mtime = os.path.getmtime(pipeline_path)
+                loaded = [b.mtime for b in self.registry.bundles.values() if b.path == self.path]
+                if loaded and mtime > max(loaded):
+                    bundle = self.registry.load(self.path, activate=True)
+                    print("Loaded model version {} from {}".format(bundle.version, self.path))
+            except Exception as e:
+                print("ERROR: could not reload the model from {}: {}".format(self.path, e))
+
+
+class ModelSync:
+    """
+        Keeps the registries of the worker processes of a server in step.
+        The admin endpoints (POST /models and /models/routing) publish their
+        change to a JSON file shared by the workers (MODEL_SYNC_FILE, set by
+        gunicorn.conf.py), and every worker reads it every interval seconds:
+        it loads the published bundles it does not have yet, then applies
+        the published routing. The changes apply on top of the MODEL_*
+        environment and last as long as the file, i.e. the server.
+
+        The file holds {"revision": n, "bundles": [[path, version], ...],
+        "default": version, "split": {...}, "shadow": version}, a None
+        setting was never changed.
+    """
+
+    def __init__(self, registry, path, interval):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.revision = 0
+        self.thread = BackgroundThread(self._run, 'model-sync')
+
+    def read(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {'revision': 0, 'bundles': [], 'default': None, 'split': None, 'shadow': None}
+
+    def publish(self, bundle=None, default=None, split=None, shadow=None):
+        """
+            Adds a (path, version) bundle and/or changes the routing of every
+            worker, the arguments that are None are left as they are
+
+            Returns:
+            - the revision of the new state
+        """
+        # Read, change and replace the file under an exclusive lock, the
+        # readers only ever see a whole file. fcntl is POSIX only, like the
+        # gunicorn servers that use this
+        import fcntl
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state = self.read()
+            state['revision'] += 1
+            if bundle is not None and list(bundle) not in state['bundles']:
+                state['bundles'].append(list(bundle))
+            if default:
+                state['default'] = default
+            if split is not None:
+                state['split'] = split
+            if shadow is not None:
+                state['shadow'] = shadow
+            temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(temporary, 'w') as fh:
+                json.dump(state, fh)
+            os.replace(temporary, self.path)
+        self.wakeup.set()
+        return state['revision']
+
+    def sync(self):
+        """
+            Applies the published state if it changed since the last call
+        """
+        with self.lock:
+            state = self.read()
+            if state['revision'] == self.revision:
+                return
+            loaded = True
+            for path, version in state['bundles']:
+                if version not in self.registry.bundles:
+                    bundle = self.registry.load_tracked(path, version)
+                    if bundle is None:
+                        loaded = False
+                        print("ERROR: could not load model version {} from {}: {}".format(
+                            version, path, self.registry.loading[version].get('error')))
+            # The revision only counts as applied once it is: otherwise the
+            # next poll retries, this worker must not stay on the old routing
+            if not loaded:
+                return
+            try:
+                self.registry.set_routing(state['default'], state['split'], state['shadow'])
+            except (KeyError, ValueError, TypeError) as e:
+                print("ERROR: could not apply the model routing: {}".format(e.args[0] if e.args else e))
+                return
+            self.revision = state['revision']
+
+    def ensure_started(self):
+        self.thread.ensure_started()
+
+    def _run(self):
+        # The published state applies on top of the models of the startup
+        startup.ready.wait()
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                print("ERROR: could not sync the models from {}: {}".format(self.path, e))
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+
+def use_default_bundle():
+    # Module level aliases of the default model, used by the original
+    # validation functions and the benchmark scripts
+    global pipeline, columns, dtypes, schema
+    bundle = registry.default
+    pipeline, columns, dtypes, schema = bundle.pipeline, bundle.columns, bundle.dtypes, bundle.schema
+
+
+def parse_split(value):
+    """
+        Parses a MODEL_SPLIT value such as "v2:10,v3:5" into {version: percentage}
+    """
+    split = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        version, weight = item.rsplit(':', 1)
+        split[version.strip()] = float(weight)
+    return split
+
+
+MODEL_DIR = os.environ.get('MODEL_DIR', 'data')
+
+registry = ModelRegistry()
+registry.listeners.append(use_default_bundle)
+if prediction_cache is not None:
+    registry.listeners.append(prediction_cache.clear)
+
+
+def load_models():
+    registry.load(MODEL_DIR, activate=True)
+    for extra_dir in filter(None, os.environ.get('MODEL_EXTRA_DIRS', '').split(',')):
+        registry.load(extra_dir.strip())
+    if os.environ.get('MODEL_SPLIT'):
+        registry.set_routing(split=parse_split(os.environ['MODEL_SPLIT']))
+    if os.environ.get('MODEL_SHADOW'):
+        registry.set_routing(shadow=os.environ['MODEL_SHADOW'].strip())
+
+if float(os.environ.get('MODEL_WATCH_INTERVAL', 0)) > 0:
+    model_watcher = ModelWatcher(registry, MODEL_DIR, float(os.environ['MODEL_WATCH_INTERVAL']))
+else:
+    model_watcher = None
+
+if os.environ.get('MODEL_SYNC_FILE'):
+    model_sync = ModelSync(registry, os.environ['MODEL_SYNC_FILE'], float(os.environ.get('MODEL_SYNC_INTERVAL', 2)))
+else:
+    model_sync = None
+
+# End model bundle stuff
+########################################
+
+########################################
+# Begin shadow scoring stuff
+
+
+class ShadowScorer:
+    """
+        Scores the stored predictions again with the shadow bundle of the
+        registry (a challenger model) off the request path, fed through a
+        DroppingQueue. The thread collects the queued observations for up to
+        interval_ms (or until batch_size of them are waiting), scores them
+        with one model call and stores the results in the shadow columns of
+        their Prediction rows with one statement, so that it takes as little
+        CPU away from the requests as possible.
+
+        quality counts the shadow predictions and baseline the primary
+        predictions of the same rows, both by shadow version, so that the
+        two models are compared on the same outcomes. Like QualityStats they
+        are per process and rebuilt from the table at startup and every
+        refresh_seconds.
+    """
+
+    def __init__(self, max_queue=10000, batch_size=256, interval_ms=500.0, sample_rate=1.0,
+                 window_seconds=3600.0, max_windows=48, refresh_seconds=0.0):
+        self.queue = DroppingQueue(max_queue)
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000.0
+        self.sample_rate = sample_rate
+        self.quality = QualityStats(window_seconds, max_windows, refresh_seconds,
+                                    'shadow_model_version', 'shadow_predicted_readmitted')
+        self.baseline = QualityStats(window_seconds, max_windows, refresh_seconds,
+                                     'shadow_model_version', 'predicted_readmitted')
+        self.lock = threading.Lock()
+        self.scored = 0
+        self.agreed = 0
+        self.invalid = 0
+        self.errors = 0
+        self.thread = BackgroundThread(self._run, 'shadow-scorer')
+
+    def offer(self, bundle, observations, predictions, created_at):
+        """
+            Queues stored observations scored by bundle with their predictions
+        """
+        shadow = registry.shadow
+        if shadow is None or shadow is bundle:
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        self._ensure_started()
+        self.queue.offer((shadow, observations, predictions, created_at), len(observations))
+
+    def _ensure_started(self):
+        self.thread.ensure_started()
+        self.quality.ensure_started()
+        self.baseline.ensure_started()
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            size = len(items[0][1])
+            deadline = time.monotonic() + self.interval
+            while size < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                size += len(items[-1][1])
+            try:
+                self.score(items)
+            except Exception as e:
+                if isinstance(e, DatabaseError):
+                    metrics.inc('db_errors_total', (('source', 'shadow'),))
+                with self.lock:
+                    self.errors += 1
+                print("ERROR: could not score with the shadow model: {}".format(e))
+
+    def score(self, items):
+        """
+            Scores queued (shadow, observations, predictions, created_at)
+            items with one model call per shadow bundle and stores the results
+        """
+        groups = {}
+        for shadow, observations, predictions, created_at in items:
+            group = groups.setdefault(shadow.version, (shadow, [], [], []))
+            group[1].extend(observations)
+            group[2].extend(predictions)
+            group[3].extend([created_at] * len(observations))
+
+        for shadow, observations, predictions, created_ats in groups.values():
+            # The shadow bundle may expect other columns than the primary one
+            keep = [i for i, errors in enumerate(shadow.schema.validate_batch(observations)) if not errors]
+            with self.lock:
+                self.invalid += len(observations) - len(keep)
+            if not keep:
+                continue
+            shadow_predictions = shadow.predict([observations[i] for i in keep], stage_prefix='shadow_')
+            ids = [observations[i]['admission_id'] for i in keep]
+
+            with DB.connection_context():
+                # The rows must be in the table before they can be updated
+                if writer is not None and any(writer.is_pending(_id) for _id in ids):
+                    writer.flush()
+                save_shadow_predictions([(shadow_prediction, shadow.version, _id)
+                                         for shadow_prediction, _id in zip(shadow_predictions, ids)])
+
+            agreed = 0
+            for i, shadow_prediction in zip(keep, shadow_predictions):
+                self.quality.record_prediction(shadow.version, created_ats[i], shadow_prediction)
+                self.baseline.record_prediction(shadow.version, created_ats[i], predictions[i])
+                agreed += shadow_prediction == predictions[i]
+            with self.lock:
+                self.scored += len(keep)
+                self.agreed += agreed
+
+    def record_outcome(self, shadow_version, created_at, predicted, shadow_predicted, previous, actual):
+        self.quality.record_outcome(shadow_version, created_at, shadow_predicted, previous, actual)
+        self.baseline.record_outcome(shadow_version, created_at, predicted, previous, actual)
+
+    def rebuild(self):
+        self.quality.rebuild()
+        self.baseline.rebuild()
+
+    def stats(self):
+        shadow = registry.shadow
+        quality = self.quality.stats()
+        baseline = self.baseline.stats()
+        with self.lock:
+            return {
+                'version': shadow.version if shadow else None,
+                'queue_depth': self.queue.qsize(),
+                'dropped': self.queue.dropped,
+                'scored': self.scored,
+                'invalid': self.invalid,
+                'errors': self.errors,
+                'agreement': self.agreed / self.scored if self.scored else None,
+                'versions': {version: {'shadow': summary, 'primary': baseline['versions'].get(version)}
+                             for version, summary in quality['versions'].items()},
+                'refreshed_at': quality['refreshed_at'],
+            }
+
+
+if os.environ.get('SHADOW_SCORING', '1').lower() not in ('0', 'false', 'no'):
+    shadow_scorer = ShadowScorer(
+        max_queue=int(os.environ.get('SHADOW_QUEUE_SIZE', 10000)),
+        batch_size=int(os.environ.get('SHADOW_BATCH_SIZE', 256)),
+        interval_ms=float(os.environ.get('SHADOW_INTERVAL_MS', 500)),
+        sample_rate=float(os.environ.get('SHADOW_SAMPLE_RATE', 1.0)),
+        window_seconds=quality.window,
+        max_windows=quality.max_windows,
+        refresh_seconds=quality.refresh_seconds)
+else:
+    shadow_scorer = None
+
+# End shadow scoring stuff
+########################################
+
+########################################
+# Begin export stuff
+
+
+PREDICTION_META_COLUMNS = ['id', 'admission_id', 'model_version', 'created_at', 'predicted_readmitted',
+                           'actual_readmitted', 'shadow_model_version', 'shadow_predicted_readmitted']
+
+
+def observations_frame(rows):
+    """
+        Decodes the stored observations of rows (layout, observation) into
+        a DataFrame with one column per feature, in the order of rows. Rows
+        of the same layout are decoded together
+    """
+    groups = {}
+    for position, (layout, observation) in enumerate(rows):
+        positions, values = groups.setdefault(layout, ([], []))
+        positions.append(position)
+        values.append(json.loads(observation) if layout else unpack_legacy_observation(observation))
+
+    frames = []
+    for layout, (positions, values) in groups.items():
+        columns = get_layout(layout) if layout else None
+        if layout and columns is None:
+            raise ValueError("Unknown observation layout {}".format(layout))
+        frames.append(pd.DataFrame(values, columns=columns, index=positions))
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, sort=False).sort_index()
+
+
+def iter_predictions(chunk_size=10000, after_id=0, with_observations=True):
+    """
+        Streams the stored predictions with their outcome, oldest first, as
+        DataFrames of at most chunk_size rows. Pages are read by primary key
+        (WHERE id > last id), so each one costs the same however deep into
+        the table it is and the table is never loaded whole.
+
+        The frames have the PREDICTION_META_COLUMNS and, if
+        with_observations, one column per feature. Pass the id of the last
+        exported row as after_id to resume an export.
+    """
+    fields = [getattr(Prediction, name) for name in PREDICTION_META_COLUMNS]
+    if with_observations:
+        fields += [Prediction.layout, Prediction.observation]
+
+    last_id = after_id
+    while True:
+        with DB.connection_context():
+            rows = list(Prediction
+                        .select(*fields)
+                        .where(Prediction.id > last_id)
+                        .order_by(Prediction.id)
+                        .limit(chunk_size)
+                        .tuples())
+            if not rows:
+                return
+            frame = pd.DataFrame([row[:len(PREDICTION_META_COLUMNS)] for row in rows],
+                                 columns=PREDICTION_META_COLUMNS)
+            if with_observations:
+                features = observations_frame([row[-2:] for row in rows])
+                features = features.drop(columns=[c for c in features.columns if c in frame.columns])
+                frame = pd.concat([frame, features.reset_index(drop=True)], axis=1)
+        last_id = rows[-1][0]
+        yield frame
+
+
+def _coerce_dtypes(frame, dtypes):
+    for key, dtype in dtypes.items():
+        if key in frame.columns:
+            try:
+                frame[key] = frame[key].astype(dtype)
+            except (TypeError, ValueError):
+                # e.g. missing values in an integer column
+                pass
+    return frame
+
+
+def _parquet_schema(frame, dtypes=None):
+    """
+        Parquet schema of the export, not inferred from a single chunk where
+        a column can be all null (e.g. created_at of the rows stored before
+        it existed): the Prediction columns are typed from their fields and
+        the features from dtypes. Features without a dtype keep the type of
+        frame, strings if they are all null
+    """
+    import pyarrow
+    field_types = {'AUTO': pyarrow.int64(), 'INT': pyarrow.int64(), 'FLOAT': pyarrow.float64(),
+                   'TEXT': pyarrow.string()}
+    dtype_types = {'i': pyarrow.int64(), 'u': pyarrow.int64(), 'f': pyarrow.float64(), 'b': pyarrow.bool_()}
+    inferred = pyarrow.Table.from_pandas(frame, preserve_index=False).schema
+    fields = []
+    for field in inferred:
+        if field.name in PREDICTION_META_COLUMNS:
+            field = field.with_type(field_types[getattr(Prediction, field.name).field_type])
+        elif dtypes is not None and field.name in dtypes:
+            field = field.with_type(dtype_types.get(dtypes[field.name].kind, pyarrow.string()))
+        elif pyarrow.types.is_null(field.type):
+            field = field.with_type(pyarrow.string())
+        fields.append(field)
+    return pyarrow.schema(fields)
+
+
+def export_predictions(path, chunk_size=10000, after_id=0, dtypes=None):
+    """
+        Writes the stored predictions to path, chunk by chunk: Parquet if
+        path ends with .parquet (needs pyarrow), CSV otherwise. The feature
+        columns are cast to dtypes when given, so that every Parquet row
+        group has the same schema.
+
+        Returns:
+        - number of rows written
+        - id of the last row written (after_id of the next incremental export)
+    """
+    parquet = path.endswith('.parquet')
+    if parquet:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow: pip install pyarrow")
+
+    written, last_id, parquet_writer = 0, after_id, None
+    try:
+        for frame in iter_predictions(chunk_size, after_id):
+            if dtypes is not None:
+                frame = _coerce_dtypes(frame, dtypes)
+            if parquet:
+                if parquet_writer is None:
+                    schema = _parquet_schema(frame, dtypes)
+                    parquet_writer = pyarrow.parquet.ParquetWriter(path, schema)
+                parquet_writer.write_table(pyarrow.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            else:
+                frame.to_csv(path, mode='a' if written else 'w', header=not written, index=False)
+            written += len(frame)
+            last_id = int(frame['id'].iloc[-1])
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+    return written, last_id
+
+
+# End export stuff
+########################################
+
+########################################
+# Begin startup stuff
+
+
+class Startup:
+    """
+        Brings the service up: creates the tables, rebuilds the quality
+        stats, loads and warms up the models and seeds the write-behind
+        index. The service reports ready
+        (GET /ready) only once all of it is done.
+
+        By default this runs while app.py is imported, so a preloading server
+        (gunicorn preload_app) does it once in the master and the forked
+        workers share the loaded model copy-on-write. With LAZY_STARTUP=1 the
+        import is cheap and each process runs it in a background thread,
+        answering 503 until it is ready.
+    """
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.error = None
+        self.started_at = time.time()
+        self.duration = None
+        self.thread = BackgroundThread(self.run, 'startup')
+
+    def run(self):
+        self.started_at = time.time()
+        try:
+            create_tables()
+            quality.rebuild()
+            if shadow_scorer is not None:
+                shadow_scorer.rebuild()
+            load_models()
+            if writer is not None:
+                writer.seed()
+        except Exception as e:
+            self.error = str(e)
+            raise
+        self.duration = time.time() - self.started_at
+        self.ready.set()
+
+    def start_in_background(self):
+        self.thread.ensure_started()
+
+    def status(self):
+        return {
+            'ready': self.ready.is_set(),
+            'error': self.error,
+            'startup_seconds': self.duration,
+            'pid': os.getpid(),
+            'default_version': registry.default.version if registry.default else None,
+        }
+
+
+def prepare_for_fork():
+    """
+        Called in the master of a preloading server before it forks the
+        workers: database connections must not be shared between processes,
+        and freezing the objects loaded so far keeps the garbage collector
+        from writing to (and so copying) their pages in every worker
+    """
+    if hasattr(DB, 'close_all'):
+        DB.close_all()
+    elif not DB.is_closed():
+        DB.close()
+    gc.freeze()
+
+
+startup = Startup()
+LAZY_STARTUP = os.environ.get('LAZY_STARTUP', '').lower() in ('1', 'true', 'yes')
+if not LAZY_STARTUP:
+    startup.run()
+
+# End startup stuff
+########################################
+
+########################################
+# Begin JSON stuff
+
+# orjson is optional: several times faster than the json module to parse a
+# request and to encode a response (the long allowed values lists of the
+# diag_* errors especially), the json module is used when it is missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FAST_JSON = orjson is not None and os.environ.get('FAST_JSON', '1').lower() not in ('0', 'false', 'no')
+
+
+# Literals the json module accepts and orjson rejects
+NON_FINITE_LITERALS = ('NaN', 'Infinity', '-Infinity')
+
+
+def json_loads(data):
+    """
+        Parses a JSON document (str or bytes). orjson rejects the NaN and
+        Infinity literals that the json module accepts, only a document
+        that orjson stopped at such a literal is parsed again with the json
+        module, the error of any other invalid document is raised as is
+    """
+    if not FAST_JSON:
+        return json.loads(data)
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError as e:
+        if not e.doc.startswith(NON_FINITE_LITERALS, e.pos):
+            raise
+    return json.loads(data)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+        Flask JSON provider (request.get_json, jsonify) using orjson when
+        FAST_JSON, with the same output as the default provider: sorted keys,
+        numpy values as numbers, other types through the default hook
+    """
+
+    options = (orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return json_loads(s)
+
+    def dumps(self, obj, **kwargs):
+        if not FAST_JSON or set(kwargs) - {'separators'}:
+            return super().dumps(obj, **kwargs)
+        return self._orjson_dumps(obj).decode()
+
+    def _orjson_dumps(self, obj):
+        try:
+            return orjson.dumps(obj, default=self.default, option=self.options)
+        except TypeError:
+            # e.g. integers beyond 64 bits
+            return super().dumps(obj).encode()
+
+    def response(self, *args, **kwargs):
+        if not FAST_JSON or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._orjson_dumps(obj) + b'\n', mimetype=self.mimetype)
+
+
+# End JSON stuff
+########################################
+
+########################################
+# Begin webserver stuff
+
+app = Flask(__name__)
+app.json = FastJSONProvider(app)
+# Whole request bodies are read in memory, batches included
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 32 * 1024 * 1024))
+# A single observation is a few hundred bytes
+MAX_OBSERVATION_BYTES = int(os.environ.get('MAX_OBSERVATION_BYTES', 64 * 1024))
+
+
+# Endpoints that need the models and the tables
+SERVING_ENDPOINTS = ('predict', 'predict_batch', 'update', 'update_batch')
+BATCH_ENDPOINTS = ('predict_batch', 'update_batch')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+def limit_request_size():
+    if request.endpoint in BATCH_ENDPOINTS or request.endpoint not in SERVING_ENDPOINTS:
+        return None
+    if (request.content_length or 0) > MAX_OBSERVATION_BYTES:
+        error_msg = 'Request body larger than {} bytes'.format(MAX_OBSERVATION_BYTES)
+        return jsonify({'error': error_msg}), 413
+
+
+@app.errorhandler(413)
+def request_too_large(e):
+    # Bodies over MAX_CONTENT_LENGTH, Flask would answer with an HTML page
+    error_msg = 'Request body larger than {} bytes'.format(app.config['MAX_CONTENT_LENGTH'])
+    return jsonify({'error': error_msg}), 413
+
+
+@app.before_request
+def wait_for_startup():
+    if startup.ready.is_set():
+        return None
+    startup.start_in_background()
+    if request.endpoint in SERVING_ENDPOINTS:
+        return jsonify({'error': 'Service is starting, retry later'}), 503
+
+
+@app.teardown_request
+def db_close(exc):
+    # A request only takes a connection with its first query (peewee
+    # autoconnect): /metrics, /stats or a prediction buffered by the
+    # write-behind writer never check one out of the pool. With the pooled
+    # backends this returns it to the pool
+    if not DB.is_closed():
+        DB.close()
+
+
+@app.before_request
+def start_model_watcher():
+    if model_watcher is not None:
+        model_watcher.ensure_started()
+
+
+@app.before_request
+def start_model_sync():
+    if model_sync is not None:
+        model_sync.ensure_started()
+
+
+@app.before_request
+def start_quality_refresh():
+    quality.ensure_started()
+
+
+@app.before_request
+def start_profiler():
+    if request.endpoint in SERVING_ENDPOINTS:
+        forced = 'X-Profile' in request.headers and admin_allowed()
+        g.profiler = profiler.start(forced)
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    request_profiler = g.pop('profiler', None)
+    if request_profiler is not None:
+        response.headers['X-Profile-Name'] = profiler.finish(request_profiler, endpoint)
+    if 'request_start' in g:
+        metrics.histogram('request_seconds', (('endpoint', endpoint),)).observe(
+            time.perf_counter() - g.request_start)
+    metrics.inc('requests_total', (('endpoint', endpoint), ('status', response.status_code)))
+    return response
+
+
+@app.teardown_request
+def record_request_errors(exc):
+    if isinstance(exc, DatabaseError) and not isinstance(exc, IntegrityError):
+        metrics.inc('db_errors_total', (('source', 'request'),))
+    # A request that failed before its response was made still has its
+    # profiler running
+    request_profiler = g.pop('profiler', None)
+    if request_profiler is not None:
+        profiler.finish(request_profiler, request.endpoint or 'unknown')
+
+
+def route_model():
+    """
+        Returns the model bundle that should score this request, see
+        ModelRegistry.route, or None if the requested version is unknown
+    """
+    return registry.route(request.headers.get('X-Model-Version'))
+
+
+def unknown_version_response():
+    error_msg = 'Model version "{}" is not loaded'.format(request.headers.get('X-Model-Version'))
+    return jsonify({'error': error_msg})
+
+
+def with_model_version(response, bundle):
+    response.headers['X-Model-Version'] = bundle.version
+    return response
+
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    with metrics.stage('parse'):
+        obs_dict = request.get_json()
+
+    bundle = route_model()
+    if bundle is None:
+        return unknown_version_response()
+  
+    with metrics.stage('validate'):
+        observation_ok, error = check_observation(obs_dict, bundle)
+    if not observation_ok:
+        response = {'error': error}
+        return jsonify(response)
+
+    _id = obs_dict['admission_id']
+
+
+    with metrics.stage('predict'):
+        prediction = cached_predict([obs_dict], bundle)[0]
+    if drift_feeder is not None:
+        drift_feeder.offer(bundle, [obs_dict])
+    
+    response = {'readmitted': prediction}
+    created_at = time.time()
+
+    if writer is not None:
+        with metrics.stage('save'):
+            reserved = writer.reserve(_id)
+            if reserved:
+                writer.put({
+                    'admission_id': _id,
+                    'observation': bundle.pack(obs_dict),
+                    'predicted_readmitted': prediction,
+                    'model_version': bundle.version,
+                    'layout': bundle.layout,
+                    'created_at': created_at,
+                })
+                quality.record_prediction(bundle.version, created_at, prediction)
+        if reserved and shadow_scorer is not None:
+            shadow_scorer.offer(bundle, [obs_dict], [prediction], created_at)
+        if not reserved:
+            metrics.inc('duplicate_ids_total')
+            error_msg = "ERROR: Observation Id: '{}' already exists".format(_id)
+            response["error"] = error_msg
+            print(error_msg)
+        return with_model_version(jsonify(response), bundle)
+    
+    p = Prediction(
+        admission_id=_id,
+        observation=bundle.pack(obs_dict),
+        predicted_readmitted = prediction,
+        model_version=bundle.version,
+        layout=bundle.layout,
+        created_at=created_at
+    )
+
+    try:
+        with metrics.stage('save'), DB.atomic():
+            p.save()
+        quality.record_prediction(bundle.version, created_at, prediction)
+        if shadow_scorer is not None:
+            shadow_scorer.offer(bundle, [obs_dict], [prediction], created_at)
+    except IntegrityError:
+        metrics.inc('duplicate_ids_total')
+        error_msg = "ERROR: Observation Id: '{}' already exists".format(_id)
+        response["error"] = error_msg
+        print(error_msg)
+    return with_model_version(jsonify(response), bundle)
+
+    
+@app.route('/update', methods=['POST'])
+def update():
+    obs = request.get_json()
+    if writer is not None and writer.is_pending(obs['admission_id']):
+        writer.flush()
+    try:
+        with metrics.stage('update'):
+            p = Prediction.get(Prediction.admission_id == obs['admission_id'])
+            previous = p.actual_readmitted
+            p.actual_readmitted = obs['readmitted']
+            # Only the outcome: the shadow scorer may be writing the row
+            p.save(only=[Prediction.actual_readmitted])
+        if previous != p.actual_readmitted:
+            quality.record_outcome(p.model_version, p.created_at, p.predicted_readmitted,
+                                   previous, p.actual_readmitted)
+            if shadow_scorer is not None and p.shadow_predicted_readmitted is not None:
+                shadow_scorer.record_outcome(p.shadow_model_version, p.created_at, p.predicted_readmitted,
+                                             p.shadow_predicted_readmitted, previous, p.actual_readmitted)
+        
+        response = {
+                    "admission_id": obs['admission_id'],
+                    "actual_readmitted": obs['readmitted'],
+                    "predicted_readmitted": p.predicted_readmitted
+                    }
+
+        return jsonify(response)
+    except Prediction.DoesNotExist:
+        error_msg = 'Admission Id: "{}" does not exist'.format(obs['admission_id'])
+        return jsonify({'error': error_msg})
+
+
+@app.route('/update_batch', methods=['POST'])
+def update_batch():
+    """
+        Outcomes of many admissions at once, as a JSON array or
+        newline-delimited JSON of {"admission_id": ..., "readmitted": ...}.
+        They are written in a single transaction; when an id is repeated the
+        last outcome wins. Like /update, "2002" is admission 2002 and the
+        outcome is stored as text.
+
+        Returns a list with, for each record in order, its admission_id and
+        status: updated, unchanged, unknown (no prediction with that id) or
+        an error if the record is malformed (e.g. an admission_id that is not
+        an integer)
+    """
+    records = read_batch_records()
+    if records is None:
+        return jsonify({'error': "Expected a JSON array or newline-delimited JSON outcomes"})
+
+    # Coerced like /update does it through the fields of Prediction
+    parsed = []
+    outcomes = {}
+    for record in records:
+        if not (isinstance(record, dict) and 'admission_id' in record and 'readmitted' in record):
+            parsed.append(None)
+            continue
+        try:
+            _id = int(record['admission_id'])
+        except (TypeError, ValueError):
+            parsed.append(None)
+            continue
+        parsed.append(_id)
+        outcomes[_id] = Prediction.actual_readmitted.db_value(record['readmitted'])
+
+    if writer is not None and any(writer.is_pending(_id) for _id in outcomes):
+        writer.flush()
+    with metrics.stage('batch_update'):
+        updated, changes = update_outcomes(outcomes)
+    for version, created_at, predicted, previous, actual, shadow_version, shadow_predicted in changes:
+        quality.record_outcome(version, created_at, predicted, previous, actual)
+        if shadow_scorer is not None and shadow_predicted is not None:
+            shadow_scorer.record_outcome(shadow_version, created_at, predicted, shadow_predicted, previous, actual)
+
+    results = []
+    for record, _id in zip(records, parsed):
+        if _id is None:
+            result = {'error': "Expected an object with an integer admission_id and readmitted"}
+            if isinstance(record, dict) and 'admission_id' in record:
+                result['admission_id'] = record['admission_id']
+            results.append(result)
+            continue
+        status, predicted = updated[_id]
+        result = {'admission_id': record['admission_id'], 'status': status}
+        if status == 'unknown':
+            result['error'] = 'Admission Id: "{}" does not exist'.format(record['admission_id'])
+        else:
+            result['actual_readmitted'] = outcomes[_id]
+            result['predicted_readmitted'] = predicted
+        results.append(result)
+    return jsonify(results)
+
+
+def read_batch_records():
+    """
+        Reads the observations of a batch request. The body can either be
+        a JSON array of observations or newline-delimited JSON (one
+        observation per line)
+
+        Returns:
+        - list of records (a line that is not valid JSON becomes None so that
+          it is reported on its own), or None if the body is not a batch
+    """
+    body = request.get_data()
+
+    if body.lstrip().startswith(b'['):
+        try:
+            records = json_loads(body)
+        except ValueError:
+            return None
+        return records if isinstance(records, list) else None
+
+    records = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json_loads(line))
+        except ValueError:
+            records.append(None)
+    return records
+
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    with metrics.stage('batch_parse'):
+        records = read_batch_records()
+    if records is None:
+        return jsonify({'error': "Expected a JSON array or newline-delimited JSON observations"})
+
+    bundle = route_model()
+    if bundle is None:
+        return unknown_version_response()
+
+    results = [None] * len(records)
+    valid = []
+
+    with metrics.stage('batch_validate'):
+        validated = bundle.schema.validate_batch(records)
+    for i, (obs_dict, errors) in enumerate(zip(records, validated)):
+        if errors:
+            count_validation_failures(errors, bundle.schema)
+            results[i] = {'error': format_errors(errors)}
+            if isinstance(obs_dict, dict) and 'admission_id' in obs_dict:
+                results[i]['admission_id'] = obs_dict['admission_id']
+            continue
+        valid.append(i)
+
+    if valid:
+        observations = [records[i] for i in valid]
+        with metrics.stage('batch_predict'):
+            predictions = cached_predict(observations, bundle)
+        if drift_feeder is not None:
+            drift_feeder.offer(bundle, observations)
+
+        with metrics.stage('batch_save'):
+            created_at = time.time()
+            if writer is None:
+                existing = existing_admission_ids([o['admission_id'] for o in observations])
+            seen = set()
+            rows = []
+            # Index in records of each row
+            stored = []
+            for i, obs_dict, prediction in zip(valid, observations, predictions):
+                _id = obs_dict['admission_id']
+                results[i] = {'admission_id': _id, 'readmitted': prediction}
+                if writer is not None:
+                    if not writer.reserve(_id):
+                        continue
+                elif _id in existing or _id in seen:
+                    continue
+                seen.add(_id)
+                stored.append(i)
+                rows.append({
+                    'admission_id': _id,
+                    'observation': bundle.pack(obs_dict),
+                    'predicted_readmitted': prediction,
+                    'model_version': bundle.version,
+                    'layout': bundle.layout,
+                    'created_at': created_at,
+                })
+
+            if writer is not None:
+                writer.put_many(rows)
+                saved = set(seen)
+            else:
+                saved = seen - save_predictions(rows) if rows else set()
+            for row in rows:
+                if row['admission_id'] in saved:
+                    quality.record_prediction(bundle.version, created_at, row['predicted_readmitted'])
+            stored = [i for i, row in zip(stored, rows) if row['admission_id'] in saved]
+            if stored and shadow_scorer is not None:
+                shadow_scorer.offer(bundle, [records[i] for i in stored],
+                                    [results[i]['readmitted'] for i in stored], created_at)
+
+        for i in valid:
+            _id = results[i]['admission_id']
+            if _id in saved:
+                # Only the first occurrence of an id in the batch is stored
+                saved.discard(_id)
+            else:
+                metrics.inc('duplicate_ids_total')
+                results[i]['error'] = "ERROR: Observation Id: '{}' already exists".format(_id)
+
+    return with_model_version(jsonify(results), bundle)
+
+
+@app.route('/batcher_stats', methods=['GET'])
+def batcher_stats():
+    if batcher is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(batcher.stats(), enabled=True))
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    if prediction_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(prediction_cache.stats(), enabled=True))
+
+
+@app.route('/writer_stats', methods=['GET'])
+def writer_stats():
+    if writer is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(writer.stats(), enabled=True))
+
+
+def stats_samples(prefix, stats):
+    """
+        Returns the numeric values of a stats() dict as metric samples
+    """
+    return [('{}_{}'.format(prefix, key), 'gauge', (), value) for key, value in stats.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+
+if batcher is not None:
+    metrics.collectors.append(lambda: stats_samples('batcher', batcher.stats()))
+if prediction_cache is not None:
+    metrics.collectors.append(lambda: stats_samples('cache', prediction_cache.stats()))
+if writer is not None:
+    metrics.collectors.append(lambda: stats_samples('writer', writer.stats()))
+if shadow_scorer is not None:
+    metrics.collectors.append(lambda: stats_samples('shadow', shadow_scorer.stats()))
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(quality.stats())
+
+
+@app.route('/shadow_stats', methods=['GET'])
+def shadow_stats():
+    """
+        The shadow scoring and, per shadow version, the quality of its
+        predictions next to the quality of the primary predictions of the
+        same admissions
+    """
+    if shadow_scorer is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(shadow_scorer.stats(), enabled=True))
+
+
+@app.route('/drift', methods=['GET'])
+def drift():
+    if drift_feeder is None:
+        return jsonify({'enabled': False})
+    versions = {}
+    for version, bundle in registry.bundles.items():
+        if bundle.drift is None:
+            versions[version] = {'error': 'No reference profile ({}) in {}'.format(REFERENCE_PROFILE, bundle.path)}
+        else:
+            versions[version] = bundle.drift.scores()
+    return jsonify({
+        'enabled': True,
+        'queue_depth': drift_feeder.queue.qsize(),
+        'dropped': drift_feeder.queue.dropped,
+        'versions': versions,
+    })
+
+
+def drift_samples():
+    samples = []
+    for version, bundle in registry.bundles.items():
+        if bundle.drift is not None:
+            for feature, scores in bundle.drift.scores()['features'].items():
+                samples.append(('drift_psi', 'gauge', (('version', version), ('feature', feature)), scores['psi']))
+    return samples
+
+
+if drift_feeder is not None:
+    metrics.collectors.append(drift_samples)
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/profile', methods=['GET'])
+def profile():
+    name = request.args.get('name')
+    if name is None:
+        return jsonify(profiler.status())
+    report = profiler.report(name)
+    if report is None:
+        return jsonify({'error': 'Profile "{}" does not exist'.format(name)}), 404
+    return Response(report, mimetype='text/plain')
+
+
+@app.route('/profile', methods=['POST'])
+def arm_profiler():
+    if not admin_allowed():
+        return jsonify({'error': 'Not allowed'}), 403
+    payload = request.get_json(silent=True) or {}
+    try:
+        n = int(payload.get('requests', 1))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'requests must be an integer'})
+    profiler.arm(n)
+    return jsonify(profiler.status())
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = startup.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+def admin_allowed():
+    # The admin endpoints load pickles from server paths and reroute the
+    # traffic: closed unless ADMIN_TOKEN is set and sent as X-Admin-Token
+    token = os.environ.get('ADMIN_TOKEN')
+    return bool(token) and request.headers.get('X-Admin-Token') == token
+
+
+@app.route('/models', methods=['GET'])
+def models():
+    return jsonify(registry.status())
+
+
+@app.route('/models', methods=['POST'])
+def load_model():
+    """
+        Loads a model bundle folder in the background, warms it up and adds
+        it to the registry. Payload: {"path": ..., "version": optional,
+        "activate": optional bool, to make it the default once loaded}.
+        Behind several workers every one of them loads it (see ModelSync)
+    """
+    if not admin_allowed():
+        return jsonify({'error': 'Not allowed'}), 403
+    payload = request.get_json(silent=True) or {}
+    path = payload.get('path')
+    if not path or not os.path.isfile(os.path.join(path, 'pipeline.pickle')):
+        return jsonify({'error': 'path must be a folder with a pipeline.pickle'})
+    activate = bool(payload.get('activate'))
+    if model_sync is None:
+        registry.load_in_background(path, payload.get('version'), activate)
+        return jsonify({'status': 'loading', 'path': path}), 202
+    # The workers must agree on the version, it is resolved once here
+    version = payload.get('version') or bundle_version(path)
+    model_sync.ensure_started()
+    model_sync.publish(bundle=(path, version), default=version if activate else None)
+    return jsonify({'status': 'loading', 'path': path, 'version': version}), 202
+
+
+@app.route('/models/routing', methods=['POST'])
+def model_routing():
+    """
+        Changes the routing of /predict traffic. Payload: {"default": version,
+        "split": {version: percentage, ...}, "shadow": version or null to
+        stop shadow scoring}, all optional. Behind several workers every one
+        of them applies it (see ModelSync)
+    """
+    if not admin_allowed():
+        return jsonify({'error': 'Not allowed'}), 403
+    payload = request.get_json(silent=True) or {}
+    shadow = (payload['shadow'] or '') if 'shadow' in payload else None
+    try:
+        registry.set_routing(payload.get('default'), payload.get('split'), shadow)
+    except (KeyError, ValueError, TypeError) as e:
+        return jsonify({'error': e.args[0] if e.args else str(e)})
+    if model_sync is not None:
+        model_sync.publish(default=payload.get('default'), split=payload.get('split'), shadow=shadow)
+    return jsonify(registry.status())
 
 
-    
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', debug=True, port=5000)
+    # Flask development server, use serve.py in production
+    debug = os.environ.get('FLASK_DEBUG', '').lower() in ('1', 'true', 'yes')
+    app.run(host='0.0.0.0', debug=debug, port=int(os.environ.get('PORT', 5000)))
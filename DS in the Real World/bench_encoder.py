@@ -0,0 +1,108 @@
+"""
+Parity check and latency benchmark of the compiled inference path
+(CompiledPipeline) against the pandas path (DataFrame + .astype(dtypes) +
+pipeline.predict).
+
+Run it from the folder that contains the data/ directory:
+
+    python bench_encoder.py --n 5000
+
+The parity check compares the encoded feature matrix and the predictions
+of both paths, one row at a time and as one batch, and exits with status 1
+on the first difference.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import app
+
+
+def pandas_frame(observations):
+    return pd.DataFrame(observations, columns=app.columns).astype(app.dtypes)
+
+
+def pandas_predict(observations):
+    return app.pipeline.predict(pandas_frame(observations))
+
+
+def with_missing_values(observations):
+    # The pandas path imputes NaN in float columns, make sure those rows are covered
+    keys = [key for key in app.valid_num_range if app.dtypes[key].kind == 'f']
+    observations = [dict(o) for o in observations]
+    for i, observation in enumerate(observations[::7]):
+        observation[keys[i % len(keys)]] = float('nan')
+    return observations
+
+
+def check_parity(compiled, observations):
+    preprocessor = app.pipeline[:-1]
+    expected = preprocessor.transform(pandas_frame(observations))
+    if hasattr(expected, 'toarray'):
+        expected = expected.toarray()
+    encoded = compiled.transform(observations)
+    if hasattr(encoded, 'toarray'):
+        encoded = encoded.toarray()
+    if not np.array_equal(encoded, expected, equal_nan=True):
+        rows = np.where(~((encoded == expected) | (np.isnan(encoded) & np.isnan(expected))).all(axis=1))[0]
+        return "encoded features differ, first row {}".format(rows[0])
+
+    if list(compiled.predict(observations)) != list(pandas_predict(observations)):
+        return "batch predictions differ"
+
+    for i, observation in enumerate(observations[:500]):
+        if compiled.predict([observation])[0] != pandas_predict([observation])[0]:
+            return "single-row prediction differs for row {}".format(i)
+
+    return None
+
+
+def best_of(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--n', type=int, default=5000, help="observations in the parity check and batch run")
+    parser.add_argument('--single', type=int, default=300, help="single-row predictions timed per run")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    compiled = app.CompiledPipeline(app.pipeline, app.columns, app.dtypes)
+    observations = with_missing_values(app.synthetic_observations(args.n, seed=1))
+
+    error = check_parity(compiled, observations)
+    if error:
+        print("PARITY FAILED: {}".format(error))
+        sys.exit(1)
+    print("parity ok on {} observations ({} features)".format(len(observations), compiled.width))
+
+    single = observations[:args.single]
+    runs = [
+        ('single row', len(single),
+         lambda: [pandas_predict([o]) for o in single],
+         lambda: [compiled.predict([o]) for o in single]),
+        ('batch of {}'.format(len(observations)), len(observations),
+         lambda: pandas_predict(observations),
+         lambda: compiled.predict(observations)),
+        ('encode only, single row', len(single),
+         lambda: [app.pipeline[:-1].transform(pandas_frame([o])) for o in single],
+         lambda: [compiled.transform([o]) for o in single]),
+    ]
+    for name, n, pandas_run, compiled_run in runs:
+        pandas_time = best_of(pandas_run, args.repeat) / n * 1e6
+        compiled_time = best_of(compiled_run, args.repeat) / n * 1e6
+        print("{:<24} pandas {:>9.1f} us/row  compiled {:>9.1f} us/row  {:>6.1f}x".format(
+            name, pandas_time, compiled_time, pandas_time / compiled_time))
+
+
+if __name__ == '__main__':
+    main()
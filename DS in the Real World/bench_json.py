@@ -0,0 +1,119 @@
+"""
+Benchmark of the JSON layer of the request path: a mix of valid and invalid
+/predict requests through the Flask test client, with the json module and
+with orjson (FAST_JSON).
+
+Run it from the folder that contains the data/ directory:
+
+    python bench_json.py --n 5000 --invalid 0.5
+    python bench_json.py --n 5000 --invalid 0.9 sqlite:///bench_json.db
+
+The two modes alternate request by request, the responses with orjson are
+checked against the json module ones (same status, same decoded body) and
+the time per request is reported for the valid and the invalid ones, then
+the time of the JSON layer alone (parsing and response). The predictions of
+the valid requests are stored, use a throwaway database.
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import time
+
+
+def post(app, client, body, fast):
+    app.FAST_JSON = fast
+    start = time.perf_counter()
+    response = client.post('/predict', data=body, content_type='application/json')
+    elapsed = time.perf_counter() - start
+    return elapsed, response.status_code, json.loads(response.get_data())
+
+
+def time_codec(app, bodies, fast, repeat=5):
+    """
+        Time of the JSON layer alone per request: parsing the body and
+        building the response of /predict for it
+    """
+    app.FAST_JSON = fast
+    provider = app.app.json
+    payloads = []
+    for valid, body in bodies:
+        observation = json.loads(body)
+        _, error_msg = app.check_observation(observation)
+        payloads.append((body.encode(), {'error': error_msg} if error_msg else {'readmitted': 'Yes'}))
+    with app.app.app_context():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for body, payload in payloads:
+                provider.loads(body)
+                provider.response(payload)
+        return (time.perf_counter() - start) / repeat / len(payloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('url', nargs='?', default='sqlite:///bench_json.db', help="DATABASE_URL to store in")
+    parser.add_argument('--n', type=int, default=5000, help="requests per mode")
+    parser.add_argument('--invalid', type=float, default=0.5, help="share of invalid requests")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.url
+    import app
+    app = importlib.reload(app)
+    from bench_validation import make_invalid
+    if app.orjson is None:
+        parser.error("orjson is not installed: pip install orjson")
+    client = app.app.test_client()
+
+    with app.DB.connection_context():
+        first_id = (app.Prediction.select(app.fn.MAX(app.Prediction.admission_id)).scalar() or 0) + 1
+
+    # The two modes alternate request by request on their own admissions,
+    # the cache and the duplicates check would otherwise answer the second
+    rng = random.Random(0)
+    bodies = {False: [], True: []}
+    for i, observation in enumerate(app.synthetic_observations(args.n)):
+        valid = rng.random() >= args.invalid
+        observation['admission_id'] = first_id + 2 * i
+        if not valid:
+            observation = make_invalid(observation, rng)
+        bodies[False].append((valid, json.dumps(observation)))
+        bodies[True].append((valid, json.dumps(dict(observation, admission_id=first_id + 2 * i + 1))))
+
+    timings = {(fast, valid): 0.0 for fast in (False, True) for valid in (False, True)}
+    for (valid, stdlib_body), (_, fast_body) in zip(bodies[False], bodies[True]):
+        elapsed, stdlib_status, stdlib_response = post(app, client, stdlib_body, False)
+        timings[False, valid] += elapsed
+        elapsed, fast_status, fast_response = post(app, client, fast_body, True)
+        timings[True, valid] += elapsed
+        assert stdlib_status == fast_status, "statuses differ"
+        if 'error' in stdlib_response:
+            assert stdlib_response == fast_response, "error responses differ"
+        else:
+            assert set(stdlib_response) == set(fast_response), "responses differ"
+    if app.writer is not None:
+        app.writer.flush()
+
+    kinds = [valid for valid, _ in bodies[False]]
+    n_valid = sum(kinds)
+    counts = {True: n_valid, False: args.n - n_valid}
+    print("{} requests per mode, {:.0%} invalid".format(args.n, 1 - n_valid / args.n))
+    for valid in (True, False):
+        if not counts[valid]:
+            continue
+        a = timings[False, valid] / counts[valid] * 1e6
+        b = timings[True, valid] / counts[valid] * 1e6
+        print("  {:8}  json {:8.0f} us/request   orjson {:8.0f} us/request   {:5.2f}x".format(
+            'valid' if valid else 'invalid', a, b, a / b))
+    a = (timings[False, True] + timings[False, False]) / args.n * 1e6
+    b = (timings[True, True] + timings[True, False]) / args.n * 1e6
+    print("  {:8}  json {:8.0f} us/request   orjson {:8.0f} us/request   {:5.2f}x".format('all', a, b, a / b))
+    a = time_codec(app, bodies[False], False) * 1e6
+    b = time_codec(app, bodies[False], True) * 1e6
+    print("  {:8}  json {:8.1f} us/request   orjson {:8.1f} us/request   {:5.2f}x  (parse + response only)".format(
+        'codec', a, b, a / b))
+
+
+if __name__ == '__main__':
+    main()
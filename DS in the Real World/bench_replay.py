@@ -0,0 +1,373 @@
+"""
+Replays a recording of /predict and /update requests against the service
+and compares the results with a saved baseline, to catch performance
+regressions of a change to app.py.
+
+Run it from the folder that contains the data/ directory:
+
+    python bench_replay.py record replay.jsonl --predictions 5000
+    python bench_replay.py run replay.jsonl --save-baseline baseline.json
+    python bench_replay.py run replay.jsonl --compare baseline.json
+    python bench_replay.py run replay.jsonl --launch --concurrency 32 --rate 500
+    python bench_replay.py run replay.jsonl --url http://localhost:5000
+
+A recording has one request per line: {"path": "/predict", "body": {...}}.
+"record" writes a reproducible one from synthetic observations, with
+invalid observations, duplicate ids and the outcomes of part of the
+predictions (sent after them).
+
+"run" sends the requests in order, from --concurrency threads, at most
+--rate requests per second overall (0: as fast as possible). The target is
+an in-process Flask test client on a fresh SQLite database (default), a
+server launched with serve.py on a fresh database (--launch) or a running
+server (--url). It reports, per endpoint, the latency percentiles, the
+throughput, the validation failures, duplicates and other errors, and the
+rate of rows written to the database. --compare exits with status 1 when a
+latency percentile or the throughput is worse than the baseline by more than
+--tolerance.
+"""
+import argparse
+import http.client
+import importlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+from loadtest import percentile
+
+ENDPOINTS = ('/predict', '/update')
+
+
+def record(args):
+    # Only the model files are needed: no startup, no database
+    os.environ['LAZY_STARTUP'] = '1'
+    import app
+    from bench_validation import make_invalid
+    with open(os.path.join(app.MODEL_DIR, 'columns.json')) as fh:
+        columns = json.load(fh)
+
+    rng = random.Random(args.seed)
+    requests = []
+    outcomes = []
+    observations = app.synthetic_observations(args.predictions, seed=args.seed, feature_columns=columns)
+    for i, observation in enumerate(observations):
+        observation['admission_id'] = i + 1
+        draw = rng.random()
+        if draw < args.invalid_ratio:
+            observation = make_invalid(observation, rng)
+        elif draw < args.invalid_ratio + args.duplicate_ratio and i:
+            observation['admission_id'] = rng.randint(1, i)
+        requests.append({'path': '/predict', 'body': observation})
+        if rng.random() < args.update_ratio:
+            outcomes.append({'admission_id': observation['admission_id'],
+                             'readmitted': rng.choice(['Yes', 'No'])})
+        # Outcomes arrive well after their prediction
+        while outcomes and len(outcomes) > args.update_lag * args.update_ratio:
+            requests.append({'path': '/update', 'body': outcomes.pop(0)})
+    requests.extend({'path': '/update', 'body': outcome} for outcome in outcomes)
+
+    with open(args.recording, 'w') as fh:
+        for request in requests:
+            fh.write(json.dumps(request) + '\n')
+    print("Recorded {} requests ({} columns of model {}) to {}".format(
+        len(requests), len(columns), app.bundle_version(app.MODEL_DIR), args.recording))
+
+
+def classify(path, status, response):
+    """
+        Returns the outcome of a request: ok, validation, duplicate, unknown
+        (outcome of an unknown admission) or error
+    """
+    if status >= 400 or not isinstance(response, dict):
+        return 'error'
+    message = response.get('error')
+    if not message:
+        return 'ok'
+    if 'already exists' in message:
+        return 'duplicate'
+    if 'does not exist' in message:
+        return 'unknown'
+    return 'validation' if path == '/predict' else 'error'
+
+
+class InProcessTarget:
+    def __init__(self, database_url):
+        os.environ['DATABASE_URL'] = database_url
+        import app
+        self.app = importlib.reload(app)
+
+    def post_factory(self):
+        client = self.app.app.test_client()
+
+        def post(path, body):
+            response = client.post(path, json=body)
+            return response.status_code, response.get_json(silent=True)
+        return post
+
+    def finish(self):
+        if self.app.writer is not None:
+            self.app.writer.flush()
+
+    def rows(self):
+        with self.app.DB.connection_context():
+            return (self.app.Prediction.select().count(),
+                    self.app.Prediction.select().where(self.app.Prediction.actual_readmitted.is_null(False)).count())
+
+    def close(self):
+        pass
+
+
+class HttpTarget:
+    def __init__(self, url, process=None):
+        self.parts = urlsplit(url)
+        self.process = process
+
+    def post_factory(self):
+        parts = self.parts
+        connection = http.client.HTTPConnection(parts.netloc, timeout=60)
+
+        def post(path, body):
+            connection.request('POST', parts.path.rstrip('/') + path, body=json.dumps(body),
+                               headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+            try:
+                return response.status, json.loads(data)
+            except ValueError:
+                return response.status, None
+        return post
+
+    def finish(self):
+        pass
+
+    def rows(self):
+        # The database of a server is not reachable from here
+        return None
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def launch_server(args):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, DATABASE_URL=args.database_url)
+    command = [sys.executable, 'serve.py', '--bind', '127.0.0.1:{}'.format(port)]
+    if args.workers:
+        command += ['--workers', str(args.workers)]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url + '/ready', timeout=5):
+                return HttpTarget(url, process)
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("serve.py did not get ready")
+
+
+def replay(target, requests, concurrency, rate):
+    """
+        Returns the (endpoint, outcome, latency) of each request and the
+        elapsed wall time
+    """
+    results = [None] * len(requests)
+    position = [0]
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def worker():
+        post = target.post_factory()
+        while True:
+            with lock:
+                i = position[0]
+                position[0] += 1
+            if i >= len(requests):
+                return
+            if rate:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            path, body = requests[i]['path'], requests[i]['body']
+            sent = time.perf_counter()
+            try:
+                status, response = post(path, body)
+            except Exception:
+                status, response = 599, None
+            results[i] = (path, classify(path, status, response), time.perf_counter() - sent)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed, rows_before, rows_after):
+    summary = {'elapsed_s': elapsed, 'throughput_rps': len(results) / elapsed, 'endpoints': {}}
+    for endpoint in ENDPOINTS:
+        latencies = [latency for path, _, latency in results if path == endpoint]
+        outcomes = {}
+        for path, outcome, _ in results:
+            if path == endpoint:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        summary['endpoints'][endpoint] = {
+            'requests': len(latencies),
+            'throughput_rps': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'outcomes': outcomes,
+            # Accepted requests, each one writes a row (or an outcome)
+            'writes_per_s': outcomes.get('ok', 0) / elapsed,
+        }
+    if rows_before is not None:
+        summary['db'] = {
+            'rows_written': rows_after[0] - rows_before[0],
+            'outcomes_written': rows_after[1] - rows_before[1],
+            'rows_per_s': (rows_after[0] - rows_before[0]) / elapsed,
+        }
+    return summary
+
+
+def print_summary(summary):
+    print("total {:8.1f} req/s over {:.1f}s".format(summary['throughput_rps'], summary['elapsed_s']))
+    for endpoint, stats in summary['endpoints'].items():
+        print("  {:<9} {:>6} req {:>8.1f} req/s  p50 {:7.2f} ms  p95 {:7.2f} ms  p99 {:7.2f} ms"
+              "  {:>7.1f} writes/s  {}".format(
+                  endpoint, stats['requests'], stats['throughput_rps'], stats['p50_ms'], stats['p95_ms'],
+                  stats['p99_ms'], stats['writes_per_s'], stats['outcomes']))
+    if 'db' in summary:
+        print("  database  {rows_written} rows and {outcomes_written} outcomes written, "
+              "{rows_per_s:.1f} rows/s".format(**summary['db']))
+
+
+def compare(summary, baseline, tolerance):
+    """
+        Returns the list of regressions of summary against baseline
+    """
+    regressions = []
+
+    def check(name, current, reference, higher_is_better):
+        if not reference:
+            return
+        change = current / reference - 1
+        worse = -change if higher_is_better else change
+        status = 'REGRESSION' if worse > tolerance else 'ok'
+        print("  {:<28} {:10.2f} vs {:10.2f}  {:+6.1%}  {}".format(name, current, reference, change, status))
+        if worse > tolerance:
+            regressions.append(name)
+
+    print("\ncompared with the baseline (tolerance {:.0%}):".format(tolerance))
+    for key in ('recording', 'target', 'concurrency', 'rate', 'requests'):
+        if summary['meta'].get(key) != baseline.get('meta', {}).get(key):
+            print("  warning: {} is {!r}, it was {!r} in the baseline".format(
+                key, summary['meta'].get(key), baseline.get('meta', {}).get(key)))
+    check('throughput_rps', summary['throughput_rps'], baseline['throughput_rps'], True)
+    for endpoint, stats in summary['endpoints'].items():
+        reference = baseline['endpoints'].get(endpoint, {})
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            check('{} {}'.format(endpoint, key), stats[key], reference.get(key), False)
+        if stats['outcomes'] != reference.get('outcomes'):
+            print("  {:<28} outcomes differ from the baseline: {} vs {}".format(
+                endpoint, stats['outcomes'], reference.get('outcomes')))
+    return regressions
+
+
+def run(args):
+    with open(args.recording) as fh:
+        requests = [json.loads(line) for line in fh if line.strip()]
+
+    tmpdir = None
+    if args.url is None and args.database_url is None:
+        tmpdir = tempfile.mkdtemp(prefix='bench_replay')
+        args.database_url = 'sqlite:///' + os.path.join(tmpdir, 'replay.db')
+
+    if args.url:
+        target, name = HttpTarget(args.url), args.url
+    elif args.launch:
+        target, name = launch_server(args), 'serve.py'
+    else:
+        target, name = InProcessTarget(args.database_url), 'in-process'
+
+    try:
+        rows_before = target.rows()
+        results, elapsed = replay(target, requests, args.concurrency, args.rate)
+        target.finish()
+        rows_after = target.rows()
+    finally:
+        target.close()
+
+    summary = summarize(results, elapsed, rows_before, rows_after)
+    summary['meta'] = {
+        'recording': args.recording, 'target': name, 'concurrency': args.concurrency, 'rate': args.rate,
+        'requests': len(requests), 'time': time.time(),
+    }
+    print("{} requests from {} against {} ({} threads{})".format(
+        len(requests), args.recording, name, args.concurrency, ', {} req/s'.format(args.rate) if args.rate else ''))
+    print_summary(summary)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fh:
+            json.dump(summary, fh, indent=1)
+        print("\nbaseline saved to {}".format(args.save_baseline))
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(summary, json.load(fh), args.tolerance)
+        if regressions:
+            print("\n{} regression(s): {}".format(len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    recorder = commands.add_parser('record', help="write a synthetic recording")
+    recorder.add_argument('recording')
+    recorder.add_argument('--predictions', type=int, default=5000)
+    recorder.add_argument('--invalid-ratio', type=float, default=0.05)
+    recorder.add_argument('--duplicate-ratio', type=float, default=0.02)
+    recorder.add_argument('--update-ratio', type=float, default=0.5, help="share of predictions with an outcome")
+    recorder.add_argument('--update-lag', type=int, default=200, help="predictions between one and its outcome")
+    recorder.add_argument('--seed', type=int, default=0)
+
+    runner = commands.add_parser('run', help="replay a recording")
+    runner.add_argument('recording')
+    runner.add_argument('--concurrency', type=int, default=8)
+    runner.add_argument('--rate', type=float, default=0, help="requests per second overall, 0 for no limit")
+    runner.add_argument('--url', help="base URL of a running server")
+    runner.add_argument('--launch', action='store_true', help="launch serve.py on a fresh database")
+    runner.add_argument('--workers', type=int, help="gunicorn workers of --launch")
+    runner.add_argument('--database-url', help="database of the in-process or launched service "
+                                               "(default: a fresh SQLite file)")
+    runner.add_argument('--timeout', type=float, default=120.0, help="seconds to wait for --launch")
+    runner.add_argument('--save-baseline', help="write the results to this JSON file")
+    runner.add_argument('--compare', help="baseline JSON file to compare with")
+    runner.add_argument('--tolerance', type=float, default=0.2, help="allowed relative slowdown")
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
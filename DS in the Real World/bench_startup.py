@@ -0,0 +1,129 @@
+"""
+Startup time and memory per worker of the service.
+
+Run it from the folder that contains the data/ directory:
+
+    python bench_startup.py --workers 4
+
+It measures, in fresh processes, the time to import app.py and to be ready
+with the eager and the lazy startup, then launches gunicorn with --workers
+workers with and without preload_app, waits until every worker answers
+GET /ready and reports the RSS and PSS (resident memory with the shared
+pages split between the processes sharing them) of each worker.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+IMPORT_SNIPPET = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+app.startup.start_in_background()
+app.startup.ready.wait()
+print(json.dumps({'import': imported, 'ready': time.perf_counter() - start}))
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def memory_kb(pid):
+    """
+        Returns:
+        - (rss, pss) of the process in kB, from /proc/<pid>/smaps_rollup
+    """
+    values = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as fh:
+        for line in fh:
+            parts = line.split()
+            if parts[0] in ('Rss:', 'Pss:'):
+                values[parts[0]] = int(parts[1])
+    return values['Rss:'], values['Pss:']
+
+
+def children(pid):
+    with open('/proc/{}/task/{}/children'.format(pid, pid)) as fh:
+        return [int(child) for child in fh.read().split()]
+
+
+def time_import(lazy, repeat):
+    env = dict(os.environ, LAZY_STARTUP='1' if lazy else '0')
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', IMPORT_SNIPPET], env=env)
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return {key: min(run[key] for run in runs) for key in ('import', 'ready')}
+
+
+def wait_ready(url, workers, timeout):
+    # Every request may land on any worker: wait until enough of them in a
+    # row say ready to have hit them all with a good probability
+    deadline = time.time() + timeout
+    seen, streak = set(), 0
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url + '/ready', timeout=5) as response:
+                seen.add(json.loads(response.read())['pid'])
+                streak += 1
+        except (urllib.error.URLError, ConnectionError, OSError):
+            streak = 0
+            time.sleep(0.1)
+        if len(seen) >= workers and streak >= 4 * workers:
+            return True
+    return False
+
+
+def run_gunicorn(args, preload):
+    port = free_port()
+    env = dict(os.environ, WEB_CONCURRENCY=str(args.workers), PRELOAD_APP='1' if preload else '0',
+               LAZY_STARTUP='0' if preload else '1', BIND='127.0.0.1:{}'.format(port))
+    start = time.perf_counter()
+    master = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_ready('http://127.0.0.1:{}'.format(port), args.workers, args.timeout):
+            raise RuntimeError("gunicorn did not get ready in {}s".format(args.timeout))
+        elapsed = time.perf_counter() - start
+        workers = [memory_kb(pid) for pid in children(master.pid)]
+        return elapsed, memory_kb(master.pid), workers
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each import measure")
+    parser.add_argument('--timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    for lazy in (False, True):
+        times = time_import(lazy, args.repeat)
+        print("{:<14} import {:6.2f}s  ready {:6.2f}s".format(
+            'lazy startup' if lazy else 'eager startup', times['import'], times['ready']))
+
+    for preload in (True, False):
+        elapsed, master, workers = run_gunicorn(args, preload)
+        print("\ngunicorn, {} workers, {} (ready in {:.1f}s)".format(
+            args.workers, 'preload' if preload else 'no preload', elapsed))
+        print("  master    RSS {:8.1f} MB  PSS {:8.1f} MB".format(master[0] / 1024, master[1] / 1024))
+        for rss, pss in workers:
+            print("  worker    RSS {:8.1f} MB  PSS {:8.1f} MB".format(rss / 1024, pss / 1024))
+        print("  total PSS {:8.1f} MB".format((master[1] + sum(pss for _, pss in workers)) / 1024))
+
+
+if __name__ == '__main__':
+    main()
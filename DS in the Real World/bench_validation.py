@@ -0,0 +1,94 @@
+"""
+Microbenchmark of the request validation: the original check_request /
+check_categorical_values / check_numerical_values chain against the compiled
+ObservationSchema used by the service.
+
+Run it from the folder that contains the data/ directory:
+
+    python bench_validation.py --n 20000
+"""
+import argparse
+import random
+import time
+
+import app
+
+
+def make_observation(i, rng):
+    observation = {}
+    for key in app.columns:
+        if key in app.valid_category_map:
+            observation[key] = rng.choice(app.valid_category_map[key])
+        elif key in app.valid_num_range:
+            low, high = app.valid_num_range[key]
+            # Float ranges such as hemoglobin_level (10.9, 18.1) have float
+            # bounds, randint on the truncated ones goes out of range
+            if isinstance(low, float):
+                observation[key] = round(rng.uniform(low, high), 1)
+            else:
+                observation[key] = rng.randint(low, high)
+        else:
+            observation[key] = i
+    return observation
+
+
+def make_invalid(observation, rng):
+    # Invalid values in the long diag_* lists are the worst case of the
+    # original functions: a full list scan plus the joined error message
+    observation = dict(observation)
+    observation[rng.choice(['diag_1', 'diag_2', 'diag_3'])] = 'XXX'
+    observation['hemoglobin_level'] = 99.0
+    return observation
+
+
+def legacy_validate(observation):
+    for check in (app.check_request, app.check_categorical_values, app.check_numerical_values):
+        ok, error = check(observation)
+        if not ok:
+            return error
+    return ""
+
+
+def timed(func, observations, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(observations)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--n', type=int, default=20000, help="observations per run")
+    parser.add_argument('--invalid-ratio', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    observations = []
+    for i in range(args.n):
+        observation = make_observation(i, rng)
+        if rng.random() < args.invalid_ratio:
+            observation = make_invalid(observation, rng)
+        observations.append(observation)
+
+    legacy = [bool(legacy_validate(o)) for o in observations]
+    compiled = [bool(app.schema.validate(o)) for o in observations]
+    assert legacy == compiled, "the schema does not accept the same observations"
+
+    runs = [
+        ('legacy functions', lambda obs: [legacy_validate(o) for o in obs]),
+        ('schema.validate', lambda obs: [app.schema.validate(o) for o in obs]),
+        ('schema.validate_batch', app.schema.validate_batch),
+    ]
+    baseline = None
+    for name, func in runs:
+        elapsed = timed(func, observations, args.repeat)
+        baseline = baseline or elapsed
+        print("{:<22} {:>8.2f} us/obs {:>6.2f}x".format(
+            name, elapsed / args.n * 1e6, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Exports the stored predictions, their outcome and their features for
+retraining or auditing, without loading the whole table in memory.
+
+Run it from the folder of the service (same DATABASE_URL and MODEL_DIR):
+
+    python export.py predictions.parquet
+    python export.py predictions.csv --chunk-size 50000
+    python export.py new.parquet --after-id 120000
+
+The features are cast to the dtypes of the model in MODEL_DIR when there is
+one. The id of the last exported row is printed, pass it as --after-id to
+export only the rows stored since.
+"""
+import argparse
+import os
+import pickle
+import time
+
+# Only the database is needed, not the models
+os.environ.setdefault('LAZY_STARTUP', '1')
+
+import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help="output file, .parquet (needs pyarrow) or .csv")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="rows read per query")
+    parser.add_argument('--after-id', type=int, default=0, help="only export the rows after this id")
+    args = parser.parse_args()
+
+    app.create_tables()
+
+    dtypes = None
+    dtypes_path = os.path.join(app.MODEL_DIR, 'dtypes.pickle')
+    if os.path.exists(dtypes_path):
+        with open(dtypes_path, 'rb') as fh:
+            dtypes = pickle.load(fh)
+
+    start = time.perf_counter()
+    written, last_id = app.export_predictions(args.path, args.chunk_size, args.after_id, dtypes)
+    elapsed = time.perf_counter() - start
+    print("Exported {} rows to {} in {:.1f}s ({:.0f} rows/s), last id {}".format(
+        written, args.path, elapsed, written / elapsed if elapsed else 0.0, last_id))
+
+
+if __name__ == '__main__':
+    main()
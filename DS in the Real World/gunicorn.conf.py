@@ -0,0 +1,79 @@
+"""
+gunicorn settings of the service, used by serve.py:
+
+    python serve.py
+    gunicorn -c gunicorn.conf.py app:app
+
+Every setting can be overridden through the environment:
+
+- WEB_CONCURRENCY: worker processes (default: one per CPU, at most 8)
+- GUNICORN_THREADS: threads per worker (default 4). The model releases the
+  GIL for most of a prediction and the requests also wait on the database,
+  so a few threads per worker keep the CPUs busy
+- GUNICORN_KEEPALIVE: seconds an idle keep-alive connection is kept open
+- GUNICORN_TIMEOUT: seconds before a silent worker is killed and restarted
+- GUNICORN_MAX_REQUESTS: restart a worker after that many requests (0: never)
+- BIND or PORT: address to listen on (default 0.0.0.0:5000)
+
+The app is preloaded: app.py is imported, the model loaded and warmed up once
+in the master, then the workers are forked and share it copy-on-write.
+With PRELOAD_APP=0 (which sets LAZY_STARTUP=1 unless it is already set) or
+LAZY_STARTUP=1 each worker loads the model itself after the fork, in the
+background, and answers 503 until GET /ready says it is ready.
+
+Every worker has its own model registry: the model admin endpoints (POST
+/models, /models/routing) publish their changes to MODEL_SYNC_FILE, a file
+created for the lifetime of the server, that the workers poll every
+MODEL_SYNC_INTERVAL seconds (default 2) to load the same models and apply
+the same routing.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('BIND', '0.0.0.0:{}'.format(os.environ.get('PORT', 5000)))
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 8)))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+preload_app = os.environ.get('PRELOAD_APP', '1') != '0'
+if not preload_app:
+    # Each worker imports app.py after the fork: load the model in the
+    # background instead of blocking the import (and the worker boot)
+    os.environ.setdefault('LAZY_STARTUP', '1')
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+
+# Read by app.py in the master and inherited by the workers
+if not os.environ.get('MODEL_SYNC_FILE'):
+    sync_dir = tempfile.mkdtemp(prefix='model-sync-')
+    os.environ['MODEL_SYNC_FILE'] = os.path.join(sync_dir, 'models.json')
+else:
+    sync_dir = None
+
+
+def when_ready(server):
+    # Runs in the master once the app is preloaded, before the first fork
+    if preload_app:
+        import app
+        app.prepare_for_fork()
+
+
+def post_worker_init(worker):
+    import app
+    if not app.startup.ready.is_set():
+        app.startup.start_in_background()
+    # A worker started after model changes (e.g. after max_requests) catches
+    # up as soon as its startup is done
+    if app.model_sync is not None:
+        app.model_sync.ensure_started()
+
+
+def on_exit(server):
+    if sync_dir is not None:
+        shutil.rmtree(sync_dir, ignore_errors=True)
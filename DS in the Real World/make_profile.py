@@ -0,0 +1,70 @@
+"""
+Builds the reference profile of a model bundle from its training data: the
+distribution of every feature, saved as profile.json next to
+pipeline.pickle. The drift monitor of the service compares the scored
+traffic against it (GET /drift).
+
+Run it from the folder of the service:
+
+    python make_profile.py data/train.csv
+    python make_profile.py train.parquet --model-dir models/v2 --bins 20
+
+The input is read chunk by chunk like score.py does and profiled as it is
+read, only counts and a sketch of each numerical feature are kept in
+memory (see app.ReferenceProfileBuilder).
+"""
+import argparse
+import json
+import os
+import pickle
+
+import pandas as pd
+
+# Only the model files are needed, not the database
+os.environ.setdefault('LAZY_STARTUP', '1')
+
+import app
+import score
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('input', help="training data: .csv, .ndjson/.jsonl or .parquet")
+    parser.add_argument('--format', choices=['csv', 'ndjson', 'parquet'], help="input format if not the extension")
+    parser.add_argument('--model-dir', default=app.MODEL_DIR, help="bundle folder to save the profile in")
+    parser.add_argument('--bins', type=int, default=10, help="quantile bins per numerical feature")
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--max-points', type=int, default=4096,
+                        help="values kept per numerical feature, past it the quantiles are approximate")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.model_dir, 'columns.json')) as fh:
+        columns = json.load(fh)
+    with open(os.path.join(args.model_dir, 'dtypes.pickle'), 'rb') as fh:
+        dtypes = pickle.load(fh)
+
+    input_format = args.format or os.path.splitext(args.input)[1].lstrip('.').lower()
+    input_format = {'jsonl': 'ndjson', 'json': 'ndjson'}.get(input_format, input_format)
+    if input_format == 'csv':
+        chunks = score.read_csv(args.input, args.chunk_size, dtypes)
+    elif input_format == 'ndjson':
+        chunks = score.read_ndjson(args.input, args.chunk_size)
+    elif input_format == 'parquet':
+        chunks = score.read_parquet(args.input, args.chunk_size)
+    else:
+        parser.error("unknown input format {!r}, use --format".format(input_format))
+
+    builder = app.ReferenceProfileBuilder(columns, dtypes, bins=args.bins, max_points=args.max_points)
+    for chunk in chunks:
+        builder.update(pd.DataFrame(score.chunk_records(chunk)))
+
+    profile = builder.profile()
+    path = os.path.join(args.model_dir, app.REFERENCE_PROFILE)
+    with open(path, 'w') as fh:
+        json.dump(profile, fh, indent=1)
+    print("Profiled {} rows, {} numerical and {} categorical features, saved to {}".format(
+        profile['rows'], len(profile['numeric']), len(profile['categorical']), path))
+
+
+if __name__ == '__main__':
+    main()
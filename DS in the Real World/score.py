@@ -0,0 +1,236 @@
+"""
+Offline batch scoring of admissions with the model and the validation of
+the service, for historical rescoring without going through HTTP.
+
+Run it from the folder of the service:
+
+    python score.py admissions.csv predictions.csv
+    python score.py admissions.ndjson predictions.parquet --workers 4 --chunk-size 20000
+
+The input (CSV, newline-delimited JSON or Parquet, by extension or
+--format) is read chunk by chunk, each chunk is validated and scored with
+one vectorized model call, and the predictions are appended to the output
+(CSV or Parquet). The records that fail validation are written to
+--errors (newline-delimited JSON, default <output>.errors.ndjson) with
+the same messages /predict would answer. With --workers the chunks are
+scored by a process pool; at most two chunks per worker are in flight, so
+memory stays bounded whatever the size of the input.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+from collections import deque
+
+import pandas as pd
+
+# Only the model is needed, not the database
+os.environ.setdefault('LAZY_STARTUP', '1')
+
+import app
+
+bundle = None
+
+
+def load_bundle(model_dir):
+    global bundle
+    bundle = app.ModelBundle(model_dir)
+    bundle.warm_up()
+
+
+def read_csv(path, chunk_size, dtypes):
+    # Categories such as 'None' or 'NaN' are values of the model, only an
+    # empty numerical cell is missing
+    text_columns = [key for key, dtype in dtypes.items() if dtype.kind == 'O']
+    numeric_columns = [key for key, dtype in dtypes.items() if dtype.kind in 'iuf']
+    return pd.read_csv(path, chunksize=chunk_size, keep_default_na=False,
+                       na_values={key: [''] for key in numeric_columns},
+                       dtype={key: str for key in text_columns})
+
+
+def read_ndjson(path, chunk_size):
+    # Lines are parsed by the scoring side, in the pool when there is one
+    with open(path) as fh:
+        lines = []
+        for line in fh:
+            if line.strip():
+                lines.append(line)
+            if len(lines) == chunk_size:
+                yield lines
+                lines = []
+        if lines:
+            yield lines
+
+
+def read_parquet(path, chunk_size):
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet input needs pyarrow: pip install pyarrow")
+    return pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size)
+
+
+def chunk_records(chunk):
+    """
+        Returns the observations of a chunk of any of the readers as dicts
+    """
+    if isinstance(chunk, pd.DataFrame):
+        # An empty numerical cell is a missing value, None like a null in
+        # the other formats, so that it fails the validation the same way
+        records = chunk.to_dict('records')
+        missing = [key for key in chunk.columns if chunk[key].hasnans]
+        for record in records if missing else ():
+            for key in missing:
+                if record[key] != record[key]:
+                    record[key] = None
+        return records
+    if hasattr(chunk, 'to_pylist'):
+        return chunk.to_pylist()
+    records = []
+    for line in chunk:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            records.append(None)
+    return records
+
+
+def score_chunk(chunk, first_row):
+    """
+        Validates and scores a chunk of observations with the bundle loaded in
+        this process
+
+        Returns:
+        - DataFrame of the predictions (row, admission_id, readmitted)
+        - list of the validation errors, one dict per invalid record
+    """
+    records = chunk_records(chunk)
+    valid, errors = [], []
+    for i, (record, record_errors) in enumerate(zip(records, bundle.schema.validate_batch(records))):
+        if record_errors:
+            error = {'row': first_row + i, 'error': app.format_errors(record_errors)}
+            if isinstance(record, dict) and 'admission_id' in record:
+                error['admission_id'] = record['admission_id']
+            errors.append(error)
+        else:
+            valid.append(i)
+
+    observations = [records[i] for i in valid]
+    predictions = bundle.predict(observations) if observations else []
+    scored = pd.DataFrame({
+        'row': [first_row + i for i in valid],
+        'admission_id': [observation['admission_id'] for observation in observations],
+        'readmitted': list(predictions),
+    })
+    return scored, errors
+
+
+class OutputWriter:
+    """
+        Appends the scored chunks to a CSV or Parquet file and the errors to
+        a newline-delimited JSON file
+    """
+
+    def __init__(self, path, errors_path, version):
+        self.path = path
+        self.version = version
+        self.parquet = path.endswith('.parquet')
+        self.parquet_writer = None
+        self.rows = 0
+        self.errors = 0
+        self.errors_file = open(errors_path, 'w')
+
+    def write(self, scored, errors):
+        scored['model_version'] = self.version
+        if self.parquet:
+            import pyarrow
+            import pyarrow.parquet
+            if self.parquet_writer is None:
+                # Not inferred from the first chunk, which can be empty when
+                # all of its records are invalid
+                schema = pyarrow.schema([('row', pyarrow.int64()), ('admission_id', pyarrow.int64()),
+                                         ('readmitted', pyarrow.string()), ('model_version', pyarrow.string())])
+                self.parquet_writer = pyarrow.parquet.ParquetWriter(self.path, schema)
+            self.parquet_writer.write_table(pyarrow.Table.from_pandas(
+                scored, schema=self.parquet_writer.schema, preserve_index=False))
+        else:
+            scored.to_csv(self.path, mode='a' if self.rows else 'w', header=not self.rows, index=False)
+        for error in errors:
+            self.errors_file.write(json.dumps(error) + '\n')
+        self.rows += len(scored) + len(errors)
+        self.errors += len(errors)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        self.errors_file.close()
+
+
+def scored_chunks(chunks, workers, model_dir):
+    """
+        Scores the chunks in order, in this process or in a pool of workers
+        processes with at most two chunks per worker in flight
+    """
+    first_row = 0
+    if workers <= 1:
+        for chunk in chunks:
+            yield score_chunk(chunk, first_row)
+            first_row += len(chunk)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=load_bundle,
+                                                initargs=(model_dir,)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(score_chunk, chunk, first_row))
+            first_row += len(chunk)
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('input', help="admissions to score: .csv, .ndjson/.jsonl or .parquet")
+    parser.add_argument('output', help="predictions: .csv or .parquet (needs pyarrow)")
+    parser.add_argument('--format', choices=['csv', 'ndjson', 'parquet'], help="input format if not the extension")
+    parser.add_argument('--errors', help="validation errors output (default <output>.errors.ndjson)")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="records scored per model call")
+    parser.add_argument('--workers', type=int, default=1, help="scoring processes")
+    parser.add_argument('--model-dir', default=app.MODEL_DIR)
+    args = parser.parse_args()
+
+    input_format = args.format or os.path.splitext(args.input)[1].lstrip('.').lower()
+    input_format = {'jsonl': 'ndjson', 'json': 'ndjson'}.get(input_format, input_format)
+
+    load_bundle(args.model_dir)
+    if input_format == 'csv':
+        chunks = read_csv(args.input, args.chunk_size, bundle.dtypes)
+    elif input_format == 'ndjson':
+        chunks = read_ndjson(args.input, args.chunk_size)
+    elif input_format == 'parquet':
+        chunks = read_parquet(args.input, args.chunk_size)
+    else:
+        parser.error("unknown input format {!r}, use --format".format(input_format))
+
+    output = OutputWriter(args.output, args.errors or args.output + '.errors.ndjson', bundle.version)
+    start = time.perf_counter()
+    try:
+        for scored, errors in scored_chunks(chunks, args.workers, args.model_dir):
+            output.write(scored, errors)
+            elapsed = time.perf_counter() - start
+            print("\r{} rows, {} errors, {:.0f} rows/s".format(output.rows, output.errors, output.rows / elapsed),
+                  end='', file=sys.stderr)
+    finally:
+        output.close()
+    elapsed = time.perf_counter() - start
+    print("\nScored {} rows ({} invalid) with model {} in {:.1f}s: {:.0f} rows/s".format(
+        output.rows, output.errors, bundle.version, elapsed, output.rows / elapsed if elapsed else 0.0),
+        file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""
+Production entry point of the service: runs app:app under gunicorn with the
+settings of gunicorn.conf.py (workers, threads, keep-alive, preload).
+
+    python serve.py
+    WEB_CONCURRENCY=4 GUNICORN_THREADS=8 python serve.py
+
+Extra arguments are passed to gunicorn and take precedence over the config
+file, e.g. python serve.py --bind 127.0.0.1:8000 --workers 2
+"""
+import os
+import sys
+
+from gunicorn.app.wsgiapp import WSGIApplication
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    sys.argv = [sys.argv[0], '--config', os.path.join(HERE, 'gunicorn.conf.py')] + sys.argv[1:] + ['app:app']
+    WSGIApplication("%(prog)s [OPTIONS]").run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+# app.py reads its configuration when it is imported: a throwaway SQLite
+# database and no startup (the tests that need the models load them)
+_db_dir = tempfile.mkdtemp(prefix='ds-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_db_dir, 'predictions.db')
+os.environ['LAZY_STARTUP'] = '1'
+os.environ.pop('WRITE_BEHIND', None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Flask test client, startup marked as done: the tests that need the
+    # models load them
+    import app
+    ready = threading.Event()
+    ready.set()
+    monkeypatch.setattr(app.startup, 'ready', ready)
+    return app.app.test_client()
@@ -0,0 +1,37 @@
+import pytest
+
+import app
+
+ADMIN_REQUESTS = [
+    ('/models', {'path': '/tmp'}),
+    ('/models/routing', {'default': 'v1'}),
+    ('/profile', {'requests': 1}),
+]
+
+
+@pytest.mark.parametrize('path, payload', ADMIN_REQUESTS)
+def test_closed_without_admin_token(client, monkeypatch, path, payload):
+    monkeypatch.delenv('ADMIN_TOKEN', raising=False)
+    response = client.post(path, json=payload, headers={'X-Admin-Token': ''})
+    assert response.status_code == 403
+    assert response.get_json() == {'error': 'Not allowed'}
+
+
+@pytest.mark.parametrize('path, payload', ADMIN_REQUESTS)
+def test_wrong_admin_token(client, monkeypatch, path, payload):
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    for headers in ({}, {'X-Admin-Token': 'guess'}):
+        assert client.post(path, json=payload, headers=headers).status_code == 403
+
+
+def test_admin_token(client, monkeypatch):
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    response = client.post('/models', json={'path': '/nonexistent'}, headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 200
+    assert 'pipeline.pickle' in response.get_json()['error']
+
+
+def test_forced_profile_needs_admin_token(client, monkeypatch):
+    monkeypatch.delenv('ADMIN_TOKEN', raising=False)
+    response = client.get('/ready', headers={'X-Profile': '1'})
+    assert 'X-Profile-Name' not in response.headers
@@ -0,0 +1,124 @@
+import json
+import pickle
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.compose import ColumnTransformer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+import app
+
+NUMERIC = ['num_lab_procedures', 'time_in_hospital']
+CATEGORICAL = ['race', 'gender']
+COLUMNS = ['admission_id'] + NUMERIC + CATEGORICAL
+DTYPES = pd.Series([np.dtype('int64')] * 3 + [np.dtype('O')] * 2, index=COLUMNS)
+
+
+@pytest.fixture(scope='module')
+def bundle(tmp_path_factory):
+    # A small model bundle on the columns above, the default of the registry
+    path = tmp_path_factory.mktemp('bundle')
+    train = pd.DataFrame(app.synthetic_observations(200, seed=1, feature_columns=COLUMNS)).astype(DTYPES)
+    preprocessor = ColumnTransformer([('numeric', StandardScaler(), NUMERIC),
+                                      ('categorical', OneHotEncoder(handle_unknown='ignore'), CATEGORICAL)])
+    pipeline = Pipeline([('preprocess', preprocessor), ('model', LogisticRegression())])
+    pipeline.fit(train, np.where(np.arange(len(train)) % 3 == 0, 'Yes', 'No'))
+    joblib.dump(pipeline, str(path / 'pipeline.pickle'))
+    with open(str(path / 'columns.json'), 'w') as fh:
+        json.dump(COLUMNS, fh)
+    with open(str(path / 'dtypes.pickle'), 'wb') as fh:
+        pickle.dump(DTYPES, fh)
+
+    app.create_tables()
+    return app.registry.load(str(path), 'test', activate=True)
+
+
+@pytest.fixture
+def predictions(bundle, client):
+    with app.DB.connection_context():
+        app.Prediction.delete().execute()
+    return client
+
+
+def observations(first_id, n):
+    observations = app.synthetic_observations(n, seed=first_id, feature_columns=COLUMNS)
+    for i, observation in enumerate(observations):
+        observation['admission_id'] = first_id + i
+    return observations
+
+
+def stored():
+    with app.DB.connection_context():
+        return dict(app.Prediction.select(app.Prediction.admission_id, app.Prediction.actual_readmitted).tuples())
+
+
+def test_predict_batch(predictions):
+    batch = observations(1, 3)
+    invalid = dict(observations(10, 1)[0], time_in_hospital='long')
+    results = predictions.post('/predict_batch', json=batch + [invalid, batch[0], 'nope']).get_json()
+
+    assert [result.get('admission_id') for result in results] == [1, 2, 3, 10, 1, None]
+    assert all(result['readmitted'] in ('Yes', 'No') and 'error' not in result for result in results[:3])
+    assert 'time_in_hospital' in results[3]['error']
+    assert results[4]['error'] == "ERROR: Observation Id: '1' already exists"
+    assert results[5] == {'error': 'Observation must be a JSON object'}
+    assert set(stored()) == {1, 2, 3}
+
+    # An id stored by an earlier request
+    results = predictions.post('/predict_batch', json=observations(3, 2)).get_json()
+    assert results[0]['error'] == "ERROR: Observation Id: '3' already exists"
+    assert 'error' not in results[1]
+    assert set(stored()) == {1, 2, 3, 4}
+
+
+def test_predict_batch_ndjson(predictions):
+    body = '\n'.join(json.dumps(observation) for observation in observations(1, 2)) + '\nnot json\n'
+    results = predictions.post('/predict_batch', data=body, content_type='application/x-ndjson').get_json()
+    assert [result.get('admission_id') for result in results] == [1, 2, None]
+    assert 'error' in results[2]
+    assert set(stored()) == {1, 2}
+
+    response = predictions.post('/predict_batch', data='{"admission_id": 1}', content_type='application/json')
+    assert 'error' in response.get_json()[0]
+    response = predictions.post('/predict_batch', data='[1, 2', content_type='application/json')
+    assert response.get_json() == {'error': "Expected a JSON array or newline-delimited JSON observations"}
+
+
+def test_update_batch(predictions):
+    predictions.post('/predict_batch', json=observations(2001, 3))
+    records = [
+        {'admission_id': 2001, 'readmitted': 'Yes'},
+        {'admission_id': '2002', 'readmitted': 'No'},
+        {'admission_id': 2003, 'readmitted': True},
+        {'admission_id': 9999, 'readmitted': 'No'},
+        {'admission_id': [1], 'readmitted': 'No'},
+        {'admission_id': {'id': 1}, 'readmitted': 'No'},
+        {'admission_id': 'abc', 'readmitted': 'No'},
+        {'readmitted': 'No'},
+        'nope',
+    ]
+    response = predictions.post('/update_batch', json=records)
+    assert response.status_code == 200
+    results = response.get_json()
+
+    assert [result.get('status') for result in results] == ['updated', 'updated', 'updated', 'unknown'] + [None] * 5
+    assert results[1]['admission_id'] == '2002'
+    assert results[2]['actual_readmitted'] == 'True'
+    assert results[3]['error'] == 'Admission Id: "9999" does not exist'
+    error = "Expected an object with an integer admission_id and readmitted"
+    assert results[4] == {'admission_id': [1], 'error': error}
+    assert results[5] == {'admission_id': {'id': 1}, 'error': error}
+    assert results[6] == {'admission_id': 'abc', 'error': error}
+    assert results[7] == results[8] == {'error': error}
+    assert stored() == {2001: 'Yes', 2002: 'No', 2003: 'True'}
+
+    # Unchanged outcomes, and the last outcome of a repeated id wins
+    results = predictions.post('/update_batch', json=[{'admission_id': 2001, 'readmitted': 'Yes'},
+                                                      {'admission_id': 2002, 'readmitted': 'Yes'},
+                                                      {'admission_id': 2002, 'readmitted': 'No'}]).get_json()
+    assert results[0]['status'] == 'unchanged'
+    assert stored()[2002] == 'No'
@@ -0,0 +1,159 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.compose import ColumnTransformer
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+import app
+
+NUMERIC = ['hemoglobin_level', 'num_lab_procedures', 'time_in_hospital', 'number_diagnoses']
+CATEGORICAL = ['race', 'gender', 'payer_code', 'diag_1']
+COLUMNS = ['admission_id'] + NUMERIC + CATEGORICAL
+DTYPES = pd.Series(
+    [np.dtype('int64'), np.dtype('float64')] + [np.dtype('int64')] * 3 + [np.dtype('O')] * len(CATEGORICAL),
+    index=COLUMNS)
+
+
+def observations(n, seed=0):
+    return app.synthetic_observations(n, seed=seed, feature_columns=COLUMNS)
+
+
+def with_missing_values(observations):
+    # NaN and None in numerical and categorical columns, imputed by the pipeline
+    observations = [dict(o) for o in observations]
+    for i, observation in enumerate(observations[::5]):
+        observation['hemoglobin_level'] = float('nan') if i % 2 else None
+        observation[CATEGORICAL[i % len(CATEGORICAL)]] = None
+    return observations
+
+
+def with_unknown_categories(observations):
+    observations = [dict(o) for o in observations]
+    for i, observation in enumerate(observations[::3]):
+        observation[CATEGORICAL[i % len(CATEGORICAL)]] = 'not-a-category'
+    return observations
+
+
+def frame(observations, columns=COLUMNS, dtypes=DTYPES):
+    return pd.DataFrame(observations, columns=columns).astype(dtypes)
+
+
+def fit_pipeline(sparse_threshold, handle_unknown='ignore'):
+    train = with_missing_values(observations(400, seed=1))
+    numeric = Pipeline([('impute', SimpleImputer(strategy='median')), ('scale', StandardScaler())])
+    categorical = Pipeline([('impute', SimpleImputer(strategy='most_frequent')),
+                            ('onehot', OneHotEncoder(handle_unknown=handle_unknown))])
+    preprocessor = ColumnTransformer([('numeric', numeric, NUMERIC), ('categorical', categorical, CATEGORICAL)],
+                                     remainder='drop', sparse_threshold=sparse_threshold)
+    pipeline = Pipeline([('preprocess', preprocessor), ('model', LogisticRegression(max_iter=500))])
+    target = np.where(np.arange(len(train)) % 3 == 0, 'Yes', 'No')
+    return pipeline.fit(frame(train), target)
+
+
+def dense(matrix):
+    return matrix.toarray() if hasattr(matrix, 'toarray') else np.asarray(matrix)
+
+
+@pytest.fixture(params=[0.0, 1.0], ids=['dense', 'sparse'])
+def pipeline(request):
+    return fit_pipeline(request.param)
+
+
+@pytest.mark.parametrize('make', [lambda n: observations(n, seed=2),
+                                  lambda n: with_missing_values(observations(n, seed=3)),
+                                  lambda n: with_unknown_categories(observations(n, seed=4))],
+                         ids=['valid', 'missing', 'unknown'])
+def test_encoded_matrix_parity(pipeline, make):
+    compiled = app.CompiledPipeline(pipeline, COLUMNS, DTYPES)
+    batch = make(200)
+    expected = dense(pipeline[:-1].transform(frame(batch)))
+
+    np.testing.assert_array_equal(dense(compiled.transform(batch)), expected)
+    for i, observation in enumerate(batch):
+        np.testing.assert_array_equal(dense(compiled.transform([observation]))[0], expected[i])
+
+
+@pytest.mark.parametrize('make', [lambda n: observations(n, seed=5),
+                                  lambda n: with_missing_values(observations(n, seed=6)),
+                                  lambda n: with_unknown_categories(observations(n, seed=7))],
+                         ids=['valid', 'missing', 'unknown'])
+def test_prediction_parity(pipeline, make):
+    compiled = app.CompiledPipeline(pipeline, COLUMNS, DTYPES)
+    batch = make(200)
+    expected = list(pipeline.predict(frame(batch)))
+
+    assert list(compiled.predict(batch)) == expected
+    assert [compiled.predict([observation])[0] for observation in batch] == expected
+
+
+def test_unknown_category_error():
+    pipeline = fit_pipeline(1.0, handle_unknown='error')
+    compiled = app.CompiledPipeline(pipeline, COLUMNS, DTYPES)
+    batch = with_unknown_categories(observations(3))
+    with pytest.raises(ValueError):
+        pipeline.predict(frame(batch))
+    with pytest.raises(ValueError):
+        compiled.predict(batch)
+
+
+def test_unsupported_step():
+    pipeline = Pipeline([('preprocess', ColumnTransformer([('numeric', 'passthrough', NUMERIC)])),
+                         ('model', LogisticRegression())])
+    pipeline.steps.insert(0, ('other', StandardScaler()))
+    with pytest.raises(app.UnsupportedPipeline):
+        app.CompiledPipeline(pipeline, COLUMNS, DTYPES)
+
+
+def bundle(pipeline):
+    return SimpleNamespace(pipeline=pipeline, columns=COLUMNS, dtypes=DTYPES, path='test')
+
+
+def test_compile_pipeline():
+    assert isinstance(app.compile_pipeline(bundle(fit_pipeline(1.0))), app.CompiledPipeline)
+
+
+def test_compile_unsupported_pipeline():
+    pipeline = fit_pipeline(1.0)
+    pipeline.steps.insert(0, ('other', StandardScaler()))
+    assert app.compile_pipeline(bundle(pipeline)) is None
+
+
+def test_compile_pipeline_parity_mismatch(monkeypatch):
+    monkeypatch.setattr(app.CompiledPipeline, 'predict', lambda self, observations: ['Maybe'] * len(observations))
+    assert app.compile_pipeline(bundle(fit_pipeline(1.0))) is None
+
+
+def test_compile_pipeline_bug_is_raised(monkeypatch):
+    def broken(self, observations):
+        raise AttributeError("bug")
+    monkeypatch.setattr(app.CompiledPipeline, 'transform', broken)
+    with pytest.raises(AttributeError):
+        app.compile_pipeline(bundle(fit_pipeline(1.0)))
+
+
+def test_model_bundle_parity():
+    # The deployed model, when its files are there
+    model_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), app.MODEL_DIR)
+    if not os.path.exists(os.path.join(model_dir, 'pipeline.pickle')):
+        pytest.skip("no model bundle in {}".format(model_dir))
+    bundle = app.ModelBundle(model_dir)
+    if bundle.compiled is None:
+        pytest.skip("the pipeline of {} is not supported by CompiledPipeline".format(model_dir))
+
+    batch = app.synthetic_observations(1000, seed=8, feature_columns=bundle.columns)
+    float_keys = [key for key in app.valid_num_range if bundle.dtypes[key].kind == 'f']
+    for i, observation in enumerate(batch[::4]):
+        observation[float_keys[i % len(float_keys)]] = float('nan')
+    pandas_frame = frame(batch, bundle.columns, bundle.dtypes)
+
+    expected = dense(bundle.pipeline[:-1].transform(pandas_frame))
+    np.testing.assert_array_equal(dense(bundle.compiled.transform(batch)), expected)
+    expected = list(bundle.pipeline.predict(pandas_frame))
+    assert list(bundle.compiled.predict(batch)) == expected
+    assert [bundle.compiled.predict([observation])[0] for observation in batch[:200]] == expected[:200]
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+import app
+
+NUMERIC = ['hemoglobin_level', 'num_lab_procedures', 'time_in_hospital']
+CATEGORICAL = ['race', 'diag_1']
+COLUMNS = ['admission_id'] + NUMERIC + CATEGORICAL
+DTYPES = pd.Series([np.dtype('int64'), np.dtype('float64')] + [np.dtype('int64')] * 2 + [np.dtype('O')] * 2,
+                   index=COLUMNS)
+
+
+def training_frame(n=5000):
+    observations = app.synthetic_observations(n, seed=0, feature_columns=COLUMNS)
+    for observation in observations[::7]:
+        observation['hemoglobin_level'] = float('nan')
+    return pd.DataFrame(observations, columns=COLUMNS)
+
+
+def test_chunked_profile_matches():
+    frame = training_frame()
+    expected = app.build_reference_profile(frame, DTYPES)
+    builder = app.ReferenceProfileBuilder(COLUMNS, DTYPES)
+    for start in range(0, len(frame), 700):
+        builder.update(frame.iloc[start:start + 700])
+    profile = builder.profile()
+
+    assert profile['rows'] == expected['rows']
+    assert profile['categorical'] == expected['categorical']
+    for key, spec in expected['numeric'].items():
+        np.testing.assert_allclose(profile['numeric'][key]['edges'], spec['edges'])
+        np.testing.assert_allclose(profile['numeric'][key]['proportions'], spec['proportions'])
+
+
+def test_compacted_sketch():
+    frame = training_frame()
+    expected = app.build_reference_profile(frame, DTYPES)
+    builder = app.ReferenceProfileBuilder(COLUMNS, DTYPES, max_points=200)
+    for start in range(0, len(frame), 700):
+        builder.update(frame.iloc[start:start + 700])
+    profile = builder.profile()
+
+    for key, spec in expected['numeric'].items():
+        assert len(builder.sketches[key][0]) <= 200
+        proportions = profile['numeric'][key]['proportions']
+        assert abs(sum(proportions) - 1) < 1e-9
+        assert proportions[-1] == spec['proportions'][-1]
+        assert app.psi(spec['proportions'], proportions) < 0.01
+
+
+def test_scores_rotate_after_a_quiet_period(monkeypatch):
+    monitor = app.DriftMonitor(app.build_reference_profile(training_frame(), DTYPES), window_seconds=60)
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'time', lambda: now[0])
+    monitor._new_window()
+    monitor.update(app.synthetic_observations(50, seed=1, feature_columns=COLUMNS))
+    assert monitor.scores()['observations'] == 50
+
+    # The previous window still counts as recent traffic
+    now[0] += 90
+    assert monitor.scores()['observations'] == 50
+    now[0] += 100
+    scores = monitor.scores()
+    assert scores['observations'] == 0
+    assert scores['observations_since_start'] == 50
@@ -0,0 +1,44 @@
+import json
+import math
+
+import pytest
+
+import app
+
+
+@pytest.fixture(params=[False, True], ids=['json', 'orjson'])
+def fast_json(request, monkeypatch):
+    if request.param and app.orjson is None:
+        pytest.skip("orjson is not installed")
+    monkeypatch.setattr(app, 'FAST_JSON', request.param)
+    return request.param
+
+
+def test_non_finite_literals(fast_json):
+    assert app.json_loads(b'{"a": 1}') == {'a': 1}
+    assert math.isnan(app.json_loads(b'{"a": NaN}')['a'])
+    assert app.json_loads('[1, -Infinity, Infinity]') == [1, -math.inf, math.inf]
+
+
+def test_invalid_json_is_parsed_once(fast_json, monkeypatch):
+    calls = []
+    json_module_loads = json.loads
+
+    def loads(*args, **kwargs):
+        calls.append(args)
+        return json_module_loads(*args, **kwargs)
+    monkeypatch.setattr(app.json, 'loads', loads)
+
+    for document in (b'{"a": 1,}', b'{"a": nul}', b'[1, 2'):
+        with pytest.raises(ValueError):
+            app.json_loads(document)
+    assert len(calls) == (0 if fast_json else 3)
+
+
+def test_body_over_max_content_length(client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'MAX_CONTENT_LENGTH', 1024)
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    response = client.post('/models/routing', data=json.dumps({'split': {'v': 1.0}, 'pad': 'x' * 2048}),
+                           content_type='application/json', headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 413
+    assert response.get_json() == {'error': 'Request body larger than 1024 bytes'}
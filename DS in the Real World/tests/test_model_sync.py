@@ -0,0 +1,55 @@
+import app
+
+
+class Registry:
+    """
+        The parts of ModelRegistry that ModelSync uses, with loads failing
+        the first failures times
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.bundles = {'v1': object()}
+        self.loading = {}
+        self.routing = None
+
+    def load_tracked(self, path, version=None, activate=False):
+        if self.failures:
+            self.failures -= 1
+            self.loading[version] = {'status': 'failed', 'error': 'disk full'}
+            return None
+        self.loading[version] = {'status': 'loaded', 'version': version}
+        self.bundles[version] = object()
+        return self.bundles[version]
+
+    def set_routing(self, default=None, split=None, shadow=None):
+        if default is not None and default not in self.bundles:
+            raise KeyError('Unknown model version {}'.format(default))
+        self.routing = default
+
+
+def test_failed_load_is_retried(tmp_path):
+    registry = Registry(failures=1)
+    sync = app.ModelSync(registry, str(tmp_path / 'models.json'), interval=1)
+    revision = sync.publish(bundle=('/models/v2', 'v2'), default='v2')
+
+    sync.sync()
+    assert registry.routing is None
+    assert sync.revision != revision
+
+    sync.sync()
+    assert registry.routing == 'v2'
+    assert sync.revision == revision
+
+
+def test_failed_routing_is_retried(tmp_path):
+    registry = Registry(failures=0)
+    sync = app.ModelSync(registry, str(tmp_path / 'models.json'), interval=1)
+    revision = sync.publish(default='v2')
+
+    sync.sync()
+    assert sync.revision != revision
+    registry.bundles['v2'] = object()
+    sync.sync()
+    assert registry.routing == 'v2'
+    assert sync.revision == revision
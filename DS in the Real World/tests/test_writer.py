@@ -0,0 +1,111 @@
+import time
+
+import pytest
+from peewee import OperationalError
+
+import app
+
+
+@pytest.fixture
+def writer():
+    app.create_tables()
+    with app.DB.connection_context():
+        app.Prediction.delete().execute()
+    return app.PredictionWriter(max_rows=10, interval_ms=10, max_retry_seconds=0.05)
+
+
+def make_row(admission_id):
+    return {
+        'admission_id': admission_id,
+        'observation': '[]',
+        'predicted_readmitted': 'Yes',
+        'model_version': 'test',
+        'created_at': time.time(),
+    }
+
+
+def stored_ids():
+    with app.DB.connection_context():
+        return set(row.admission_id for row in app.Prediction.select(app.Prediction.admission_id))
+
+
+def failing(times):
+    """
+        save_predictions failing the first times calls like a locked database
+    """
+    calls = []
+    save_predictions = app.save_predictions
+
+    def save(rows):
+        calls.append(len(rows))
+        if len(calls) <= times:
+            raise OperationalError('database is locked')
+        return save_predictions(rows)
+    return save, calls
+
+
+def test_failed_flush_keeps_the_rows(writer, monkeypatch):
+    save, calls = failing(1)
+    monkeypatch.setattr(app, 'save_predictions', save)
+    assert writer.reserve(5555)
+    writer.buffer.append(make_row(5555))
+    writer.pending.add(5555)
+
+    with pytest.raises(OperationalError):
+        with app.DB.connection_context():
+            writer.flush()
+    assert writer.is_pending(5555)
+    assert not writer.reserve(5555)
+    assert writer.stats()['failed_flushes'] == 1
+
+    with app.DB.connection_context():
+        assert writer.flush() == 1
+    assert not writer.is_pending(5555)
+    assert stored_ids() == {5555}
+
+
+def test_failed_flush_keeps_the_order(writer, monkeypatch):
+    save, calls = failing(1)
+    monkeypatch.setattr(app, 'save_predictions', save)
+    writer.buffer.extend([make_row(1), make_row(2)])
+    with pytest.raises(OperationalError):
+        writer.flush()
+    writer.buffer.append(make_row(3))
+    assert [row['admission_id'] for row in writer.buffer] == [1, 2, 3]
+
+
+def test_writer_thread_retries(writer, monkeypatch):
+    save, calls = failing(3)
+    monkeypatch.setattr(app, 'save_predictions', save)
+    for admission_id in (1, 2, 3):
+        assert writer.reserve(admission_id)
+        writer.put(make_row(admission_id))
+
+    deadline = time.time() + 5
+    while writer.stats()['flushed_rows'] < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(calls) >= 4
+    assert stored_ids() == {1, 2, 3}
+    assert not any(writer.is_pending(admission_id) for admission_id in (1, 2, 3))
+
+
+def test_close_retries(writer, monkeypatch):
+    save, calls = failing(2)
+    monkeypatch.setattr(app, 'save_predictions', save)
+    writer.buffer.extend([make_row(1), make_row(2)])
+
+    assert writer.close()
+    assert len(calls) == 3
+    assert stored_ids() == {1, 2}
+
+
+def test_close_logs_the_rows_it_could_not_write(writer, monkeypatch, capsys):
+    save, calls = failing(1000)
+    monkeypatch.setattr(app, 'save_predictions', save)
+    writer.close_timeout = 0.2
+    writer.buffer.extend([make_row(7), make_row(8)])
+
+    assert not writer.close()
+    assert len(calls) > 1
+    assert 'admission_ids: 7, 8' in capsys.readouterr().out
+    assert writer.stats()['buffered_rows'] == 2